@@ -1,3 +1,10 @@
 from django.contrib import admin
 
+from .models import TokenUsage
+
 # Register your models here.
+
+@admin.register(TokenUsage)
+class TokenUsageAdmin(admin.ModelAdmin):
+    list_display = ["user", "environment", "date", "promptTokens", "completionTokens", "cachedTokens", "requests"]
+    list_filter = ["date"]
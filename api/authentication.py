@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+
+# Create your authentication classes here.
+
+def tokenCacheKey(key: str) -> str:
+    return f"auth-token:{key}"
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Аутентификация по постоянным токенам, кэширующая пользователя токена на TOKEN_CACHE_TTL секунд.
+    Кэш сбрасывается при удалении или замене токена и изменении пользователя
+    """
+
+    def authenticate_credentials(self, key: str):
+        result = cache.get(tokenCacheKey(key))
+        if (result is None):
+            result = super().authenticate_credentials(key)
+            cache.set(tokenCacheKey(key), result, settings.TOKEN_CACHE_TTL)
+        return result
@@ -7,8 +7,23 @@ def once(func):
             initialized = True
     return wrapper
 
+class lazy():
+    """
+    Атрибут класса, значение которого создается `factory` при каждом обращении. Для сервисов-одиночек
+    это откладывает их создание с импорта модуля до первого использования
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __get__(self, instance, owner):
+        # Обращение через класс, например при разборе атрибутов представления, объект не создает
+        if (instance is None):
+            return self
+        return self.factory()
+
 class Singleton(object):
-    def __new__(cls):
+    def __new__(cls, *args, **kwargs):
         if not hasattr(cls, 'instance'):
             cls.instance = super(Singleton, cls).__new__(cls)
         return cls.instance
\ No newline at end of file
@@ -0,0 +1,213 @@
+import json
+import math
+import random
+import statistics
+import subprocess
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+# Create your benchmark helpers here.
+
+def percentile(values: List[float], q: float) -> float:
+    """Возвращает `q`-й перцентиль `values` методом ближайшего ранга"""
+    if (len(values) == 0):
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    """Сводка по задержкам в миллисекундах и пропускной способности в запросах в секунду"""
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "p50": round(percentile(latencies, 50) * 1000, 3),
+        "p95": round(percentile(latencies, 95) * 1000, 3),
+        "p99": round(percentile(latencies, 99) * 1000, 3),
+        "throughput": round((len(latencies) + errors) / elapsed, 3) if elapsed else 0.0,
+    }
+
+def measure(func: Callable, repeat: int = 5, setup: Callable = None) -> Dict:
+    """Вызывает `func` `repeat` раз, перед каждым вызовом выполняя `setup`. Время в миллисекундах"""
+    timings = []
+    for _ in range(repeat):
+        if (setup is not None):
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min": round(min(timings) * 1000, 3),
+        "median": round(statistics.median(timings) * 1000, 3),
+        "max": round(max(timings) * 1000, 3),
+    }
+
+def revision() -> str | None:
+    """Возвращает хеш текущего коммита, если код запущен из git-репозитория"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def syntheticText(size: int, seed: int = 0) -> str:
+    """Генерирует текст из `size` ASCII-символов, разбитый на строки"""
+    rng = random.Random(seed)
+    words = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do")
+    lines = []
+    length = 0
+    while (length < size):
+        line = " ".join(rng.choice(words) for _ in range(12))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+class StubServer(ThreadingHTTPServer):
+    """
+    OpenAI-совместимый сервер, отвечающий на запросы к /v1/chat/completions без обращения к модели
+    """
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            address: tuple,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            promptTokens: int = None,
+            completionTokens: int = 64,
+            chunks: int = 8,
+            errorRate: float = 0.0,
+            errorStatus: int = HTTPStatus.INTERNAL_SERVER_ERROR
+        ):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.promptTokens = promptTokens
+        self.completionTokens = completionTokens
+        self.chunks = max(1, chunks)
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StubServer":
+        """Запускает сервер в фоновом потоке"""
+        threading.Thread(target=self.serve_forever, name="stub-server", daemon=True).start()
+        return self
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if (self.path.rstrip("/") not in ("/v1/models", "/models")):
+            return self.__json({"error": {"message": "not found"}}, HTTPStatus.NOT_FOUND)
+        self.__json({"object": "list", "data": [{"id": "stub", "object": "model", "owned_by": "stub"}]})
+
+    def do_POST(self):
+        if (self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions")):
+            return self.__json({"error": {"message": "not found"}}, HTTPStatus.NOT_FOUND)
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server = self.server
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if (random.random() < server.errorRate):
+            time.sleep(delay)
+            return self.__json(
+                {"error": {"message": "injected error", "type": "server_error"}},
+                server.errorStatus
+            )
+
+        completionTokens = server.completionTokens
+        if (body.get("max_tokens")):
+            completionTokens = min(completionTokens, body["max_tokens"])
+        promptTokens = server.promptTokens
+        if (promptTokens is None):
+            # Около 4 символов на токен
+            promptTokens = sum(len(str(x.get("content", ""))) for x in body.get("messages", [])) // 4
+        usage = {
+            "prompt_tokens": promptTokens,
+            "completion_tokens": completionTokens,
+            "total_tokens": promptTokens + completionTokens,
+        }
+        words = ["stub"] * completionTokens
+        id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model") or "stub"
+
+        if (body.get("stream") == False or body.get("stream") is None):
+            time.sleep(delay)
+            return self.__json({
+                "id": id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        step = math.ceil(len(words) / server.chunks) or 1
+        for i in range(0, max(len(words), 1), step):
+            time.sleep(delay / server.chunks)
+            self.__event({
+                "id": id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": " ".join(words[i:i + step]) + " "},
+                    "finish_reason": None,
+                }],
+            })
+        self.__event({
+            "id": id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        })
+        if ((body.get("stream_options") or {}).get("include_usage")):
+            self.__event({
+                "id": id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            })
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def __event(self, data: Dict) -> None:
+        self.wfile.write(b"data: " + json.dumps(data).encode() + b"\n\n")
+        self.wfile.flush()
+
+    def __json(self, data: Dict, code: int = HTTPStatus.OK) -> None:
+        content = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
@@ -0,0 +1,72 @@
+import hashlib
+import itertools
+import threading
+import weakref
+from typing import Dict
+
+# Create your chat messages here.
+
+class Message():
+    """
+    Сообщение чата. В отличие от словаря хранит только роль и текст, а словарь для запроса к модели
+    создается при отправке. Сообщения используются несколькими чатами (копии окружений, общие блоки файлов),
+    поэтому не изменяются после создания: изменение сообщения заменяет его новым.
+    Идентификатор возрастает с каждым созданным в процессе сообщением и не меняется при сжатии истории
+    """
+
+    __slots__ = ("id", "role", "content")
+
+    ids = itertools.count(1)
+
+    def __init__(self, role: str, content: str):
+        object.__setattr__(self, "id", next(self.ids))
+        object.__setattr__(self, "role", role)
+        object.__setattr__(self, "content", content)
+
+    def __setattr__(self, name: str, value) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    @property
+    def size(self) -> int:
+        return len(self.content)
+
+    def prompt(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self) -> str:
+        return f"Message(role={self.role!r}, content={self.content[:32]!r})"
+
+class FileBlock(Message):
+    """
+    Содержимое файла в контексте модели. Блоки с одинаковым содержимым создаются один раз через `intern`
+    и используются всеми чатами, пока хотя бы один из них на блок ссылается
+    """
+
+    __slots__ = ("filename", "hash", "__weakref__")
+
+    prefix = "This is the content of file "
+
+    blocks: "weakref.WeakValueDictionary[bytes, FileBlock]" = weakref.WeakValueDictionary()
+    lock = threading.Lock()
+
+    def __init__(self, filename: str, text: str, hash: bytes):
+        super().__init__("system", f"{self.prefix}{filename}: {text}")
+        object.__setattr__(self, "filename", filename)
+        object.__setattr__(self, "hash", hash)
+
+    @property
+    def text(self) -> str:
+        return self.content[len(self.prefix) + len(self.filename) + 2:]
+
+    @classmethod
+    def intern(cls, filename: str, text: str) -> "FileBlock":
+        """Возвращает общий блок для файла `filename` с содержимым `text`"""
+        digest = hashlib.blake2b(f"{filename}\0{text}".encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        with cls.lock:
+            block = cls.blocks.get(digest, None)
+            if (block is None):
+                block = cls.blocks[digest] = cls(filename, text, digest)
+        return block
+
+    def __repr__(self) -> str:
+        return f"FileBlock(filename={self.filename!r}, hash={self.hash.hex()})"
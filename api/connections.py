@@ -1,3 +1,6 @@
+import os
+import threading
+
 from openai import OpenAI
 
 from .base import once, Singleton
@@ -32,10 +35,26 @@ class GPTConnection(Connection):
     model: str = None
 
     @once
-    def __init__(self, api_key: str, url: str, model: str):
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=url,
-            timeout=30
-        )
-        self.model = model
\ No newline at end of file
+    def __init__(self, api_key: str = None, url: str = None, model: str = None):
+        # Клиент создается при первом запросе к модели, а не при запуске процесса
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.url = url or os.getenv("OPENAI_API_URL")
+        self.model = model or os.getenv("MODEL_NAME")
+        self._client = None
+        self.lock = threading.Lock()
+
+    @property
+    def client(self) -> OpenAI:
+        if (self._client is None):
+            with self.lock:
+                if (self._client is None):
+                    self._client = OpenAI(
+                        api_key=self.api_key,
+                        base_url=self.url,
+                        timeout=30
+                    )
+        return self._client
+
+    @client.setter
+    def client(self, value: OpenAI) -> None:
+        self._client = value
\ No newline at end of file
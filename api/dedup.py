@@ -0,0 +1,168 @@
+import hashlib
+import re
+import zlib
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Create your deduplication here.
+
+# Количество хеш-функций MinHash и полос LSH: фрагменты попадают в кандидаты, если совпали все значения хотя бы в одной полосе
+PERMUTATIONS = 64
+BANDS = 16
+# Количество слов в шингле
+SHINGLE = 5
+# Фрагменты короче не сравниваются: ссылка на повтор занимает почти столько же токенов
+MIN_CHUNK = 256
+
+_rng = np.random.default_rng(0)
+# Хеширование умножением и сдвигом: (a * h + b) mod 2^64, старшие 32 бита
+_A = _rng.integers(1, 1 << 63, PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 1 << 63, PERMUTATIONS, dtype=np.uint64)
+_SHINGLE_WEIGHTS = _rng.integers(1, 1 << 63, SHINGLE, dtype=np.uint64) | np.uint64(1)
+_BAND_WEIGHTS = _rng.integers(1, 1 << 63, PERMUTATIONS // BANDS, dtype=np.uint64) | np.uint64(1)
+
+def split(text: str, size: int) -> List[str]:
+    """
+    Делит текст на фрагменты по пустым строкам, объединяя короткие абзацы до `size` символов. Границы зависят
+    от содержимого, поэтому вставка в начало файла не сдвигает остальные фрагменты. Фрагменты вместе дают исходный текст
+    """
+    parts = re.split(r"(\n[ \t]*\n)", text)
+    pieces = []
+    for i in range(0, len(parts), 2):
+        piece = parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+        if (len(piece) > size * 4):
+            # Длинные блоки без пустых строк делятся по строкам
+            pieces.extend(piece.splitlines(keepends=True))
+        else:
+            pieces.append(piece)
+
+    chunks = []
+    current = ""
+    for x in pieces:
+        current += x
+        if (len(current) >= size):
+            chunks.append(current)
+            current = ""
+    if (current):
+        chunks.append(current)
+    return chunks
+
+def signatures(chunks: List[str]) -> np.ndarray:
+    """
+    Возвращает подписи MinHash фрагментов по шинглам из `SHINGLE` слов, по строке на фрагмент.
+    Шинглы всех фрагментов хешируются вместе, минимумы считаются по фрагментам через `reduceat`
+    """
+    words = [re.findall(r"\w+", x.lower()) for x in chunks]
+    counts = np.array([max(len(x) - SHINGLE + 1, 1) for x in words])
+    hashes = []
+    for x in words:
+        values = [zlib.crc32(w.encode("utf-8")) for w in x]
+        # Короткий фрагмент дополняется до одного шингла
+        hashes.extend(values + [0] * (SHINGLE - len(values)) if len(values) < SHINGLE else values)
+    hashes = np.array(hashes, dtype=np.uint64)
+
+    # Начала шинглов каждого фрагмента в общем массиве слов
+    lengths = np.array([max(len(x), SHINGLE) for x in words])
+    wordStarts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    positions = np.repeat(wordStarts, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+
+    shingles = np.zeros(len(positions), dtype=np.uint64)
+    for j in range(SHINGLE):
+        shingles += hashes[positions + j] * _SHINGLE_WEIGHTS[j]
+
+    starts = np.cumsum(counts) - counts
+    result = np.empty((len(chunks), PERMUTATIONS), dtype=np.uint64)
+    # По одной хеш-функции за проход, чтобы не держать в памяти матрицу шинглов на все хеш-функции
+    for i in range(PERMUTATIONS):
+        result[:, i] = np.minimum.reduceat((shingles * _A[i] + _B[i]) >> np.uint64(32), starts)
+    return result
+
+def clusters(chunks: List[str], threshold: float) -> List[int]:
+    """
+    Возвращает для каждого фрагмента индекс первого фрагмента с тем же содержимым с точностью до пробелов в конце строк
+    или с оценкой сходства Жаккара не ниже `threshold`. Уникальный фрагмент ссылается на себя
+    """
+    representatives = list(range(len(chunks)))
+    exact: Dict[bytes, int] = {}
+    candidates = []
+    for i, x in enumerate(chunks):
+        if (len(x) < MIN_CHUNK):
+            continue
+        # Отступы сохраняются: в коде они значимы
+        text = "\n".join(line.rstrip() for line in x.strip("\n").splitlines())
+        key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        if (key in exact):
+            representatives[i] = exact[key]
+        else:
+            exact[key] = i
+            candidates.append(i)
+
+    if (threshold >= 1 or len(candidates) < 2):
+        return representatives
+
+    sig = signatures([chunks[i] for i in candidates])
+    rows = PERMUTATIONS // BANDS
+    pairs = set()
+    for band in range(BANDS):
+        keys = (sig[:, band * rows:(band + 1) * rows] * _BAND_WEIGHTS).sum(axis=1)
+        order = np.argsort(keys, kind="stable")
+        ordered = keys[order]
+        # Фрагменты с одинаковым ключом полосы сравниваются с первым фрагментом группы
+        same = np.flatnonzero(ordered[1:] == ordered[:-1]) + 1
+        firsts = np.maximum.accumulate(np.where(np.concatenate(([True], ordered[1:] != ordered[:-1])), np.arange(len(keys)), 0))
+        for j in same:
+            pairs.add((int(order[firsts[j]]), int(order[j])))
+
+    positions = {x: k for k, x in enumerate(candidates)}
+    for first, second in sorted((min(x), max(x)) for x in pairs):
+        if (representatives[candidates[second]] != candidates[second]):
+            continue
+        # Сравнение с первым фрагментом группы, а не с промежуточным, чтобы группа не расползалась по цепочке похожих
+        root = representatives[candidates[first]]
+        if (float(np.mean(sig[positions[root]] == sig[second])) >= threshold):
+            representatives[candidates[second]] = root
+
+    # Точные повторы фрагмента, который сам оказался похож на более ранний
+    for i, root in enumerate(representatives):
+        representatives[i] = representatives[root]
+    return representatives
+
+def deduplicate(files: List[Tuple[str, str]], threshold: float, size: int) -> Tuple[List[str], int]:
+    """
+    Заменяет повторы фрагментов в файлах `files` (имя, текст) ссылкой на первое вхождение, а к первому вхождению
+    добавляет список файлов, где фрагмент повторяется. Возвращает тексты файлов и количество сэкономленных символов
+    """
+    chunks = []
+    owners = []
+    for index, (_, text) in enumerate(files):
+        for x in split(text, size):
+            chunks.append(x)
+            owners.append(index)
+
+    representatives = clusters(chunks, threshold)
+    repeated: Dict[int, List[str]] = {}
+    for i, root in enumerate(representatives):
+        if (root != i and files[owners[i]][0] != files[owners[root]][0]):
+            names = repeated.setdefault(root, [])
+            if (files[owners[i]][0] not in names):
+                names.append(files[owners[i]][0])
+
+    texts = [[] for _ in files]
+    saved = 0
+    for i, (x, root) in enumerate(zip(chunks, representatives)):
+        if (root != i):
+            marker = f"[repeated content, see file {files[owners[root]][0]}]\n"
+            # Подряд идущие повторы из одного файла заменяются одной ссылкой
+            if (len(texts[owners[i]]) == 0 or texts[owners[i]][-1] != marker):
+                texts[owners[i]].append(marker)
+                saved -= len(marker)
+            saved += len(x)
+        elif (i in repeated):
+            note = f"[this fragment also appears in: {', '.join(repeated[i])}]\n"
+            texts[owners[i]].append(x if x.endswith("\n") else f"{x}\n")
+            texts[owners[i]].append(note)
+            saved -= len(note) + (0 if x.endswith("\n") else 1)
+        else:
+            texts[owners[i]].append(x)
+    return ["".join(x) for x in texts], saved
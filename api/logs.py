@@ -0,0 +1,61 @@
+import json
+import logging
+import random
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any
+
+from django.conf import settings
+
+# Create your logging helpers here.
+
+requestId: ContextVar[str] = ContextVar("requestId", default="")
+
+# Атрибуты LogRecord, которые не относятся к полям, переданным через extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "requestId"}
+
+def truncate(value: Any, limit: int = None) -> Any:
+    """Обрезает строки длиннее `limit` символов и списки длиннее `limit` элементов, в том числе вложенные"""
+    limit = limit or settings.LOG_MAX_LENGTH
+    if (isinstance(value, str)):
+        return value if len(value) <= limit else f"{value[:limit]}... ({len(value)} chars)"
+    if (isinstance(value, dict)):
+        return {k: truncate(v, limit) for k, v in value.items()}
+    if (isinstance(value, (list, tuple))):
+        result = [truncate(x, limit) for x in value[:limit]]
+        if (len(value) > limit):
+            result.append(f"... ({len(value)} items)")
+        return result
+    return value
+
+def sampled(rate: float = None) -> bool:
+    """Решает, записывать ли подробное событие, с вероятностью `rate`"""
+    rate = settings.LOG_SAMPLE_RATE if rate is None else rate
+    return rate >= 1 or random.random() < rate
+
+class RequestIdFilter(logging.Filter):
+    """
+    Добавляет в записи идентификатор текущего запроса
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.requestId = requestId.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует записи как JSON-объекты, по одному на строку
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "requestId": getattr(record, "requestId", ""),
+        }
+        data.update({k: v for k, v in vars(record).items() if k not in RECORD_ATTRIBUTES})
+        if (record.exc_info):
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
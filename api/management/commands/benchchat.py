@@ -0,0 +1,94 @@
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import revision, syntheticText
+from api.chats import FileBlock, Message
+from api.connections import GPTConnection
+from api.services import GPTService
+
+class Command(BaseCommand):
+    help = """Измеряет память, занимаемую чатами: словари с отдельной копией содержимого файлов в каждом чате
+            и сообщения со __slots__ с общими блоками файлов"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=1000, help="Количество чатов")
+        parser.add_argument("--file-sets", type=int, default=10, help="Количество различных наборов файлов, которые делят чаты")
+        parser.add_argument("--files", type=int, default=10, help="Количество файлов в наборе")
+        parser.add_argument("--file-size", type=int, default=4096, help="Размер файла в символах")
+        parser.add_argument("--turns", type=int, default=10, help="Количество пар вопрос-ответ в чате")
+        parser.add_argument("--turn-size", type=int, default=256, help="Размер сообщения в символах")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+
+    def handle(self, *args, **options):
+        GPTConnection(api_key="benchmark", url=None, model=None)
+
+        fileSets = [
+            {f"file{j}.txt": syntheticText(options["file_size"], seed=i * options["files"] + j) for j in range(options["files"])}
+            for i in range(options["file_sets"])
+        ]
+        turns = lambda i: [
+            (role, syntheticText(options["turn_size"], seed=(i * options["turns"] + j) * 2 + (role == "assistant")))
+            for j in range(options["turns"]) for role in ("user", "assistant")
+        ]
+        # Файлы читаются с диска при каждой загрузке в контекст, поэтому каждый чат получает свои копии строк
+        read = lambda i: {name: text.encode().decode() for name, text in fileSets[i % len(fileSets)].items()}
+
+        unique = sum(len(x[1]) for i in range(options["conversations"]) for x in turns(i))
+        results = [
+            self.measure("dicts", lambda: self.dicts(options["conversations"], read, turns), options["conversations"]),
+            self.measure("compact", lambda: self.compact(options["conversations"], read, turns), options["conversations"]),
+        ]
+
+        self.stdout.write(f"turn text: {unique} chars in {options['conversations']} conversations")
+        self.stdout.write(f"{'store':<10}{'total MiB':>12}{'per chat KiB':>15}{'build s':>10}")
+        for x in results:
+            self.stdout.write(f"{x['store']:<10}{x['bytes'] / 2 ** 20:>12.2f}{x['perConversation'] / 1024:>15.2f}{x['seconds']:>10}")
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"revision": revision(), "options": options, "uniqueTurnChars": unique, "results": results}, file, indent=2, default=str)
+
+    def dicts(self, count: int, read: Callable, turns: Callable) -> List:
+        """Представление чата до появления api.chats: словари и строки с содержимым файлов в каждом чате"""
+        default = [{"role": "system", "content": GPTService.default_context[0].content}]
+        return [
+            default
+            + [{"role": "system", "content": f"This is the content of file {name}: " + text} for name, text in read(i).items()]
+            + [{"role": role, "content": content} for role, content in turns(i)]
+            for i in range(count)
+        ]
+
+    def compact(self, count: int, read: Callable, turns: Callable) -> GPTService:
+        service = GPTService()
+        for i in range(count):
+            chat = service.createConversation(
+                f"benchmark-{i}",
+                files=[FileBlock.intern(name, text) for name, text in read(i).items()]
+            )
+            chat.messages.extend(Message(role, content) for role, content in turns(i))
+        return service
+
+    def measure(self, store: str, build: Callable, count: int) -> Dict:
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = build()
+            elapsed = time.perf_counter() - start
+            gc.collect()
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        if (isinstance(result, GPTService)):
+            for i in range(count):
+                result.closeConversation(f"benchmark-{i}")
+        del result
+        return {"store": store, "bytes": size, "perConversation": size // count, "seconds": round(elapsed, 3)}
@@ -0,0 +1,120 @@
+import copy
+import json
+import threading
+import time
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from api.benchmarks import revision, summarize
+
+def integers(value: str) -> List[int]:
+    return [int(x) for x in value.split(",") if x]
+
+class Command(BaseCommand):
+    help = """Измеряет задержку запросов к базе данных из настроек с разной параллельностью при новом соединении
+            на каждый запрос, постоянных соединениях и пуле соединений psycopg 3"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=integers, default=[1, 8, 32], help="Уровни параллельности, через запятую")
+        parser.add_argument("--requests", type=int, default=2000, help="Количество запросов на каждый уровень параллельности")
+        parser.add_argument("--queries", type=int, default=2, help="Количество запросов к базе данных за один запрос к API")
+        parser.add_argument("--database", default="default", help="Псевдоним базы данных из настроек")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+
+    def handle(self, *args, **options):
+        base = connections.settings.get(options["database"], None)
+        if (base is None):
+            raise CommandError(f"database {options['database']} is not configured")
+
+        results = []
+        for mode, overrides in self.modes(options["database"], max(options["concurrency"])).items():
+            alias = f"benchmark-{mode}"
+            connections.settings[alias] = {
+                **copy.deepcopy(base),
+                **overrides,
+                "OPTIONS": {**{k: v for k, v in base.get("OPTIONS", {}).items() if k != "pool"}, **overrides.get("OPTIONS", {})},
+            }
+            try:
+                for concurrency in options["concurrency"]:
+                    results.append({
+                        "mode": mode,
+                        "concurrency": concurrency,
+                        **self.measure(alias, concurrency, options["requests"], options["queries"]),
+                    })
+            finally:
+                close = getattr(connections[alias], "close_pool", None)
+                if (close is not None):
+                    close()
+                connections[alias].close()
+
+        self.stdout.write(f"{'mode':<14}{'conc':>6}{'reqs':>7}{'errs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>11}")
+        for x in results:
+            self.stdout.write(
+                f"{x['mode']:<14}{x['concurrency']:>6}{x['requests']:>7}{x['errors']:>6}"
+                f"{x['p50']:>10}{x['p95']:>10}{x['p99']:>10}{x['throughput']:>11}"
+            )
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"revision": revision(), "vendor": connections[options["database"]].vendor, "results": results}, file, indent=2)
+
+    def modes(self, database: str, concurrency: int) -> Dict[str, Dict]:
+        """Режимы подключения. Пул доступен только для PostgreSQL с драйвером psycopg 3"""
+        modes = {
+            "per-request": {"CONN_MAX_AGE": 0},
+            "persistent": {"CONN_MAX_AGE": None, "CONN_HEALTH_CHECKS": True},
+        }
+        connection = connections[database]
+        if (connection.vendor == "postgresql" and connection.Database.__name__ == "psycopg"):
+            modes["pool"] = {
+                "CONN_MAX_AGE": 0,
+                "OPTIONS": {"pool": {"min_size": 2, "max_size": concurrency}},
+            }
+        else:
+            self.stderr.write("Connection pool requires PostgreSQL with psycopg 3, skipping pool mode")
+        return modes
+
+    def measure(self, alias: str, concurrency: int, requests: int, queries: int) -> Dict:
+        """Имитирует цикл запроса к API: несколько запросов к базе данных и закрытие устаревших соединений"""
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def worker(count: int) -> None:
+            nonlocal errors
+            connection = connections[alias]
+            try:
+                for _ in range(count):
+                    start = time.perf_counter()
+                    try:
+                        for _ in range(queries):
+                            with connection.cursor() as cursor:
+                                cursor.execute("SELECT 1")
+                                cursor.fetchone()
+                        # То же, что делает Django по сигналу request_finished
+                        connection.close_if_unusable_or_obsolete()
+                    except Exception:
+                        with lock:
+                            errors += 1
+                        continue
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(requests // concurrency + (i < requests % concurrency),))
+            for i in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+
+        return summarize(latencies, errors, time.perf_counter() - start)
@@ -0,0 +1,67 @@
+import json
+import random
+from typing import List, Tuple
+
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import measure, revision, syntheticText
+from api.dedup import deduplicate
+
+class Command(BaseCommand):
+    help = """Измеряет время удаления повторов из файлов окружения и долю сэкономленных токенов на файлах,
+            часть которых - версии одного документа с небольшими правками"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--files", type=int, default=20, help="Количество файлов в окружении")
+        parser.add_argument("--size", type=int, default=64 * 1024, help="Размер файла в символах")
+        parser.add_argument("--versions", type=float, default=0.5, help="Доля файлов, являющихся версиями других файлов")
+        parser.add_argument("--chunk", type=int, default=1024, help="Размер фрагмента в символах")
+        parser.add_argument("--repeat", type=int, default=5, help="Количество повторов каждого измерения")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+
+    def handle(self, *args, **options):
+        files = self.environment(options["files"], options["size"], options["versions"])
+        total = sum(len(x) for _, x in files)
+
+        results = []
+        for threshold in (1.0, 0.9, 0.8):
+            _, saved = deduplicate(files, threshold, options["chunk"])
+            results.append({
+                "threshold": threshold,
+                "chars": total,
+                "savedTokens": max(saved // 4, 0),
+                "savedShare": round(saved / total, 4) if total else 0.0,
+                **measure(lambda: deduplicate(files, threshold, options["chunk"]), options["repeat"]),
+            })
+
+        self.stdout.write(f"{'threshold':<11}{'chars':>10}{'saved tokens':>14}{'saved %':>9}{'median ms':>11}{'max ms':>10}")
+        for x in results:
+            self.stdout.write(
+                f"{x['threshold']:<11}{x['chars']:>10}{x['savedTokens']:>14}{x['savedShare'] * 100:>9.1f}"
+                f"{x['median']:>11}{x['max']:>10}"
+            )
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"revision": revision(), "options": options, "results": results}, file, indent=2, default=str)
+
+    def environment(self, count: int, size: int, versions: float) -> List[Tuple[str, str]]:
+        """Создает файлы из абзацев, часть файлов - копии предыдущих с измененными абзацами"""
+        rng = random.Random(0)
+        files = []
+        for i in range(count):
+            if (files and rng.random() < versions):
+                _, source = rng.choice(files)
+                paragraphs = source.split("\n\n")
+                for _ in range(max(len(paragraphs) // 20, 1)):
+                    # Правка нескольких слов в абзаце
+                    k = rng.randrange(len(paragraphs))
+                    paragraphs[k] = paragraphs[k].replace("lorem", "LOREM", 3)
+                files.append((f"file-{i}.md", "\n\n".join(paragraphs)))
+            else:
+                text = syntheticText(size, seed=i)
+                lines = text.split("\n")
+                files.append((f"file-{i}.md", "\n\n".join("\n".join(lines[j:j + 4]) for j in range(0, len(lines), 4))))
+        return files
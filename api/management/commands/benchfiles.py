@@ -0,0 +1,130 @@
+import inspect
+import json
+import os
+import tempfile
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import measure, revision, syntheticText
+from api.connections import GPTConnection
+from api.managers import FileManager
+from api.services import EnvironmentService, FileService
+
+def integers(value: str) -> List[int]:
+    return [int(x) for x in value.split(",") if x]
+
+class Command(BaseCommand):
+    help = """Измеряет время методов FileManager для каждого хранилища, а также getFilesContext и commitFiles
+            на синтетических окружениях. Результаты можно сохранить в JSON и сравнить с результатами другого коммита"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--files", type=integers, default=[100, 1000, 10000], help="Количество файлов в окружении, через запятую")
+        parser.add_argument("--file-size", type=integers, default=[1024, 65536], help="Размер файла в байтах, через запятую")
+        parser.add_argument(
+            "--max-total-size", type=int, default=512 * 1024 * 1024,
+            help="Пропускать сочетания, при которых размер окружения превышает это значение в байтах"
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="Количество повторов каждого измерения")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+        parser.add_argument("--compare", default=None, help="JSON с результатами другого запуска для сравнения медиан")
+
+    def handle(self, *args, **options):
+        GPTConnection(api_key="benchmark", url=None, model=None)
+
+        cwd = os.getcwd()
+        storage = tempfile.TemporaryDirectory(prefix="benchfiles-")
+        os.chdir(storage.name)
+        try:
+            results = self.run(storage.name, options)
+        finally:
+            os.chdir(cwd)
+            storage.cleanup()
+
+        previous = {}
+        if (options["compare"]):
+            with open(options["compare"], "r", encoding="utf-8") as file:
+                previous = {self.key(x): x for x in json.load(file)["results"]}
+
+        self.stdout.write(f"{'backend':<18}{'operation':<22}{'files':>7}{'size':>9}{'min ms':>11}{'median ms':>11}{'max ms':>11}{'vs prev':>9}")
+        for x in results:
+            ratio = ""
+            if (self.key(x) in previous and previous[self.key(x)]["median"]):
+                ratio = f"{x['median'] / previous[self.key(x)]['median']:.2f}x"
+            self.stdout.write(
+                f"{x['backend']:<18}{x['operation']:<22}{x['files']:>7}{x['size']:>9}"
+                f"{x['min']:>11}{x['median']:>11}{x['max']:>11}{ratio:>9}"
+            )
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"revision": revision(), "results": results}, file, indent=2)
+
+    def key(self, result: Dict) -> tuple:
+        return (result["backend"], result["operation"], result["files"], result["size"])
+
+    def run(self, root: str, options: Dict) -> List[Dict]:
+        backends = [x for x in FileManager.__subclasses__() if inspect.isabstract(x) == False]
+        fileService = FileService()
+        environmentService = EnvironmentService()
+        default = fileService.fileManager
+        repeat = options["repeat"]
+
+        results = []
+        for backend in backends:
+            basePath = os.path.join(root, backend.__name__)
+            os.makedirs(basePath, exist_ok=True)
+            manager: FileManager = backend(basePath=basePath)
+            fileService.fileManager = manager
+
+            for files in options["files"]:
+                for size in options["file_size"]:
+                    if (files * size > options["max_total_size"]):
+                        continue
+
+                    path = f"{files}-{size}"
+                    content = syntheticText(size)
+                    data = content.encode("utf-8")
+                    chunks = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+                    line = data[:128] + b"\n"
+                    manager.makeDir(path)
+                    for i in range(files):
+                        manager.saveFile(path, f"file-{i}.txt", content)
+
+                    cases = {
+                        "list": (lambda: manager.list(path), None, repeat),
+                        "listFiles": (lambda: manager.listFiles(path), None, repeat),
+                        "listFilesStat": (lambda: manager.listFilesStat(path), None, repeat),
+                        "exists": (lambda: manager.exists(f"{path}/file-0.txt"), None, repeat),
+                        "readFile": (lambda: manager.readFile(path, "file-0.txt"), None, repeat),
+                        "readFile (all)": (lambda: [manager.readFile(path, f"file-{i}.txt") for i in range(files)], None, repeat),
+                        "saveFile": (lambda: manager.saveFile(path, "extra.txt", content), None, repeat),
+                        "saveFileByChunks": (lambda: manager.saveFileByChunks(path, "extra.txt", iter(chunks)), None, repeat),
+                        # Дописывается одна строка, стоимость не должна зависеть от размера файла
+                        "appendFileByChunks": (lambda: manager.appendFileByChunks(path, "extra.txt", iter((line,))), None, repeat),
+                        "removeFile": (
+                            lambda: manager.removeFile(path, "extra.txt"),
+                            lambda: manager.saveFile(path, "extra.txt", content),
+                            repeat
+                        ),
+                        "getFilesContext": (lambda: environmentService.getFilesContext(path), None, repeat),
+                        "commitFiles": (lambda: environmentService.commitFiles(path), None, repeat),
+                        # Очистка удаляет окружение, поэтому измеряется последней и один раз
+                        "clearDir": (lambda: manager.clearDir(path), None, 1),
+                    }
+                    for operation, (func, setup, count) in cases.items():
+                        results.append({
+                            "backend": backend.__name__,
+                            "operation": operation,
+                            "files": files,
+                            "size": size,
+                            **measure(func, count, setup),
+                        })
+
+                    environmentService.gptService.closeConversation(path)
+                    manager.removeDir(path)
+
+        fileService.fileManager = default
+        return results
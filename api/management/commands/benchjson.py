@@ -0,0 +1,76 @@
+import gzip
+import json
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from api.benchmarks import measure, revision, syntheticText
+from api.renderers import dumps
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def integers(value: str) -> List[int]:
+    return [int(x) for x in value.split(",") if x]
+
+class Command(BaseCommand):
+    help = """Измеряет время сериализации контекста чата стандартным json и orjson, а также время сжатия
+            и размер ответа без сжатия, с gzip и brotli"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=integers, default=[20, 200, 1000], help="Количество сообщений в чате, через запятую")
+        parser.add_argument("--message-size", type=int, default=4096, help="Размер сообщения в символах")
+        parser.add_argument("--repeat", type=int, default=10, help="Количество повторов каждого измерения")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+
+    def handle(self, *args, **options):
+        results = []
+        for count in options["messages"]:
+            context = self.context(count, options["message_size"])
+            results.extend(self.measure(count, context, options["repeat"]))
+
+        self.stdout.write(f"{'messages':>9}  {'step':<12}{'median ms':>11}{'bytes':>12}")
+        for x in results:
+            self.stdout.write(f"{x['messages']:>9}  {x['step']:<12}{x['median']:>11}{x['bytes']:>12}")
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"revision": revision(), "results": results}, file, indent=2)
+
+    def context(self, count: int, size: int) -> List[Dict[str, str]]:
+        """Контекст чата в том виде, в котором его возвращает get-context"""
+        return [
+            {"id": i + 1, "role": "user" if i % 2 == 0 else "assistant", "content": syntheticText(size, seed=i)}
+            for i in range(count)
+        ]
+
+    def measure(self, count: int, context: List[Dict[str, str]], repeat: int) -> List[Dict]:
+        # Так сериализует данные JsonResponse
+        stdlib = lambda: json.dumps(context, cls=DjangoJSONEncoder).encode()
+        body = dumps(context)
+        steps = {
+            "json": (stdlib, len(stdlib())),
+            "orjson": (lambda: dumps(context), len(body)),
+            "gzip": (
+                lambda: gzip.compress(body, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0),
+                len(gzip.compress(body, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0)),
+            ),
+        }
+        if (brotli is not None):
+            steps["brotli"] = (
+                lambda: brotli.compress(body, quality=settings.COMPRESSION_BROTLI_QUALITY),
+                len(brotli.compress(body, quality=settings.COMPRESSION_BROTLI_QUALITY)),
+            )
+        else:
+            self.stderr.write("brotli is not installed, skipping brotli compression")
+
+        return [
+            {"messages": count, "step": step, "bytes": size, **measure(func, repeat=repeat)}
+            for step, (func, size) in steps.items()
+        ]
@@ -0,0 +1,172 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from openai import OpenAI
+from rest_framework.authtoken.models import Token
+
+from api.benchmarks import StubServer, summarize
+from api.connections import GPTConnection
+
+def integers(value: str) -> List[int]:
+    return [int(x) for x in value.split(",") if x]
+
+class Command(BaseCommand):
+    help = """Нагрузочное тестирование эндпоинтов generate и commit-files с OpenAI-совместимой заглушкой вместо модели.
+            Создает тестовую базу данных и временное хранилище окружений, выводит p50/p95/p99 задержки и пропускную способность"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=integers, default=[1, 4, 16], help="Уровни параллельности, через запятую")
+        parser.add_argument("--files", type=integers, default=[1, 10], help="Количество файлов в окружении, через запятую")
+        parser.add_argument("--file-size", type=integers, default=[1024, 65536], help="Размер файла в байтах, через запятую")
+        parser.add_argument("--requests", type=int, default=50, help="Количество запросов на каждый уровень параллельности")
+        parser.add_argument(
+            "--actions", type=lambda x: x.split(","), default=["generate", "commit-files"],
+            help="Эндпоинты окружения, через запятую"
+        )
+        parser.add_argument("--stub-url", default=None, help="URL запущенной заглушки (stubserver), по умолчанию запускается встроенная")
+        parser.add_argument("--latency", type=float, default=50.0, help="Задержка встроенной заглушки в миллисекундах")
+        parser.add_argument("--jitter", type=float, default=0.0, help="Случайная добавка к задержке встроенной заглушки в миллисекундах")
+        parser.add_argument("--prompt-tokens", type=int, default=100, help="Количество токенов запроса, возвращаемое встроенной заглушкой")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ошибок встроенной заглушки")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+
+    def handle(self, *args, **options):
+        stub = None
+        url = options["stub_url"]
+        if (url is None):
+            stub = StubServer(
+                ("127.0.0.1", 0),
+                latency=options["latency"] / 1000,
+                jitter=options["jitter"] / 1000,
+                promptTokens=options["prompt_tokens"],
+                errorRate=options["error_rate"],
+            ).start()
+            url = stub.url
+
+        gpt = GPTConnection(api_key="stub", url=url, model="stub")
+        gpt.client = OpenAI(api_key="stub", base_url=url, max_retries=0)
+        gpt.model = "stub"
+
+        # Хранилище окружений создается относительно рабочей директории
+        cwd = os.getcwd()
+        storage = tempfile.TemporaryDirectory(prefix="benchload-")
+        os.chdir(storage.name)
+
+        setup_test_environment()
+        name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = self.run(options)
+        finally:
+            connection.creation.destroy_test_db(name, verbosity=0)
+            teardown_test_environment()
+            os.chdir(cwd)
+            storage.cleanup()
+            if (stub is not None):
+                stub.shutdown()
+                stub.server_close()
+
+        self.stdout.write(f"{'action':<14}{'files':>7}{'size':>9}{'conc':>6}{'reqs':>6}{'errs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>10}")
+        for x in results:
+            self.stdout.write(
+                f"{x['action']:<14}{x['files']:>7}{x['size']:>9}{x['concurrency']:>6}{x['requests']:>6}{x['errors']:>6}"
+                f"{x['p50']:>10}{x['p95']:>10}{x['p99']:>10}{x['throughput']:>10}"
+            )
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"options": {k: v for k, v in options.items() if k in (
+                    "concurrency", "files", "file_size", "requests", "actions", "latency", "jitter", "prompt_tokens", "error_rate"
+                )}, "results": results}, file, indent=2)
+
+    def run(self, options: Dict) -> List[Dict]:
+        user = User.objects.create_user(username="benchmark", password="benchmark")
+        token = Token.objects.create(user=user)
+        headers = {"HTTP_AUTHORIZATION": f"Token {token.key}"}
+        client = Client(**headers)
+        random.seed(0)
+
+        results = []
+        for files in options["files"]:
+            for size in options["file_size"]:
+                environments = []
+                for i in range(max(options["concurrency"])):
+                    response = client.post(
+                        "/api/v1/environments/",
+                        {"name": f"benchmark-{files}-{size}-{i}", "user": user.id},
+                        content_type="application/json"
+                    )
+                    environments.append(response.json()["id"])
+                    for j in range(files):
+                        content = " ".join(random.choice(("lorem", "ipsum", "dolor", "sit", "amet")) for _ in range(size // 6))
+                        client.post(
+                            f"/api/v1/environments/{environments[-1]}/load-file/",
+                            {"file": SimpleUploadedFile(f"file-{j}.txt", content.encode()[:size])}
+                        )
+
+                for action in options["actions"]:
+                    for concurrency in options["concurrency"]:
+                        for x in environments:
+                            client.post(f"/api/v1/environments/{x}/commit-files/")
+
+                        results.append({
+                            "action": action,
+                            "files": files,
+                            "size": size,
+                            "concurrency": concurrency,
+                            **self.measure(action, environments[:concurrency], options["requests"], headers),
+                        })
+        return results
+
+    def measure(self, action: str, environments: List[int], requests: int, headers: Dict) -> Dict:
+        """Отправляет `requests` запросов к `action`, распределяя их по потокам, по одному на окружение"""
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def worker(environment: int, count: int) -> None:
+            nonlocal errors
+            client = Client(**headers)
+            try:
+                for _ in range(count):
+                    start = time.perf_counter()
+                    response = client.post(
+                        f"/api/v1/environments/{environment}/{action}/",
+                        {"prompt": "benchmark"} if action == "generate" else {},
+                        content_type="application/json"
+                    )
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        if (response.status_code < 400):
+                            latencies.append(elapsed)
+                        else:
+                            errors += 1
+            finally:
+                connections.close_all()
+
+        threads = [
+            threading.Thread(
+                target=worker,
+                args=(x, requests // len(environments) + (i < requests % len(environments)))
+            )
+            for i, x in enumerate(environments)
+        ]
+        start = time.perf_counter()
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+
+        return summarize(latencies, errors, time.perf_counter() - start)
@@ -0,0 +1,102 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from drf_spectacular.views import SpectacularAPIView
+
+from api.benchmarks import measure, revision
+from api.views import SchemaView
+
+# Запуск приложения в отдельном процессе: импорт WSGI-приложения, загрузка маршрутов и прогрев
+STARTUP = """
+import json, time
+start = time.perf_counter()
+from base.wsgi import application
+imported = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+routed = time.perf_counter()
+from api.warmup import warmUp
+timings = warmUp()
+print(json.dumps({
+    "import": round((imported - start) * 1000, 3),
+    "urls": round((routed - imported) * 1000, 3),
+    **timings,
+}))
+"""
+
+class Command(BaseCommand):
+    help = """Измеряет время от импорта WSGI-приложения до готовности к запросам в отдельных процессах,
+            время каждого шага прогрева и задержку запроса схемы OpenAPI с кэшем и без него"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=5, help="Количество запусков приложения")
+        parser.add_argument("--repeat", type=int, default=20, help="Количество запросов схемы в каждом измерении")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+
+    def handle(self, *args, **options):
+        startup = self.startup(options["processes"])
+        schema = self.schema(options["repeat"])
+
+        self.stdout.write(f"{'startup step':<14}{'median ms':>11}{'max ms':>10}")
+        for step in startup[0]:
+            values = [x[step] for x in startup]
+            self.stdout.write(f"{step:<14}{statistics.median(values):>11.3f}{max(values):>10.3f}")
+
+        self.stdout.write(f"{'schema':<20}{'format':<8}{'min ms':>10}{'median ms':>11}{'max ms':>10}")
+        for x in schema:
+            self.stdout.write(f"{x['view']:<20}{x['format']:<8}{x['min']:>10}{x['median']:>11}{x['max']:>10}")
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"revision": revision(), "startup": startup, "schema": schema}, file, indent=2)
+
+    def startup(self, processes: int) -> List[Dict]:
+        env = {
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join(x for x in (str(settings.BASE_DIR), os.getenv("PYTHONPATH")) if x),
+            "DJANGO_SETTINGS_MODULE": os.environ["DJANGO_SETTINGS_MODULE"],
+            "WARMUP": "False",
+        }
+        env.setdefault("OPENAI_API_KEY", "benchmark")
+
+        results = []
+        # Хранилище окружений создается относительно рабочей директории
+        with tempfile.TemporaryDirectory(prefix="benchstartup-") as cwd:
+            for _ in range(processes):
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable, "-c", STARTUP], cwd=cwd, env=env, capture_output=True, text=True)
+                elapsed = time.perf_counter() - start
+                if (process.returncode != 0):
+                    raise CommandError(process.stderr)
+                timings = json.loads(process.stdout.strip().splitlines()[-1])
+                timings["ready"] = round(sum(timings.values()), 3)
+                # Вместе с запуском интерпретатора
+                timings["process"] = round(elapsed * 1000, 3)
+                results.append(timings)
+        return results
+
+    def schema(self, repeat: int) -> List[Dict]:
+        factory = RequestFactory()
+        results = []
+        for name, view in (("SpectacularAPIView", SpectacularAPIView.as_view()), ("SchemaView", SchemaView.as_view())):
+            for format, query in (("yaml", {}), ("json", {"format": "json"})):
+                SchemaView.schemas.clear()
+
+                def get():
+                    response = view(factory.get("/api/schema/", query))
+                    if (hasattr(response, "render")):
+                        response.render()
+
+                results.append({"view": name, "format": format, **measure(get, repeat)})
+        return results
@@ -0,0 +1,84 @@
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import revision, summarize
+from api.managers import LocalFileManager
+
+class Command(BaseCommand):
+    help = """Измеряет задержку создания, поиска и чтения списка файлов окружений, а также перебора всех окружений
+            при хранении в одной директории и в сегментах shards/<хеш>/"""
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--environments", type=int, default=100000, help="Количество окружений")
+        parser.add_argument("--lookups", type=int, default=10000, help="Количество случайных обращений к окружениям")
+        parser.add_argument("--dir", default=None, help="Директория для временного хранилища (по умолчанию системная)")
+        parser.add_argument("--output", default=None, help="Путь для сохранения результатов в формате JSON")
+
+    def handle(self, *args, **options):
+        results = []
+        for layout, sharded in (("flat", False), ("sharded", True)):
+            with tempfile.TemporaryDirectory(prefix="benchstorage-", dir=options["dir"]) as root:
+                manager = LocalFileManager(basePath=root, sharded=sharded, fsync=False)
+                results.extend(self.run(layout, manager, options))
+
+        self.stdout.write(f"{'layout':<9}{'operation':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>12}")
+        for x in results:
+            self.stdout.write(
+                f"{x['layout']:<9}{x['operation']:<14}{x['requests']:>8}"
+                f"{x['p50']:>10}{x['p95']:>10}{x['p99']:>10}{x['throughput']:>12}"
+            )
+
+        if (options["output"]):
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump({"revision": revision(), "environments": options["environments"], "results": results}, file, indent=2)
+
+    def run(self, layout: str, manager: LocalFileManager, options: Dict) -> List[Dict]:
+        count = options["environments"]
+        rng = random.Random(0)
+        sample = [str(rng.randrange(count)) for _ in range(options["lookups"])]
+
+        def create(name: str) -> None:
+            manager.makeDir(name)
+            manager.saveFile(name, "file.txt", "content")
+
+        cases = [
+            ("create", create, [str(x) for x in range(count)]),
+            ("exists", manager.exists, sample),
+            ("listFilesStat", manager.listFilesStat, sample),
+            ("readFile", lambda x: manager.readFile(x, "file.txt"), sample),
+            ("create (new)", create, [str(count + x) for x in range(min(options["lookups"], count))]),
+        ]
+        results = [{"layout": layout, "operation": operation, **self.measure(func, args)} for operation, func, args in cases]
+
+        # Перебор всех окружений, например для сборки мусора
+        start = time.perf_counter()
+        total = sum(1 for _ in manager.listDirs())
+        elapsed = time.perf_counter() - start
+        results.append({
+            "layout": layout,
+            "operation": "listDirs",
+            **summarize([elapsed], 0, elapsed),
+            "requests": total,
+            "throughput": round(total / elapsed, 3) if elapsed else 0.0,
+        })
+
+        entries = len(os.listdir(manager.basePath))
+        self.stderr.write(f"{layout}: {entries} entries in the base directory")
+        return results
+
+    def measure(self, func: Callable, args: List[str]) -> Dict:
+        latencies = []
+        start = time.perf_counter()
+        for x in args:
+            begin = time.perf_counter()
+            func(x)
+            latencies.append(time.perf_counter() - begin)
+        return summarize(latencies, 0, time.perf_counter() - start)
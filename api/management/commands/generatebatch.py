@@ -0,0 +1,44 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Environment
+from api.services import EnvironmentService
+
+class Command(BaseCommand):
+    help = "Генерирует текстовые файлы для нескольких окружений и выводит результаты в формате NDJSON по мере готовности"
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, help="Идентификаторы окружений")
+        parser.add_argument("--prompt", default='', help="Дополнительный запрос для всех окружений из ids")
+        parser.add_argument(
+            "--file",
+            help='JSON-файл со списком объектов {"id": ..., "prompt": ...}, "-" для чтения из stdin'
+        )
+
+    def handle(self, *args, **options):
+        items = [{"id": str(x), "prompt": options["prompt"]} for x in options["ids"]]
+        if (options["file"]):
+            try:
+                if (options["file"] == "-"):
+                    data = json.load(sys.stdin)
+                else:
+                    with open(options["file"], "r", encoding="utf-8") as file:
+                        data = json.load(file)
+                items += [{"id": str(x["id"]), "prompt": x.get("prompt") or ''} for x in data]
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                raise CommandError(f"invalid items file: {e}")
+
+        if (len(items) == 0):
+            raise CommandError("no environments given")
+
+        existing = set(
+            str(x) for x in Environment.objects.filter(id__in=[x["id"] for x in items]).values_list("id", flat=True)
+        )
+        for x in items:
+            if (x["id"] not in existing):
+                self.stdout.write(json.dumps({"id": int(x["id"]), "detail": "Not found."}))
+
+        for x in EnvironmentService().generateBatch([x for x in items if x["id"] in existing]):
+            self.stdout.write(json.dumps({**x, "id": int(x["id"])}))
@@ -0,0 +1,52 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.managers import LocalFileManager
+from api.services import FileService
+
+class Command(BaseCommand):
+    help = """Переносит директории окружений в раскладку из настройки FILES_SHARDED: из общей директории
+            в сегменты shards/<хеш>/ или обратно. Перед переносом остановите сервер"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Вывести переносы, не выполняя их")
+
+    def handle(self, *args, **options):
+        target = FileService().fileManager
+        if (isinstance(target, LocalFileManager) == False):
+            raise CommandError(f"{type(target).__name__} does not support migration")
+        source = LocalFileManager(basePath=target.basePath, sharded=not target.sharded, fsync=target.fsync)
+
+        moved = skipped = 0
+        # Список собирается заранее, потому что переносы меняют перебираемые директории
+        for name in list(source.listDirs()):
+            path = source.makePath(name)
+            destination = target.makePath(name)
+            if (os.path.exists(destination)):
+                self.stderr.write(f"{destination} already exists, skipping {path}")
+                skipped += 1
+                continue
+
+            if (options["verbosity"] > 1 or options["dry_run"]):
+                self.stdout.write(f"{path} -> {destination}")
+            if (options["dry_run"] == False):
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                # Перенос в пределах одной файловой системы не копирует файлы
+                os.rename(path, destination)
+            moved += 1
+
+        if (target.sharded == False and options["dry_run"] == False):
+            self.removeEmptyShards(target.basePath)
+
+        self.stdout.write(f"{'would move' if options['dry_run'] else 'moved'} {moved} environments, skipped {skipped}")
+
+    def removeEmptyShards(self, basePath: str) -> None:
+        root = os.path.join(basePath, LocalFileManager.shardsDir)
+        if (os.path.isdir(root) == False):
+            return
+        for shard in os.scandir(root):
+            if (shard.is_dir() and len(os.listdir(shard.path)) == 0):
+                os.rmdir(shard.path)
+        if (len(os.listdir(root)) == 0):
+            os.rmdir(root)
@@ -0,0 +1,42 @@
+from typing import Dict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Environment, StorageUsage, User
+from api.services import FileService
+
+class Command(BaseCommand):
+    help = """Пересчитывает с диска объем и количество файлов окружений и пользователей, например после
+            удаления окружений напрямую из базы данных. Записи во время пересчета могут учитываться неточно"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Вывести расхождения, не исправляя их")
+
+    def handle(self, *args, **options):
+        fileService = FileService()
+        users: Dict[int, list] = {}
+        changed = 0
+
+        for id, user, size, files in Environment.objects.values_list("id", "user_id", "storageBytes", "storageFiles").iterator():
+            stats = fileService.listFilesStat(str(id)) if fileService.exists(str(id)) else []
+            actual = (sum(x["size"] for x in stats), len(stats))
+            total = users.setdefault(user, [0, 0])
+            total[0] += actual[0]
+            total[1] += actual[1]
+            if (actual == (size, files)):
+                continue
+
+            changed += 1
+            if (options["verbosity"] > 1 or options["dry_run"]):
+                self.stdout.write(f"environment {id}: {size} bytes, {files} files -> {actual[0]} bytes, {actual[1]} files")
+            if (options["dry_run"] == False):
+                Environment.objects.filter(id=id).update(storageBytes=actual[0], storageFiles=actual[1])
+
+        if (options["dry_run"] == False):
+            with transaction.atomic():
+                for user in User.objects.values_list("id", flat=True).iterator():
+                    size, files = users.get(user, (0, 0))
+                    StorageUsage.objects.update_or_create(user_id=user, defaults={"bytes": size, "files": files})
+
+        self.stdout.write(f"{'would update' if options['dry_run'] else 'updated'} {changed} environments, {len(users)} users with environments")
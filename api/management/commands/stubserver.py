@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from api.benchmarks import StubServer
+
+class Command(BaseCommand):
+    help = "Запускает локальный OpenAI-совместимый сервер для нагрузочного тестирования без обращения к модели"
+
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8100)
+        parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа в миллисекундах")
+        parser.add_argument("--jitter", type=float, default=0.0, help="Случайная добавка к задержке в миллисекундах")
+        parser.add_argument(
+            "--prompt-tokens", type=int, default=None,
+            help="Количество токенов запроса в usage, по умолчанию оценивается по длине сообщений"
+        )
+        parser.add_argument("--completion-tokens", type=int, default=64, help="Количество токенов ответа")
+        parser.add_argument("--chunks", type=int, default=8, help="Количество частей ответа при stream=true")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов, завершающихся ошибкой")
+        parser.add_argument("--error-status", type=int, default=500, help="Код ответа для ошибочных запросов")
+
+    def handle(self, *args, **options):
+        server = StubServer(
+            (options["host"], options["port"]),
+            latency=options["latency"] / 1000,
+            jitter=options["jitter"] / 1000,
+            promptTokens=options["prompt_tokens"],
+            completionTokens=options["completion_tokens"],
+            chunks=options["chunks"],
+            errorRate=options["error_rate"],
+            errorStatus=options["error_status"],
+        )
+        self.stdout.write(f"Stub server is listening on {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -1,18 +1,76 @@
+import hashlib
+import json
 import os
+import shutil
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
 from typing import Iterator, List, Union, Dict
 from abc import ABC, abstractmethod
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from .connections import FTPConnection
 
 # Create your managers here.
 
-def fileStatFactory(filename: str, size: int, updatedAt: int):
+def fileStatFactory(filename: str, size: int, updatedAt: int, tokens: int = None, revision: str = None):
     return {
         "filename": filename,
         "size": size,
-        "updatedAt": updatedAt
+        "updatedAt": updatedAt,
+        "tokens": tokens,
+        "revision": revision,
     }
 
+class OffsetMismatch(ValueError):
+    """Смещение части загрузки не совпадает с количеством уже полученных байтов"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"expected offset {offset}")
+        self.offset = offset
+
+class ChecksumMismatch(ValueError):
+    """Контрольная сумма загруженного файла не совпадает с переданной клиентом"""
+    pass
+
+class FileMeta():
+    """
+    Метаданные файла, которые обновляются по дописываемым частям без повторного чтения файла: размер,
+    количество символов UTF-8, оценка количества токенов и метка версии. Метка строится цепочкой по записям
+    (метка предыдущей версии и хеш дописанных байтов), поэтому меняется при любом изменении файла, но зависит
+    от истории записей: это не хеш содержимого, и у файлов с одинаковым содержимым метки могут различаться
+    """
+
+    __slots__ = ("size", "chars", "previous", "digest")
+
+    # Байты продолжения многобайтовых символов UTF-8 не считаются отдельными символами
+    continuation = bytes(range(0x80, 0xC0))
+
+    def __init__(self, size: int = 0, chars: int = 0, revision: str = ""):
+        self.size = size
+        self.chars = chars
+        self.previous = bytes.fromhex(revision)
+        self.digest = hashlib.blake2b(digest_size=16)
+
+    def update(self, data: bytes) -> None:
+        self.size += len(data)
+        self.chars += len(data.translate(None, self.continuation))
+        self.digest.update(data)
+
+    def dump(self) -> Dict:
+        return {
+            "size": self.size,
+            "chars": self.chars,
+            # Около 4 символов на токен
+            "tokens": (self.chars + 3) // 4,
+            "revision": hashlib.blake2b(self.previous + self.digest.digest(), digest_size=16).hexdigest(),
+        }
+
 class FileManager(ABC):
     """
     Предоставляет интерфейс для классов файловых менеджеров
@@ -33,11 +91,21 @@ class FileManager(ABC):
         """Выводит список сведений о файлах в директории, указанной в path"""
         pass
     
+    @abstractmethod
+    def listDirs(self) -> Iterator[str]:
+        """Перебирает директории верхнего уровня, например директории окружений"""
+        pass
+
     @abstractmethod
     def exists(self, path: str) -> bool:
         """Проверяет существование директории или файл по пути path"""
         pass
 
+    @abstractmethod
+    def version(self, path: str) -> str:
+        """Возвращает метку, которая меняется при любом изменении файлов в директории path"""
+        pass
+
     @abstractmethod
     def makeDir(self, path: str) -> None:
         """Создает директорию, указанную в path"""
@@ -53,6 +121,21 @@ class FileManager(ABC):
         """Очищает директорию, указанною в path"""
         pass
 
+    @abstractmethod
+    def discardDir(self, path: str) -> None:
+        """Помечает директорию path для удаления. Директория сразу перестает существовать, данные удаляет collectTrash"""
+        pass
+
+    @abstractmethod
+    def collectTrash(self) -> int:
+        """Удаляет директории, помеченные для удаления, и возвращает их количество"""
+        pass
+
+    @abstractmethod
+    def copyDir(self, source: str, destination: str) -> None:
+        """Создает директорию destination с файлами директории source"""
+        pass
+
     @abstractmethod
     def readFile(self, path: str, name: str) -> str: # добавить возможность возврата генератора
         """Читает файл с именем name в директории path"""
@@ -72,32 +155,106 @@ class FileManager(ABC):
         """
         pass
 
+    @abstractmethod
+    def appendFileByChunks(self, path: str, name: str, data: Iterator[bytes]) -> Dict:
+        """
+        Дописывает data по частям в конец файла с именем name в директории path, создавая файл при необходимости.
+        Возвращает метаданные файла после записи
+        """
+        pass
+
+    @abstractmethod
+    def readMeta(self, path: str, name: str) -> Dict:
+        """Возвращает размер, оценку количества токенов и метку версии файла с именем name в директории path"""
+        pass
+
+    @abstractmethod
+    def fileSize(self, path: str, name: str) -> int:
+        """Возвращает размер файла с именем name в директории path в байтах, не читая файл"""
+        pass
+
     @abstractmethod
     def removeFile(self, path: str, name: str) -> None:
         """Удаляет файл с именем name в директории path"""
         pass
 
+    @abstractmethod
+    def createUpload(self, path: str, upload: str, name: str, size: int) -> Dict:
+        """Начинает загрузку файла с именем name размером size байт в директорию path по частям"""
+        pass
+
+    @abstractmethod
+    def readUpload(self, upload: str) -> Dict:
+        """Возвращает директорию, имя, размер и количество полученных байтов загрузки"""
+        pass
+
+    @abstractmethod
+    def writeUpload(self, upload: str, offset: int, data: Iterator[bytes]) -> int:
+        """Записывает часть загрузки, начиная с offset. Возвращает количество полученных байтов"""
+        pass
+
+    @abstractmethod
+    def commitUpload(self, upload: str, checksum: str) -> Dict:
+        """Проверяет контрольную сумму SHA-256 загрузки и заменяет ей файл. Возвращает метаданные файла"""
+        pass
+
+    @abstractmethod
+    def removeUpload(self, upload: str) -> bool:
+        """Удаляет загрузку. Возвращает False, если полученных данных уже нет"""
+        pass
+
+    @abstractmethod
+    def listUploads(self) -> Iterator[Dict]:
+        """Перебирает незавершенные загрузки"""
+        pass
+
 class LocalFileManager(FileManager):
     """
-    Отвечает за хранение файлов локально
+    Отвечает за хранение файлов локально. При `sharded` директории верхнего уровня распределяются по
+    4096 сегментам `shards/<3 символа хеша имени>/`, чтобы в одной директории не оказывалось сотен тысяч записей.
+    Файлы записываются во временный файл и переименовываются, поэтому читатели не видят частично записанных файлов
     """
 
-    def __init__(self, basePath: str = ''):
+    shardsDir = "shards"
+    # Директории, помеченные для удаления, переносятся в корзину и удаляются в фоне
+    trashDir = ".trash"
+    # Временные файлы записи, метаданные и файл блокировки не показываются в списках файлов
+    tempPrefix = ".tmp-"
+    metaPrefix = ".meta-"
+    lockName = ".lock"
+    # Части загрузок записываются прямо в директорию окружения, а сведения о загрузках хранятся в общей директории,
+    # чтобы находить брошенные загрузки без обхода всех окружений
+    uploadPrefix = ".upload-"
+    uploadsDir = ".uploads"
+    # Запрос ioctl для копирования файла без копирования данных (reflink) на Btrfs, XFS и других файловых системах Linux
+    FICLONE = 0x40049409
+
+    def __init__(self, basePath: str = '', sharded: bool = False, fsync: bool = True):
         self.basePath = basePath
+        self.sharded = sharded
+        self.fsync = fsync
         self.__initializeBaseDir()
 
     def __initializeBaseDir(self):
-        if (os.path.exists(self.basePath) == False):
-            currentPath = ''
-            for x in self.basePath.split('/'):
-                currentPath +=x
-                if (os.path.exists(currentPath) == False):
-                    os.mkdir(path=x)
-                currentPath+='/'
+        if (self.basePath):
+            os.makedirs(self.basePath, exist_ok=True)
+
+    def shard(self, name: str) -> str:
+        """Возвращает сегмент директории верхнего уровня `name`"""
+        return f"{zlib.crc32(name.encode('utf-8')) & 0xfff:03x}"
 
     def makePath(self, path: str, name: str = "") -> str:
+        if (self.sharded and path):
+            path = f"{self.shardsDir}/{self.shard(path.partition('/')[0])}/{path}"
         return f'{self.basePath}/{path}{f"/{name}" if name else ""}'
 
+    def isInternal(self, name: str) -> bool:
+        """Проверяет, является ли name служебным файлом менеджера"""
+        return (
+            name == self.lockName or name.startswith(self.tempPrefix) or 
+            name.startswith(self.metaPrefix) or name.startswith(self.uploadPrefix)
+        )
+
     def list(self, path: str) -> List[str]:
         """Выводит список имен в директории, указанной в path"""
 
@@ -107,6 +264,8 @@ class LocalFileManager(FileManager):
         """Выводит список имен файлов в директории, указанной в path"""
         result = []
         for name in self.list(path):
+            if (self.isInternal(name)):
+                continue
             if (os.path.isdir(self.makePath(path, name))): # This means name is dir
                 continue
 
@@ -115,34 +274,84 @@ class LocalFileManager(FileManager):
         return result
 
     def listFilesStat(self, path: str) -> List[Dict]:
-        """Выводит список сведений о файлах в директории, указанной в path"""
+        """
+        Выводит список сведений о файлах в директории, указанной в path. Файлы не читаются: если сохраненных
+        метаданных нет или они устарели, оценка токенов и метка версии равны None до следующей записи в файл
+        """
         result = []
         for name in self.list(path):
+            if (self.isInternal(name)):
+                continue
             fullPath = self.makePath(path, name)
             if (os.path.isdir(fullPath)): # This means name is dir
                 continue
 
             stat = os.stat(fullPath)
+            meta = self.__cachedMeta(path, name, stat) or {}
             result.append(
                 fileStatFactory(
                     name, 
                     stat.st_size, 
-                    int(stat.st_mtime)
+                    int(stat.st_mtime),
+                    meta.get("tokens"),
+                    meta.get("revision"),
                 )
             )
 
         return result
 
+    def listDirs(self) -> Iterator[str]:
+        """Перебирает директории верхнего уровня во всех сегментах"""
+        if (self.sharded == False):
+            for x in os.scandir(self.basePath):
+                if (x.is_dir() and x.name not in (self.shardsDir, self.trashDir, self.uploadsDir)):
+                    yield x.name
+            return
+
+        root = f"{self.basePath}/{self.shardsDir}"
+        if (os.path.isdir(root) == False):
+            return
+        for shard in os.scandir(root):
+            if (shard.is_dir() == False):
+                continue
+            for x in os.scandir(shard.path):
+                if (x.is_dir()):
+                    yield x.name
+
     def exists(self, path: str) -> bool:
         """Проверяет существование директории или файл по пути path"""
         return os.path.exists(self.makePath(path))
 
+    def version(self, path: str) -> str:
+        """Возвращает метку, которая меняется при любом изменении файлов в директории path"""
+        stat = os.stat(self.makePath(path))
+        return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}"
+
+    def touch(self, path: str) -> None:
+        """
+        Увеличивает время изменения директории path. Дозапись в файл не меняет время изменения директории,
+        а его точность может быть ниже времени между двумя изменениями, поэтому время всегда увеличивается явно
+        """
+        fullPath = self.makePath(path)
+        now = max(time.time_ns(), os.stat(fullPath).st_mtime_ns + 1)
+        os.utime(fullPath, ns=(now, now))
+
     def makeDir(self, path: str) -> None:
         """Создает директорию, указанную в path"""
-        os.mkdir(self.makePath(path))
+        fullPath = self.makePath(path)
+        try:
+            os.mkdir(fullPath)
+        except FileNotFoundError:
+            if (self.sharded == False):
+                raise
+            # Сегмент создается при первом окружении в нем
+            os.makedirs(os.path.dirname(fullPath), exist_ok=True)
+            os.mkdir(fullPath)
 
     def removeDir(self, path: str) -> None:
         """Удаляет директорию, указанную в path"""
+        if (os.path.exists(self.makePath(path, self.lockName))):
+            os.remove(self.makePath(path, self.lockName))
         os.rmdir(self.makePath(path))
 
     def clearDir(self, path: str) -> None:
@@ -150,9 +359,71 @@ class LocalFileManager(FileManager):
         for name in self.list(path):
             fullPath = self.makePath(path, name)
             if (os.path.isdir(fullPath)):
-                self.removeDir()
+                self.removeDir(f"{path}/{name}")
+            elif (name == self.lockName):
+                # Файл блокировки может использоваться другими записями
+                continue
+            elif (self.isInternal(name)):
+                # Метаданные могли быть удалены вместе со своим файлом
+                if (os.path.exists(fullPath)):
+                    os.remove(fullPath)
             else:
-                self.removeFile(fullPath)
+                self.removeFile(path, name)
+
+    def discardDir(self, path: str) -> None:
+        """
+        Переносит директорию path в корзину. Перенос в пределах одной файловой системы не зависит
+        от количества файлов, поэтому может выполняться при обработке запроса
+        """
+        trash = f"{self.basePath}/{self.trashDir}"
+        os.makedirs(trash, exist_ok=True)
+        os.rename(self.makePath(path), f"{trash}/{path.replace('/', '-')}-{uuid.uuid4().hex}")
+
+    def collectTrash(self) -> int:
+        """Удаляет директории из корзины. Директории, которые не удалось удалить, остаются до следующего вызова"""
+        trash = f"{self.basePath}/{self.trashDir}"
+        if (os.path.isdir(trash) == False):
+            return 0
+
+        count = 0
+        for x in os.scandir(trash):
+            try:
+                shutil.rmtree(x.path)
+                count += 1
+            except OSError:
+                continue
+        return count
+
+    def copyDir(self, source: str, destination: str) -> None:
+        """
+        Создает директорию destination с файлами директории source. Файлы не копируются, а связываются
+        жесткими ссылками: запись через временный файл создает новый файл, а перед дописыванием файл
+        с несколькими ссылками копируется. Если ссылку создать нельзя, файл копируется через reflink или полностью
+        """
+        self.makeDir(destination)
+        for name in self.list(source):
+            # Незавершенные загрузки дописываются на месте, поэтому не связываются с копией
+            if (name == self.lockName or name.startswith(self.tempPrefix) or name.startswith(self.uploadPrefix)):
+                continue
+            fullPath = self.makePath(source, name)
+            if (os.path.isdir(fullPath)):
+                continue
+            try:
+                os.link(fullPath, self.makePath(destination, name))
+            except OSError:
+                self.__copy(fullPath, self.makePath(destination, name))
+        self.touch(destination)
+
+    def __copy(self, source: str, destination: str) -> None:
+        """Копирует файл через reflink, если файловая система это поддерживает, иначе копирует данные"""
+        if (fcntl is not None):
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+                    return
+                except OSError:
+                    pass
+        shutil.copyfile(source, destination)
 
     def readFile(self, path: str, name: str) -> str:
         """Читает файл с именем name в директории path"""
@@ -163,20 +434,259 @@ class LocalFileManager(FileManager):
         """
         Создает файл с именем name в директории path и записывает в него data целиком
         """
-        with open(self.makePath(path, name), "wb+") as file:
-            file.write(data)
+        self.__write(path, name, [data.encode("utf-8") if isinstance(data, str) else data])
 
     def saveFileByChunks(self, path: str, name: str, data: Iterator[bytes]) -> None:
         """
         Создает файл с именем name в директории path и записывает в него data по частям
         """
-        with open(self.makePath(path, name), "wb+") as file:
-            for x in data:
-                file.write(x)
+        self.__write(path, name, data)
+
+    def appendFileByChunks(self, path: str, name: str, data: Iterator[bytes]) -> Dict:
+        """
+        Дописывает data по частям в конец файла с именем name в директории path, создавая файл при необходимости.
+        Записываются только новые байты, метаданные обновляются по ним же. Одновременные записи в окружение
+        выполняются по очереди
+        """
+        with self.__lock(path):
+            fullPath = self.makePath(path, name)
+            previous = (self.__cachedMeta(path, name) or self.__computeMeta(path, name)) if os.path.exists(fullPath) else None
+            meta = FileMeta(**{k: previous[k] for k in ("size", "chars", "revision")}) if previous else FileMeta()
+            if (previous and os.stat(fullPath).st_nlink > 1):
+                # Файл связан с копией окружения, поэтому дописывается в собственную копию файла
+                temp = self.makePath(path, f"{self.tempPrefix}{uuid.uuid4().hex}")
+                self.__copy(fullPath, temp)
+                os.replace(temp, fullPath)
+            with open(fullPath, "ab") as file:
+                for x in data:
+                    file.write(x)
+                    meta.update(x)
+                if (self.fsync):
+                    file.flush()
+                    os.fsync(file.fileno())
+            result = self.__writeMeta(path, name, meta)
+        self.touch(path)
+        return result
+
+    def readMeta(self, path: str, name: str, stat: os.stat_result = None) -> Dict:
+        """
+        Возвращает размер, оценку количества токенов и метку версии файла с именем name в директории path.
+        Если метаданных нет или они не соответствуют файлу, они вычисляются по содержимому файла
+        """
+        meta = self.__cachedMeta(path, name, stat)
+        if (meta is not None):
+            return meta
+        with self.__lock(path):
+            return self.__computeMeta(path, name)
+
+    def fileSize(self, path: str, name: str) -> int:
+        """Возвращает размер файла с именем name в директории path в байтах, не читая файл"""
+        return os.stat(self.makePath(path, name)).st_size
+
+    def __cachedMeta(self, path: str, name: str, stat: os.stat_result = None) -> Dict | None:
+        stat = stat or os.stat(self.makePath(path, name))
+        try:
+            with open(self.makePath(path, f"{self.metaPrefix}{name}"), "r", encoding="utf-8") as file:
+                meta = json.load(file)
+            # Метаданные без метки версии записаны прежним форматом и вычисляются заново
+            if (meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime_ns and "revision" in meta):
+                return meta
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def __computeMeta(self, path: str, name: str) -> Dict:
+        """Вычисляет метаданные по содержимому файла, вызывается под блокировкой"""
+        meta = FileMeta()
+        with open(self.makePath(path, name), "rb") as file:
+            for x in iter(lambda: file.read(65536), b""):
+                meta.update(x)
+        return self.__writeMeta(path, name, meta)
+
+    def __writeMeta(self, path: str, name: str, meta: FileMeta) -> Dict:
+        # Метаданные можно вычислить заново, поэтому они не синхронизируются с диском
+        result = meta.dump()
+        result["mtime"] = os.stat(self.makePath(path, name)).st_mtime_ns
+        temp = self.makePath(path, f"{self.tempPrefix}{uuid.uuid4().hex}")
+        with open(temp, "x", encoding="utf-8") as file:
+            json.dump(result, file)
+        os.replace(temp, self.makePath(path, f"{self.metaPrefix}{name}"))
+        return result
+
+    @contextmanager
+    def __lock(self, path: str) -> Iterator[None]:
+        """Блокирует запись в директорию path, в том числе для других процессов"""
+        with open(self.makePath(path, self.lockName), "a") as file:
+            if (fcntl is not None):
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if (fcntl is not None):
+                    fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    def __write(self, path: str, name: str, data: Iterator[bytes]) -> None:
+        """Записывает data во временный файл и заменяет им файл name, чтобы файл не был виден частично записанным"""
+        temp = self.makePath(path, f"{self.tempPrefix}{uuid.uuid4().hex}")
+        meta = FileMeta()
+        try:
+            with open(temp, "xb") as file:
+                for x in data:
+                    file.write(x)
+                    meta.update(x)
+                if (self.fsync):
+                    file.flush()
+                    os.fsync(file.fileno())
+            with self.__lock(path):
+                os.replace(temp, self.makePath(path, name))
+                self.__writeMeta(path, name, meta)
+        except BaseException:
+            if (os.path.exists(temp)):
+                os.remove(temp)
+            raise
+
+        if (self.fsync):
+            self.__syncDir(path)
+        self.touch(path)
+
+    def __syncDir(self, path: str) -> None:
+        # Переименование сохраняется на диске только после синхронизации директории
+        if (hasattr(os, "O_DIRECTORY") == False):
+            return
+        fd = os.open(self.makePath(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
     def removeFile(self, path: str, name: str) -> None:
         """Удаляет файл с именем name в директории path"""
-        os.remove(self.makePath(path, name))
+        with self.__lock(path):
+            os.remove(self.makePath(path, name))
+            if (os.path.exists(self.makePath(path, f"{self.metaPrefix}{name}"))):
+                os.remove(self.makePath(path, f"{self.metaPrefix}{name}"))
+        self.touch(path)
+
+    def createUpload(self, path: str, upload: str, name: str, size: int) -> Dict:
+        """Создает пустой файл загрузки в директории path и сведения о ней"""
+        os.makedirs(f"{self.basePath}/{self.uploadsDir}", exist_ok=True)
+        open(self.makePath(path, f"{self.uploadPrefix}{upload}"), "xb").close()
+        state = {"upload": upload, "path": path, "name": name, "size": size}
+        with open(self.__uploadState(upload), "x", encoding="utf-8") as file:
+            json.dump(state, file)
+        return {**state, "offset": 0}
+
+    def readUpload(self, upload: str) -> Dict:
+        """
+        Возвращает сведения о загрузке с количеством полученных байтов `offset` и временем последней записи
+        `updatedAt`. Если директория окружения удалена вместе с файлом загрузки, выбрасывает FileNotFoundError
+        """
+        statePath = self.__uploadState(upload)
+        with open(statePath, "r", encoding="utf-8") as file:
+            state = json.load(file)
+        stat = os.stat(self.makePath(state["path"], f"{self.uploadPrefix}{upload}"))
+        return {**state, "offset": stat.st_size, "updatedAt": max(stat.st_mtime, os.stat(statePath).st_mtime)}
+
+    def writeUpload(self, upload: str, offset: int, data: Iterator[bytes]) -> int:
+        """
+        Дописывает data в файл загрузки. Часть принимается, только если offset равен количеству полученных байтов,
+        поэтому повторно отправленная часть не записывается дважды. Одновременные записи одной загрузки
+        выполняются по очереди
+        """
+        state = self.readUpload(upload)
+        with open(self.makePath(state["path"], f"{self.uploadPrefix}{upload}"), "r+b") as file:
+            with self.__flock(file):
+                current = os.fstat(file.fileno()).st_size
+                if (current != offset):
+                    raise OffsetMismatch(current)
+                file.seek(offset)
+                try:
+                    for x in data:
+                        if (file.tell() + len(x) > state["size"]):
+                            raise ValueError(f"upload exceeds declared size of {state['size']} bytes")
+                        file.write(x)
+                except BaseException:
+                    # Часть записывается целиком или не записывается
+                    file.truncate(offset)
+                    raise
+                if (self.fsync):
+                    file.flush()
+                    os.fsync(file.fileno())
+                return file.tell()
+
+    def commitUpload(self, upload: str, checksum: str) -> Dict:
+        """
+        Проверяет, что получены все байты и их SHA-256 равен checksum, и заменяет файлом загрузки файл в окружении.
+        Метаданные файла вычисляются при том же чтении. Если сумма не совпадает, выбрасывает ChecksumMismatch
+        """
+        state = self.readUpload(upload)
+        path, name = state["path"], state["name"]
+        partPath = self.makePath(path, f"{self.uploadPrefix}{upload}")
+        with open(partPath, "rb") as file:
+            with self.__flock(file):
+                if (os.fstat(file.fileno()).st_size != state["size"]):
+                    raise OffsetMismatch(os.fstat(file.fileno()).st_size)
+                meta = FileMeta()
+                digest = hashlib.sha256()
+                for x in iter(lambda: file.read(65536), b""):
+                    meta.update(x)
+                    digest.update(x)
+                if (digest.hexdigest() != checksum.lower()):
+                    raise ChecksumMismatch(f"checksum mismatch: received data has sha256 {digest.hexdigest()}")
+
+                with self.__lock(path):
+                    os.replace(partPath, self.makePath(path, name))
+                    result = self.__writeMeta(path, name, meta)
+        os.remove(self.__uploadState(upload))
+
+        if (self.fsync):
+            self.__syncDir(path)
+        self.touch(path)
+        return result
+
+    def removeUpload(self, upload: str) -> bool:
+        """Удаляет файл и сведения о загрузке"""
+        statePath = self.__uploadState(upload)
+        with open(statePath, "r", encoding="utf-8") as file:
+            state = json.load(file)
+        removed = True
+        try:
+            os.remove(self.makePath(state["path"], f"{self.uploadPrefix}{upload}"))
+        except FileNotFoundError:
+            removed = False
+        os.remove(statePath)
+        return removed
+
+    def listUploads(self) -> Iterator[Dict]:
+        """Перебирает незавершенные загрузки. Загрузки удаленных окружений возвращаются без `offset`"""
+        root = f"{self.basePath}/{self.uploadsDir}"
+        if (os.path.isdir(root) == False):
+            return
+        for x in os.scandir(root):
+            upload = x.name.removesuffix(".json")
+            try:
+                yield self.readUpload(upload)
+            except FileNotFoundError:
+                try:
+                    yield {"upload": upload, "updatedAt": x.stat().st_mtime}
+                except FileNotFoundError:
+                    continue
+            except ValueError:
+                # Сведения еще записываются
+                continue
+
+    def __uploadState(self, upload: str) -> str:
+        return f"{self.basePath}/{self.uploadsDir}/{upload}.json"
+
+    @contextmanager
+    def __flock(self, file) -> Iterator[None]:
+        if (fcntl is not None):
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if (fcntl is not None):
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
 
 class RemoteFileManager(FileManager):
     """
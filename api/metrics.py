@@ -0,0 +1,94 @@
+import os
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+# Create your metrics here.
+
+REQUEST_LATENCY = Histogram(
+    "api_request_duration_seconds",
+    "Время обработки запроса по действию",
+    ["view", "action", "status"],
+)
+REQUEST_QUERIES = Histogram(
+    "api_request_db_queries",
+    "Количество запросов к базе данных за один запрос к API",
+    ["view", "action"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+MODEL_LATENCY = Histogram(
+    "model_request_duration_seconds",
+    "Время ответа модели",
+    ["operation"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60),
+)
+MODEL_TTFT = Histogram(
+    "model_time_to_first_token_seconds",
+    "Время до получения первого токена ответа модели",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+MODEL_TOKENS = Counter(
+    "model_tokens",
+    "Количество токенов, использованных моделью. Использование по пользователям и окружениям хранится в TokenUsage",
+    ["kind"],
+)
+FILES_READ_BYTES = Histogram(
+    "files_context_read_bytes",
+    "Объем файлов окружения, прочитанных при загрузке в контекст модели",
+    buckets=(1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26, 1 << 29),
+)
+
+FILES_CONTEXT_PREBUILT = Counter(
+    "files_context_prebuilt",
+    "Использование контекста файлов, собранного в фоне: hit - контекст актуален, miss - файлы читаются заново",
+    ["result"],
+)
+
+FILES_CONTEXT_DEDUP_SAVED = Counter(
+    "files_context_dedup_saved_tokens",
+    "Оценка токенов, сэкономленных при загрузке файлов в контекст заменой повторяющихся фрагментов ссылками",
+)
+
+@dataclass
+class RequestMetrics():
+    """Метрики, собираемые в рамках одного запроса к API"""
+    queries: int = 0
+
+    def countQuery(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+currentRequest: ContextVar[RequestMetrics | None] = ContextVar("currentRequest", default=None)
+
+def recordTokens(usage) -> None:
+    """Учитывает токены из `usage` ответа модели"""
+    if (usage is None):
+        return
+
+    kinds = {
+        "prompt": usage.prompt_tokens,
+        "completion": usage.completion_tokens,
+    }
+    details = getattr(usage, "prompt_tokens_details", None)
+    if (details is not None and getattr(details, "cached_tokens", None)):
+        kinds["cached"] = details.cached_tokens
+
+    for kind, count in kinds.items():
+        MODEL_TOKENS.labels(kind=kind).inc(count)
+
+def exposition() -> bytes:
+    """Возвращает метрики в текстовом формате Prometheus"""
+    if ("PROMETHEUS_MULTIPROC_DIR" in os.environ):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
@@ -0,0 +1,203 @@
+import gzip
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .logs import requestId
+from .metrics import (
+    REQUEST_LATENCY,
+    REQUEST_QUERIES,
+    RequestMetrics,
+    currentRequest,
+)
+from .profiling import Profiler, currentProfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Create your middleware here.
+
+def actionName(request: HttpRequest, view_func) -> tuple:
+    """
+    Возвращает имя представления и действия, например ("environment", "load-file") или ("environment", "retrieve").
+    Используются url_path действий и имена методов, а не пути запросов, чтобы количество меток оставалось ограниченным
+    """
+    actions = getattr(view_func, "actions", None)
+    if (actions is None):
+        name = getattr(view_func, "view_class", view_func).__name__
+        return (name, request.resolver_match.url_name or request.method.lower())
+
+    handler = actions.get(request.method.lower(), request.method.lower())
+    name = getattr(getattr(view_func.cls, handler, None), "url_path", handler)
+    return (view_func.initkwargs.get("basename") or view_func.cls.__name__, name)
+
+class MetricsMiddleware:
+    """
+    Собирает время обработки и количество запросов к базе данных для каждого запроса к API
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        scope = RequestMetrics()
+        token = currentRequest.set(scope)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(scope.countQuery):
+                response = self.get_response(request)
+        finally:
+            currentRequest.reset(token)
+        elapsed = time.perf_counter() - start
+
+        view, action = getattr(request, "metricsAction", ("", "unmatched"))
+        REQUEST_LATENCY.labels(view=view, action=action, status=f"{response.status_code // 100}xx").observe(elapsed)
+        REQUEST_QUERIES.labels(view=view, action=action).observe(scope.queries)
+
+        return response
+
+    def process_view(self, request: HttpRequest, view_func, view_args, view_kwargs):
+        request.metricsAction = actionName(request, view_func)
+        return None
+
+class RequestIdMiddleware:
+    """
+    Присваивает запросу идентификатор для связывания записей журнала. Идентификатор берется из заголовка
+    X-Request-ID, если он корректен, и возвращается в том же заголовке ответа
+    """
+
+    header = "X-Request-ID"
+    pattern = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        value = request.headers.get(self.header, "")
+        if (self.pattern.match(value) is None):
+            value = uuid.uuid4().hex
+
+        token = requestId.set(value)
+        try:
+            response = self.get_response(request)
+        finally:
+            requestId.reset(token)
+
+        response[self.header] = value
+        return response
+
+class ProfilingMiddleware:
+    """
+    Профилирует запросы, выбранные случайно с долей PROFILING_SAMPLE_RATE или по заголовку X-Profile
+    с секретом PROFILING_TOKEN, и сохраняет профили медленных запросов. Если PROFILING_ENABLED не задан,
+    middleware отключается при запуске
+    """
+
+    header = "X-Profile"
+
+    def __init__(self, get_response):
+        if (settings.PROFILING_ENABLED == False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.profiler = Profiler()
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        forced = self.profiler.isForced(request.headers.get(self.header, ""))
+        if (forced == False and self.profiler.isSampled() == False):
+            return self.get_response(request)
+
+        started = self.profiler.start(request.method, request.path, forced)
+        if (started is None):
+            # Другой запрос уже профилируется, этот обрабатывается без профиля
+            return self.get_response(request)
+
+        profile, profiler = started
+        token = currentProfile.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            currentProfile.reset(token)
+            self.profiler.finish(profile, profiler)
+
+        profile.view, profile.action = getattr(request, "metricsAction", ("", "unmatched"))
+        profile.status = response.status_code
+        if (forced):
+            response[self.header] = profile.id
+        return response
+
+    def process_view(self, request: HttpRequest, view_func, view_args, view_kwargs):
+        if (hasattr(request, "metricsAction") == False):
+            request.metricsAction = actionName(request, view_func)
+        return None
+
+def acceptedEncodings(header: str) -> dict:
+    """Разбирает заголовок Accept-Encoding в словарь кодировок и их весов"""
+    result = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if (name == ""):
+            continue
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if (key == "q"):
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        result[name.lower()] = weight
+    return result
+
+class CompressionMiddleware:
+    """
+    Сжимает ответы размером от COMPRESSION_MIN_SIZE байт алгоритмом brotli или gzip в зависимости от
+    заголовка Accept-Encoding. Потоковые ответы не сжимаются, чтобы не задерживать отправку частей
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        response = self.get_response(request)
+        if (response.streaming or response.has_header("Content-Encoding")):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if (len(response.content) < settings.COMPRESSION_MIN_SIZE):
+            return response
+
+        encoding = self.negotiate(request.headers.get("Accept-Encoding", ""))
+        if (encoding is None):
+            return response
+
+        if (encoding == "br"):
+            content = brotli.compress(response.content, quality=settings.COMPRESSION_BROTLI_QUALITY)
+        else:
+            content = gzip.compress(response.content, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0)
+        if (len(content) >= len(response.content)):
+            return response
+
+        response.content = content
+        response["Content-Length"] = str(len(content))
+        response["Content-Encoding"] = encoding
+        # Сжатое тело отличается от исходного побайтно, поэтому строгий ETag становится слабым
+        etag = response.get("ETag", "")
+        if (etag.startswith('"')):
+            response["ETag"] = f"W/{etag}"
+        return response
+
+    def negotiate(self, header: str) -> str | None:
+        accepted = acceptedEncodings(header)
+        for encoding in self.encodings:
+            if (accepted.get(encoding, accepted.get("*", 0.0)) > 0):
+                return encoding
+        return None
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.3 on 2026-10-19 14:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('promptTokens', models.BigIntegerField(default=0)),
+                ('completionTokens', models.BigIntegerField(default=0)),
+                ('cachedTokens', models.BigIntegerField(default=0)),
+                ('requests', models.IntegerField(default=0)),
+                ('environment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='api.environment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'date'], name='api_tokenus_user_id_0f329b_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'environment', 'date'), name='unique_token_usage')],
+            },
+        ),
+    ]
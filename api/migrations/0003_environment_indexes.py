@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-19 14:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_tokenusage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='environment',
+            index=models.Index(fields=['user', '-editedAt', '-id'], name='api_environ_user_id_23c0bc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='environment',
+            index=models.Index(fields=['-editedAt', '-id'], name='api_environ_editedA_f26aab_idx'),
+        ),
+    ]
@@ -9,4 +9,40 @@ class Environment(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     
     createdAt = models.DateTimeField(auto_now_add=True)
-    editedAt = models.DateTimeField(auto_now=True)
\ No newline at end of file
+    editedAt = models.DateTimeField(auto_now=True)
+
+    # Объем и количество файлов окружения, изменяются FileService при каждой записи и удалении
+    storageBytes = models.BigIntegerField(default=0)
+    storageFiles = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Списки окружений пользователя и всех окружений по времени изменения
+            models.Index(fields=["user", "-editedAt", "-id"]),
+            models.Index(fields=["-editedAt", "-id"]),
+        ]
+
+class StorageUsage(models.Model):
+    """Объем и количество файлов во всех окружениях пользователя"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+
+    bytes = models.BigIntegerField(default=0)
+    files = models.IntegerField(default=0)
+
+class TokenUsage(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    environment = models.ForeignKey(Environment, on_delete=models.SET_NULL, blank=True, null=True)
+    date = models.DateField()
+
+    promptTokens = models.BigIntegerField(default=0)
+    completionTokens = models.BigIntegerField(default=0)
+    cachedTokens = models.BigIntegerField(default=0)
+    requests = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "environment", "date"], name="unique_token_usage"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "date"]),
+        ]
@@ -0,0 +1,22 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+# Create your paginations here.
+
+class KeysetPagination(CursorPagination):
+    """
+    Постраничный вывод по курсору. Страница выбирается условием по индексированному полю сортировки,
+    а не смещением, поэтому время получения страницы не зависит от ее номера и размера таблицы
+    """
+    page_size_query_param = "limit"
+
+    def __init__(self):
+        self.page_size = settings.PAGE_SIZE
+        self.max_page_size = settings.MAX_PAGE_SIZE
+
+class EnvironmentPagination(KeysetPagination):
+    # id разделяет окружения с одинаковым временем изменения
+    ordering = ("-editedAt", "-id")
+
+class UserPagination(KeysetPagination):
+    ordering = ("id",)
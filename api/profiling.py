@@ -0,0 +1,125 @@
+import marshal
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from cProfile import Profile as CProfile
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List
+
+from django.conf import settings
+
+from .base import once, Singleton
+
+# Create your profiling helpers here.
+
+@dataclass
+class Profile():
+    """Профиль одного запроса: интервалы обработки и статистика cProfile"""
+    id: str
+    method: str
+    path: str
+    start: float
+    createdAt: float = field(default_factory=time.time)
+    view: str = ""
+    action: str = ""
+    status: int = 0
+    duration: float = 0.0
+    forced: bool = False
+    spans: List[Dict] = field(default_factory=list)
+    stats: bytes = b""
+
+    def summary(self) -> Dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "view": self.view,
+            "action": self.action,
+            "status": self.status,
+            "duration": round(self.duration * 1000, 3),
+            "createdAt": int(self.createdAt),
+            "spans": self.spans,
+        }
+
+currentProfile: ContextVar[Profile | None] = ContextVar("currentProfile", default=None)
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Учитывает время выполнения блока в профиле текущего запроса, если запрос профилируется"""
+    profile = currentProfile.get()
+    if (profile is None):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.spans.append({
+            "name": name,
+            "start": round((start - profile.start) * 1000, 3),
+            "duration": round((time.perf_counter() - start) * 1000, 3),
+        })
+
+class Profiler(Singleton):
+    """
+    Выбирает запросы для профилирования и хранит профили последних медленных запросов
+    """
+
+    @once
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles: deque[Profile] = deque(maxlen=settings.PROFILING_KEEP)
+        self.sampleRate: float = settings.PROFILING_SAMPLE_RATE
+        self.slow: float = settings.PROFILING_SLOW_MS / 1000
+
+    def isForced(self, token: str) -> bool:
+        """Проверяет, запрошено ли профилирование заголовком с секретом PROFILING_TOKEN"""
+        return bool(settings.PROFILING_TOKEN) and token == settings.PROFILING_TOKEN
+
+    def isSampled(self) -> bool:
+        return self.sampleRate > 0 and random.random() < self.sampleRate
+
+    def start(self, method: str, path: str, forced: bool) -> tuple[Profile, CProfile] | None:
+        """
+        Начинает профилирование запроса. Возвращает None, если профилирование уже идет: начиная с Python 3.12
+        cProfile использует sys.monitoring, и одновременно в процессе может быть активен только один профиль
+        """
+        profile = Profile(id=uuid.uuid4().hex, method=method, path=path, start=time.perf_counter(), forced=forced)
+        profiler = CProfile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return None
+        return profile, profiler
+
+    def finish(self, profile: Profile, profiler: CProfile) -> None:
+        profiler.disable()
+        profile.duration = time.perf_counter() - profile.start
+        if (profile.forced == False and profile.duration < self.slow):
+            return
+
+        stats = pstats.Stats(profiler)
+        profile.stats = marshal.dumps(stats.stats)
+        with self.lock:
+            self.profiles.append(profile)
+
+    def list(self) -> List[Profile]:
+        with self.lock:
+            return list(reversed(self.profiles))
+
+    def get(self, id: str) -> Profile | None:
+        with self.lock:
+            return next((x for x in self.profiles if x.id == id), None)
+
+    def configure(self, sampleRate: float = None, slow: float = None) -> None:
+        """Изменяет долю профилируемых запросов и порог медленного запроса в секундах во время работы"""
+        if (sampleRate is not None):
+            self.sampleRate = sampleRate
+        if (slow is not None):
+            self.slow = slow
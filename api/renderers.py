@@ -0,0 +1,36 @@
+from typing import Any
+
+import orjson
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse
+from rest_framework.renderers import JSONRenderer
+
+# Create your renderers here.
+
+ENCODER = DjangoJSONEncoder()
+OPTIONS = orjson.OPT_NON_STR_KEYS
+
+def dumps(data: Any) -> bytes:
+    """Сериализует `data` в JSON с помощью orjson. Типы, которые orjson не поддерживает, передаются DjangoJSONEncoder"""
+    return orjson.dumps(data, default=ENCODER.default, option=OPTIONS)
+
+class FastJsonResponse(JsonResponse):
+    """
+    JsonResponse, сериализующий данные с помощью orjson
+    """
+
+    def __init__(self, data: Any, safe: bool = True, **kwargs):
+        if (safe and not isinstance(data, dict)):
+            raise TypeError("In order to allow non-dict objects to be serialized set the safe parameter to False.")
+        kwargs.setdefault("content_type", "application/json")
+        HttpResponse.__init__(self, content=dumps(data), **kwargs)
+
+class OrjsonRenderer(JSONRenderer):
+    """
+    JSON-рендерер DRF на основе orjson
+    """
+
+    def render(self, data: Any, accepted_media_type: str = None, renderer_context: dict = None) -> bytes:
+        if (data is None):
+            return b""
+        return dumps(data)
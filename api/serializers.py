@@ -25,11 +25,19 @@ class LoginSerializer(serializers.ModelSerializer):
 class EnvironmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Environment
-        fields = ['id', 'name', 'description', 'user', 'createdAt', 'editedAt']
+        fields = ['id', 'name', 'description', 'user', 'createdAt', 'editedAt', 'storageBytes', 'storageFiles']
         extra_kwargs = {
-            'id': {'read_only': True}
+            'id': {'read_only': True},
+            'storageBytes': {'read_only': True},
+            'storageFiles': {'read_only': True},
         }
 
+class CloneSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=48, required=False)
+    description = serializers.CharField(max_length=256, required=False, allow_blank=True, allow_null=True)
+    fork = serializers.BooleanField(default=False)
+    index = serializers.IntegerField(min_value=0, required=False, allow_null=True)
+
 class FileSerializer(serializers.Serializer):
     # filename = serializers.CharField(max_length=50)
     file = serializers.FileField()
@@ -37,8 +45,40 @@ class FileSerializer(serializers.Serializer):
 class FileNameSerializer(serializers.Serializer):
     filename = serializers.CharField(max_length=50, allow_blank=False, allow_null=False)
 
+class UploadSerializer(serializers.Serializer):
+    filename = serializers.CharField(max_length=50, allow_blank=False, allow_null=False)
+    size = serializers.IntegerField(min_value=0)
+
+    def validate_filename(self, value: str) -> str:
+        # Имя используется как имя файла в директории окружения, служебные файлы начинаются с точки
+        if ("/" in value or "\\" in value or value.startswith(".")):
+            raise serializers.ValidationError("filename must not contain path separators or start with a dot")
+        return value
+
+class UploadChunkSerializer(serializers.Serializer):
+    offset = serializers.IntegerField(min_value=0)
+
+class CommitUploadSerializer(serializers.Serializer):
+    checksum = serializers.RegexField(r"^[0-9a-fA-F]{64}$", help_text="SHA-256 всего файла в шестнадцатеричном виде")
+
 class PromptSerializer(serializers.Serializer):
     prompt = serializers.CharField(min_length=1, max_length=512)
 
 class GeneratePromptSerializer(serializers.Serializer):
-    prompt = serializers.CharField(min_length=1, max_length=512, allow_null=True)
\ No newline at end of file
+    prompt = serializers.CharField(min_length=1, max_length=512, allow_null=True)
+
+class BatchItemSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    prompt = serializers.CharField(min_length=1, max_length=512, allow_null=True, required=False)
+
+class GenerateBatchSerializer(serializers.Serializer):
+    items = BatchItemSerializer(many=True, allow_empty=False)
+
+class FixPromptSerializer(serializers.Serializer):
+    fragment = serializers.CharField(min_length=1)
+    index = serializers.IntegerField(min_value=0, required=False, allow_null=True)
+    prompt = serializers.CharField(max_length=512, required=False, allow_blank=True)
+
+class ProfilingSerializer(serializers.Serializer):
+    sampleRate = serializers.FloatField(min_value=0, max_value=1, required=False)
+    slowMs = serializers.FloatField(min_value=0, required=False)
@@ -1,15 +1,39 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.db.models import F, Sum
 from django.http import JsonResponse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.request import HttpRequest
 
-from dataclasses import dataclass
+import atexit
+import logging
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 
-from typing import Dict, List, Iterator, overload, Union
+from typing import Callable, Dict, List, Iterator, overload, Union
 
 from .base import once, Singleton
-from .managers import FileManager, LocalFileManager, RemoteFileManager
+from .chats import FileBlock, Message
+from .dedup import deduplicate
+from .managers import ChecksumMismatch, FileManager, LocalFileManager, OffsetMismatch, RemoteFileManager
 from .connections import GPTConnection
+from .logs import sampled, truncate
+from .models import Environment, StorageUsage, TokenUsage
+from .metrics import FILES_CONTEXT_DEDUP_SAVED, FILES_CONTEXT_PREBUILT, FILES_READ_BYTES, MODEL_LATENCY, MODEL_TTFT, recordTokens
+from .profiling import span
+from .renderers import FastJsonResponse
+from .workers import BackgroundWorker
+
+logger = logging.getLogger(__name__)
 
 # Create your services here.
 
@@ -28,7 +52,7 @@ class FileService(Service):
 
     @once
     def __init__(self):
-        self.fileManager = LocalFileManager(basePath="environments")
+        self.fileManager = LocalFileManager(basePath="environments", sharded=settings.FILES_SHARDED, fsync=settings.FILES_FSYNC)
 
     def exists(self, path: str, filename: str = '') -> bool:
         return self.fileManager.exists(f"{path}/{filename}")
@@ -43,6 +67,11 @@ class FileService(Service):
 
         return self.fileManager.listFilesStat(path=path)
     
+    def version(self, path: str) -> str:
+        """Возвращает метку версии файлов директории"""
+
+        return self.fileManager.version(path)
+
     def readFile(self, path: str, filename: str) -> str:
         """Возвращает содержимое файла с именем `filename`"""
         if (self.exists(path, filename) == False):
@@ -51,34 +80,188 @@ class FileService(Service):
 
     def removeFile(self, path: str, filename: str) -> str:
         """Удаляет файл с именем `filename`"""
-        if (self.exists(path, filename) == False):
+        size = self.__sizeOf(path, filename)
+        if (size is None):
             raise FileNotFoundError(f"file with name: {filename} not found")
-        return self.fileManager.removeFile(path, filename) 
+        result = self.fileManager.removeFile(path, filename)
+        self.account(path, -size, -1, check=False)
+        return result
 
     def replaceFile(self, path: str, file: Union[UploadedFile, str], filename: str, returning=False) -> None | Union[Iterator[bytes], str]:
         """Заменяет файл с именем `filename` файлом, представленным как `UploadedFile` или `str`"""
-        if (self.fileManager.exists(f"{path}/{file.name}")):
-            self.fileManager.removeFile(f"{path}/{file.name}")
-        
+        # Запись через временный файл заменяет существующий файл, удалять его заранее не нужно
         return self.saveFile(path, file, filename, returning)
 
     def saveFile(self, path: str, file: Union[UploadedFile, str], filename: str, returning=False) -> None | Union[Iterator[bytes], str]:
-        """Сохраняет файл, представленный как `UploadedFile` или `str`, с именем `filename`"""
-        if isinstance(file, str):
-            return self.fileManager.saveFile(
-                path=path,
-                name=filename,
-                data=file
-            )
-        elif isinstance(file, UploadedFile):
-            return self.fileManager.saveFileByChunks(
-                path=path,
-                name=filename,
-                data=file.chunks()
-            )
+        """
+        Сохраняет файл, представленный как `UploadedFile` или `str`, с именем `filename`.
+        Квоты хранилища проверяются до записи
+        """
+        previous = self.__sizeOf(path, filename)
+        size = self.__lengthOf(file) - (previous or 0)
+        files = int(previous is None)
+        self.account(path, size, files)
+        try:
+            if isinstance(file, str):
+                return self.fileManager.saveFile(
+                    path=path,
+                    name=filename,
+                    data=file
+                )
+            elif isinstance(file, UploadedFile):
+                return self.fileManager.saveFileByChunks(
+                    path=path,
+                    name=filename,
+                    data=file.chunks()
+                )
+        except BaseException:
+            self.account(path, -size, -files, check=False)
+            raise
         if (returning):
             return file
         return None
+
+    def appendFile(self, path: str, file: Union[UploadedFile, str], filename: str) -> Dict:
+        """Дописывает в конец файла с именем `filename` файл, представленный как `UploadedFile` или `str`"""
+        if isinstance(file, str):
+            data = iter((file.encode("utf-8"),))
+        else:
+            data = file.chunks()
+        size = self.__lengthOf(file)
+        files = int(self.exists(path, filename) == False)
+        self.account(path, size, files)
+        try:
+            meta = self.fileManager.appendFileByChunks(path=path, name=filename, data=data)
+        except BaseException:
+            self.account(path, -size, -files, check=False)
+            raise
+        return {"size": meta["size"], "tokens": meta["tokens"], "revision": meta["revision"]}
+
+    def createUpload(self, path: str, filename: str, size: int) -> Dict:
+        """Начинает загрузку файла по частям. Весь размер файла учитывается в квотах до записи первой части"""
+        self.account(path, size, 1)
+        try:
+            return self.fileManager.createUpload(path, uuid.uuid4().hex, filename, size)
+        except BaseException:
+            self.account(path, -size, -1, check=False)
+            raise
+
+    def readUpload(self, path: str, upload: str) -> Dict:
+        """Возвращает сведения о загрузке `upload` в директорию `path`"""
+        state = self.fileManager.readUpload(upload)
+        if (state["path"] != path):
+            raise FileNotFoundError(f"upload {upload} not found")
+        return state
+
+    def writeUpload(self, path: str, upload: str, offset: int, data: Iterator[bytes]) -> int:
+        """Записывает часть загрузки, начиная с `offset`. Возвращает количество полученных байтов"""
+        self.readUpload(path, upload)
+        return self.fileManager.writeUpload(upload, offset, data)
+
+    def commitUpload(self, path: str, upload: str, checksum: str) -> Dict:
+        """
+        Завершает загрузку, заменяя ей файл с тем же именем. Если контрольная сумма не совпадает, 
+        загрузка удаляется, потому что полученные байты уже нельзя исправить дозаписью
+        """
+        state = self.readUpload(path, upload)
+        previous = self.__sizeOf(path, state["name"])
+        try:
+            meta = self.fileManager.commitUpload(upload, checksum)
+        except ChecksumMismatch:
+            self.removeUpload(path, upload)
+            raise
+        # Место под файл занято при создании загрузки, поэтому освобождается место замененного файла
+        if (previous is not None):
+            self.account(path, -previous, -1, check=False)
+        return {"filename": state["name"], "size": meta["size"], "tokens": meta["tokens"], "revision": meta["revision"]}
+
+    def removeUpload(self, path: str, upload: str) -> None:
+        """Удаляет загрузку и освобождает занятое ей место в квотах"""
+        state = self.readUpload(path, upload)
+        if (self.fileManager.removeUpload(upload)):
+            self.account(path, -state["size"], -1, check=False)
+
+    def expireUploads(self, ttl: float) -> int:
+        """Удаляет загрузки, в которые не записывали дольше `ttl` секунд. Возвращает количество удаленных загрузок"""
+        deadline = time.time() - ttl
+        count = 0
+        for x in list(self.fileManager.listUploads()):
+            if (x["updatedAt"] >= deadline):
+                continue
+            try:
+                if (self.fileManager.removeUpload(x["upload"]) and "path" in x):
+                    self.account(x["path"], -x["size"], -1, check=False)
+            except FileNotFoundError:
+                # Загрузка завершена или удалена другим процессом
+                continue
+            count += 1
+        return count
+
+    def account(self, path: str, size: int, files: int, check: bool = True) -> None:
+        """
+        Изменяет счетчики объема и количества файлов окружения `path` и его владельца. Если `check`, 
+        квоты проверяются тем же условным обновлением, поэтому проверка не зависит от количества файлов
+        и не пропускает одновременные загрузки
+        """
+        if (path.isdigit() == False or (size == 0 and files == 0)):
+            return
+        user = AccessService().ownerOf(path)
+        check = check and size >= 0 and files >= 0
+
+        with transaction.atomic():
+            environments = Environment.objects.filter(id=int(path))
+            if (check and settings.STORAGE_QUOTA_ENVIRONMENT_BYTES):
+                environments = environments.filter(storageBytes__lte=settings.STORAGE_QUOTA_ENVIRONMENT_BYTES - size)
+            if (environments.update(storageBytes=F("storageBytes") + size, storageFiles=F("storageFiles") + files) == 0):
+                if (Environment.objects.filter(id=int(path)).exists()):
+                    raise StorageQuotaExceeded(
+                        f"storage quota of {settings.STORAGE_QUOTA_ENVIRONMENT_BYTES} bytes per environment exceeded"
+                    )
+                return
+            if (user is None):
+                return
+
+            usage = StorageUsage.objects.filter(user_id=user)
+            if (check and settings.STORAGE_QUOTA_USER_BYTES):
+                usage = usage.filter(bytes__lte=settings.STORAGE_QUOTA_USER_BYTES - size)
+            if (check and settings.STORAGE_QUOTA_USER_FILES):
+                usage = usage.filter(files__lte=settings.STORAGE_QUOTA_USER_FILES - files)
+            for _ in range(2):
+                if (usage.update(bytes=F("bytes") + size, files=F("files") + files)):
+                    return
+                # Счетчики пользователя создаются при первой записи
+                if (StorageUsage.objects.get_or_create(user_id=user)[1] == False):
+                    break
+            raise StorageQuotaExceeded(
+                f"storage quota of {settings.STORAGE_QUOTA_USER_BYTES} bytes "
+                f"and {settings.STORAGE_QUOTA_USER_FILES} files per user exceeded"
+            )
+
+    def releaseUsage(self, path: str) -> None:
+        """Вычитает объем и количество файлов окружения `path` из счетчиков владельца и обнуляет счетчики окружения"""
+        if (path.isdigit() == False):
+            return
+        with transaction.atomic():
+            environment = Environment.objects.select_for_update().filter(id=int(path)).values_list(
+                "user_id", "storageBytes", "storageFiles"
+            ).first()
+            if (environment is None):
+                return
+            user, size, files = environment
+            Environment.objects.filter(id=int(path)).update(storageBytes=0, storageFiles=0)
+            StorageUsage.objects.filter(user_id=user).update(bytes=F("bytes") - size, files=F("files") - files)
+
+    def __sizeOf(self, path: str, filename: str) -> int | None:
+        """Возвращает размер файла в байтах или None, если файла нет"""
+        try:
+            return self.fileManager.fileSize(path, filename)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def __lengthOf(self, file: Union[UploadedFile, str]) -> int:
+        if isinstance(file, str):
+            return len(file.encode("utf-8"))
+        return file.size
     
     def createDir(self, path: str) -> None:
         """Создает директорию"""
@@ -94,6 +277,222 @@ class FileService(Service):
         """Очищает директорию"""
         return self.fileManager.clearDir(path)
 
+    def discardDir(self, path: str) -> None:
+        """Помечает директорию для удаления в фоне и освобождает занятое ей место в квотах"""
+        if (self.fileManager.exists(path)):
+            self.fileManager.discardDir(path)
+        self.releaseUsage(path)
+
+    def collectTrash(self) -> int:
+        """Удаляет директории, помеченные для удаления"""
+        return self.fileManager.collectTrash()
+
+    def listDirs(self) -> Iterator[str]:
+        """Перебирает директории окружений"""
+        return self.fileManager.listDirs()
+
+    def copyDir(self, source: str, destination: str) -> None:
+        """
+        Создает копию директории, не копируя данные файлов, если хранилище это поддерживает.
+        Копия учитывается в квотах полным объемом
+        """
+        stats = self.fileManager.listFilesStat(source)
+        size = sum(x["size"] for x in stats)
+        self.account(destination, size, len(stats))
+        try:
+            return self.fileManager.copyDir(source, destination)
+        except BaseException:
+            self.account(destination, -size, -len(stats), check=False)
+            raise
+
+class AccessService(Service):
+    """
+    Отвечает за проверку существования окружений и их владельцев. Владельцы кэшируются,
+    чтобы запросы к окружению не обращались к базе данных
+    """
+
+    @once
+    def __init__(self):
+        pass
+
+    def ownerOf(self, id: str) -> int | None:
+        """Возвращает идентификатор владельца окружения или None, если окружения не существует"""
+        key = f"environment-owner:{id}"
+        owner = cache.get(key)
+        if (owner is None):
+            try:
+                owner = Environment.objects.filter(pk=id).values_list("user_id", flat=True).first()
+            except (TypeError, ValueError):
+                return None
+            if (owner is not None):
+                cache.set(key, owner, settings.OWNER_CACHE_TTL)
+        return owner
+
+    def exists(self, id: str) -> bool:
+        return self.ownerOf(id) is not None
+
+    def forgetEnvironment(self, id: str) -> None:
+        """Удаляет окружение из кэша, например после удаления или смены владельца"""
+        cache.delete(f"environment-owner:{id}")
+
+class NotificationService(Service):
+    """
+    Отвечает за рассылку событий окружения (изменение файлов, загрузка файлов в контекст модели) подписчикам
+    этого процесса, например WebSocket-соединениям. События других процессов подписчики не получают
+    """
+
+    @once
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers: Dict[str, List[Callable[[Dict], None]]] = {}
+
+    def subscribe(self, id: str, callback: Callable[[Dict], None]) -> None:
+        """Вызывает `callback` для каждого события окружения `id`. Вызов может происходить в любом потоке"""
+        with self.lock:
+            self.subscribers.setdefault(id, []).append(callback)
+
+    def unsubscribe(self, id: str, callback: Callable[[Dict], None]) -> None:
+        with self.lock:
+            callbacks = self.subscribers.get(id, [])
+            if (callback in callbacks):
+                callbacks.remove(callback)
+            if (len(callbacks) == 0):
+                self.subscribers.pop(id, None)
+
+    def publish(self, id: str, event: Dict) -> None:
+        with self.lock:
+            callbacks = list(self.subscribers.get(id, []))
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("notification failed", extra={"environment": id, "event": event.get("type")})
+
+class QuotaExceeded(Exception):
+    """Превышена квота токенов пользователя"""
+    pass
+
+class StorageQuotaExceeded(QuotaExceeded):
+    """Превышена квота хранилища пользователя или окружения"""
+    pass
+
+class UsageService(Service):
+    """
+    Отвечает за учет токенов модели по пользователям и окружениям и за квоты.
+    Использование накапливается в памяти и записывается в базу данных пакетами в фоне,
+    текущие суммы для проверки квот хранятся в кэше. Процессы видят ответы друг друга только через общий кэш
+    (CACHE_URL), с кэшем в памяти процесса квоты соблюдаются в каждом процессе отдельно
+    """
+
+    @once
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffer: Dict[tuple, Dict[str, int]] = {}
+        BackgroundWorker().every(settings.USAGE_FLUSH_INTERVAL, self.flush, key="usage-flush")
+        atexit.register(self.flush)
+
+    def record(self, id: str, usage) -> None:
+        """Учитывает токены из `usage` ответа модели для окружения `id` и его владельца"""
+        user = AccessService().ownerOf(id)
+        if (usage is None or user is None):
+            return
+
+        details = getattr(usage, "prompt_tokens_details", None)
+        counts = {
+            "promptTokens": usage.prompt_tokens,
+            "completionTokens": usage.completion_tokens,
+            "cachedTokens": getattr(details, "cached_tokens", None) or 0,
+            "requests": 1,
+        }
+        today = timezone.localdate()
+        with self.lock:
+            current = self.buffer.setdefault((user, int(id), today), dict.fromkeys(counts, 0))
+            for k, v in counts.items():
+                current[k] += v
+            size = len(self.buffer)
+
+        for period in self.__periods(today):
+            try:
+                cache.incr(f"token-usage:{user}:{period}", usage.prompt_tokens + usage.completion_tokens)
+            except ValueError:
+                # Сумма еще не загружена в кэш, она будет посчитана при следующей проверке
+                pass
+
+        if (size >= settings.USAGE_FLUSH_SIZE):
+            BackgroundWorker().submit(self.flush, key="usage-flush")
+
+    def getUsage(self, user: int, period: str) -> int:
+        """Возвращает количество токенов пользователя за `period` ("day" или "month")"""
+        today = timezone.localdate()
+        start = today if period == "day" else today.replace(day=1)
+        key = f"token-usage:{user}:{self.__periods(today)[0 if period == 'day' else 1]}"
+
+        value = cache.get(key)
+        if (value is None):
+            total = TokenUsage.objects.filter(user_id=user, date__gte=start, date__lte=today).aggregate(
+                prompt=Sum("promptTokens"),
+                completion=Sum("completionTokens"),
+            )
+            value = (total["prompt"] or 0) + (total["completion"] or 0)
+            with self.lock:
+                value += sum(
+                    x["promptTokens"] + x["completionTokens"] 
+                    for (u, _, date), x in self.buffer.items() if u == user and date >= start
+                )
+            cache.add(key, value, settings.USAGE_CACHE_TTL)
+        return value
+
+    def checkQuota(self, id: str) -> None:
+        """Проверяет, не превысил ли владелец окружения дневную или месячную квоту токенов"""
+        if (settings.TOKEN_QUOTA_DAILY == 0 and settings.TOKEN_QUOTA_MONTHLY == 0):
+            return
+        user = AccessService().ownerOf(id)
+        if (user is None):
+            return
+
+        if (settings.TOKEN_QUOTA_DAILY and self.getUsage(user, "day") >= settings.TOKEN_QUOTA_DAILY):
+            raise QuotaExceeded(f"daily token quota of {settings.TOKEN_QUOTA_DAILY} exceeded")
+        if (settings.TOKEN_QUOTA_MONTHLY and self.getUsage(user, "month") >= settings.TOKEN_QUOTA_MONTHLY):
+            raise QuotaExceeded(f"monthly token quota of {settings.TOKEN_QUOTA_MONTHLY} exceeded")
+
+    def flush(self) -> None:
+        """Записывает накопленное использование в базу данных"""
+        with self.lock:
+            buffer, self.buffer = self.buffer, {}
+        if (len(buffer) == 0):
+            return
+
+        try:
+            for (user, environment, date), counts in list(buffer.items()):
+                with transaction.atomic():
+                    self.__write(user, environment, date, counts)
+                buffer.pop((user, environment, date))
+        except Exception:
+            logger.exception("token usage flush failed", extra={"pending": len(buffer)})
+            # Незаписанное использование возвращается в буфер до следующей попытки
+            with self.lock:
+                for key, counts in buffer.items():
+                    current = self.buffer.setdefault(key, dict.fromkeys(counts, 0))
+                    for k, v in counts.items():
+                        current[k] += v
+        finally:
+            close_old_connections()
+
+    def __write(self, user: int, environment: int, date, counts: Dict[str, int]) -> None:
+        increments = {k: F(k) + v for k, v in counts.items()}
+        query = TokenUsage.objects.filter(user_id=user, environment_id=environment, date=date)
+        if (query.update(**increments)):
+            return
+        try:
+            with transaction.atomic():
+                TokenUsage.objects.create(user_id=user, environment_id=environment, date=date, **counts)
+        except IntegrityError:
+            # Запись уже создана другим процессом
+            query.update(**increments)
+
+    def __periods(self, today) -> List[str]:
+        return [today.isoformat(), today.strftime("%Y-%m")]
+
 class GPTService(Service):
     """
     Отвечает за общение с GPT-моделью
@@ -101,33 +500,51 @@ class GPTService(Service):
 
     @dataclass
     class Chat():
-        messages: List[Dict[str, str]] = None
+        messages: List[Message] = None
         tokens: int = 0
         commited: bool = False
+        summary: Message = None
+        lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+        # Идентификатор и счетчик изменений образуют версию истории сообщений для ETag
+        id: str = field(default_factory=lambda: uuid.uuid4().hex, compare=False)
+        version: int = 0
+
+        @property
+        def etag(self) -> str:
+            return f'"{self.id}-{self.version}"'
+
+        def prompt(self) -> List[Dict[str, str]]:
+            """Сообщения в формате запроса к модели"""
+            return [x.prompt() for x in self.messages]
 
         def clear(self):
-            self.messages = self.messages[:1]
-            self.tokens = 0
-            self.commited = False
+            with self.lock:
+                self.messages = self.messages[:1]
+                self.tokens = 0
+                self.commited = False
+                self.summary = None
+                self.version += 1
 
     connection: GPTConnection = None
 
-    default_context: List[Dict[str, str]] = [
-        {
-            "role": "system",
-            "content": "You're a helpful assistant who answers questions, generates information based on the files if they are given. Use only plain text without formatting."
-        }
+    default_context: List[Message] = [
+        Message(
+            "system",
+            "You're a helpful assistant who answers questions, generates information based on the files if they are given. Use only plain text without formatting."
+        )
     ]
     tokenLimit: int = 10000
     prompts: Dict[str, str] = {
         "generate": "Based on the files you previously got find similarities and generate a response.",
         "generate-instructed": "Based on the files you previously got generate a response according to these instructions: ",
         "fix": "Try to write this part of generated file differently:",
+        "summarize": "Summarize the conversation above in a few paragraphs. Keep every fact, decision and instruction that later answers may rely on.",
     }
 
     @once
     def __init__(self):
         self.connection = GPTConnection()
+        self.usageService = UsageService()
         self.conversations: Dict[str, GPTService.Chat] = {}
 
     def getConversation(self, id: str) -> Chat:
@@ -139,9 +556,11 @@ class GPTService(Service):
             # raise KeyError(f"id: {id} not found in conversations")
         return result
 
-    def createConversation(self, id: str, files: List[Dict[str, str]] = [], context: List[Dict[str, str]] = []) -> Chat:
+    def createConversation(self, id: str, files: List[FileBlock] = [], context: List[Message] = []) -> Chat:
         """Создает или заменяет чат с моделью по id окружения"""
-        print(files)
+        logger.info("conversation created", extra={"environment": id, "files": len(files)})
+        if (logger.isEnabledFor(logging.DEBUG) and sampled()):
+            logger.debug("conversation files", extra={"environment": id, "payload": truncate([x.prompt() for x in files])})
 
         # Добавить загрузку в БД
 
@@ -151,6 +570,32 @@ class GPTService(Service):
             )
         return chat
 
+    def forkConversation(self, source: str, target: str, index: int = None) -> Chat:
+        """
+        Создает чат окружения `target` с сообщениями чата окружения `source`. Если указан `index`, копируются только
+        сообщения до `index`-го сообщения истории (без системных сообщений, как в get-context). Сообщения и блоки
+        файлов не копируются, новый чат ссылается на те же объекты
+        """
+        chat: GPTService.Chat = self.getConversation(source)
+        with chat.lock:
+            messages = chat.messages
+            tokens = chat.tokens
+            if (index is not None):
+                history = [i for i, x in enumerate(messages) if x.role != "system"]
+                if (index < len(history)):
+                    messages = messages[:history[index]]
+                    # Размер укороченного контекста станет известен после следующего ответа модели
+                    tokens = 0
+
+            fork = self.conversations[target] = GPTService.Chat(
+                messages=list(messages),
+                tokens=tokens,
+                commited=chat.commited,
+                summary=chat.summary if any(x is chat.summary for x in messages) else None,
+            )
+        logger.info("conversation forked", extra={"environment": target, "source": source, "messages": len(messages)})
+        return fork
+
     def closeConversation(self, id: str) -> None:
         """Удаляет чат с моделью по id окружения"""
 
@@ -160,42 +605,246 @@ class GPTService(Service):
 
     def sendMessage(self, id: str, prompt: str) -> str:
         """Отправляет `prompt` модели"""
+        chat, messages = self.__appendPrompt(id, prompt)
+
+        completion = self.__complete("message", id, messages=messages)
+
+        self.__appendResponse(id, chat, completion.choices[0].message.content, completion.usage.total_tokens)
+        return completion.choices[0].message.content
+
+    def streamMessage(self, id: str, prompt: str) -> Iterator[str]:
+        """Отправляет `prompt` модели и возвращает части ответа по мере их генерации"""
+        chat, messages = self.__appendPrompt(id, prompt)
+
+        chunks = self.__complete(
+            "message",
+            id,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        parts = []
+        tokens = None
+        for x in chunks:
+            if (x.usage is not None):
+                tokens = x.usage.total_tokens
+            if (len(x.choices) and x.choices[0].delta.content):
+                parts.append(x.choices[0].delta.content)
+                yield x.choices[0].delta.content
+
+        self.__appendResponse(id, chat, "".join(parts), tokens)
+
+    def __appendPrompt(self, id: str, prompt: str) -> tuple[Chat, List[Dict[str, str]]]:
+        """Добавляет `prompt` в чат и возвращает чат и сообщения для отправки модели"""
         chat: GPTService.Chat = self.getConversation(id)
 
+        if (chat.tokens > self.tokenLimit):
+            # Сжатие могло быть запланировано предыдущим запросом. Его ошибка не мешает сжать чат заново
+            pending = BackgroundWorker().getPending(("compact", id))
+            if (pending is not None):
+                pending.exception()
+
+        if (chat.tokens > self.tokenLimit):
+            # Фоновое сжатие не удалось или его не хватило: чат сжимается сразу, оставляя все меньше последних сообщений
+            for keep in range(settings.CHAT_KEEP_MESSAGES, -1, -1):
+                try:
+                    self.__compact(id, keep)
+                except Exception:
+                    logger.exception("conversation compaction failed", extra={"environment": id})
+                    break
+                if (chat.tokens <= self.tokenLimit):
+                    break
+
         if (chat.tokens > self.tokenLimit):
             raise Exception(f"token limit of {self.tokenLimit} exeeded")
 
-        chat.messages.append(
-            {
-                "role": "user",
-                "content": prompt
-            }
-        )
+        with chat.lock:
+            chat.messages.append(Message("user", prompt))
+            chat.version += 1
+            messages = chat.prompt()
+
+        return chat, messages
+
+    def __appendResponse(self, id: str, chat: Chat, content: str, tokens: int | None) -> None:
+        """Добавляет ответ модели в чат и планирует сжатие, если контекст приближается к лимиту"""
+        with chat.lock:
+            # Размер контекста после ответа модели
+            if (tokens is not None):
+                chat.tokens = tokens
+            chat.messages.append(Message("assistant", content))
+            chat.version += 1
+
+        if (logger.isEnabledFor(logging.DEBUG) and sampled()):
+            logger.debug("conversation messages", extra={"environment": id, "payload": truncate(chat.prompt())})
+
+        if (chat.tokens > self.tokenLimit * settings.CHAT_COMPACTION_THRESHOLD):
+            self.compactConversation(id)
+
+    def compactConversation(self, id: str) -> Future:
+        """Планирует сжатие старых сообщений чата в одно сообщение с кратким содержанием"""
+        return BackgroundWorker().submit(self.__compact, id, key=("compact", id))
+
+    def __compact(self, id: str, keep: int = None) -> None:
+        """Сжимает сообщения чата, кроме `keep` последних (по умолчанию CHAT_KEEP_MESSAGES), вместе с предыдущим кратким содержанием"""
+        chat: GPTService.Chat = self.conversations.get(id, None)
+        if (chat is None):
+            return
 
-        completion = self.connection.client.chat.completions.create(
-            model=self.connection.model,
-            messages=chat.messages
+        with chat.lock:
+            start = next((i for i, x in enumerate(chat.messages) if x.role != "system"), None)
+            if (chat.summary is not None and chat.summary in chat.messages):
+                start = chat.messages.index(chat.summary)
+            end = len(chat.messages) - (settings.CHAT_KEEP_MESSAGES if keep is None else keep)
+            if (start is None or end - start < 2):
+                return
+            turns = chat.messages[start:end]
+
+        completion = self.__complete(
+            "summarize",
+            id,
+            messages=[x.prompt() for x in self.default_context + turns] + [
+                {
+                    "role": "user",
+                    "content": self.prompts.get("summarize")
+                }
+            ]
+        )
+        summary = Message(
+            "system",
+            "This is the summary of the earlier conversation: " + completion.choices[0].message.content
         )
 
-        chat.tokens += completion.usage.total_tokens
-        print("used tokens:", completion.usage.total_tokens)
-        print("total tokens:", chat.tokens)
+        with chat.lock:
+            # Чат мог быть очищен или пересоздан, пока модель готовила ответ
+            current = chat.messages[start:end]
+            if (self.conversations.get(id, None) is not chat or len(current) != len(turns) \
+                    or any(x is not y for x, y in zip(current, turns))):
+                return
+
+            total = sum(x.size for x in chat.messages) or 1
+            removed = sum(x.size for x in turns)
+            chat.messages[start:end] = [summary]
+            chat.summary = summary
+            chat.version += 1
+            chat.tokens = int(chat.tokens * (total - removed + summary.size) / total)
+
+    def fixFragment(self, id: str, fragment: str, index: int = None, instructions: str = '', excerpts: List[str] = []) -> str:
+        """
+        Переписывает `fragment` ответа модели с индексом `index` (по умолчанию последнего ответа, содержащего `fragment`),
+        отправляя модели только сам фрагмент, соседние строки и `excerpts` вместо всего контекста
+        """
+        chat: GPTService.Chat = self.getConversation(id)
+
+        with chat.lock:
+            message = self.__findResponse(chat, fragment, index)
+            content = message.content
 
-        chat.messages.append(
-            {
-                "role": "assistant",
-                "content": completion.choices[0].message.content
-            }
+        position = content.index(fragment)
+        before = content[:position].split("\n")[-settings.FIX_CONTEXT_LINES - 1:]
+        after = content[position + len(fragment):].split("\n")[:settings.FIX_CONTEXT_LINES + 1]
+
+        messages = [x.prompt() for x in self.default_context]
+        if (len(excerpts)):
+            messages.append({
+                "role": "system",
+                "content": "These are the relevant excerpts from the files:\n" + "\n".join(excerpts)
+            })
+        messages.append({
+            "role": "user",
+            "content": "Text before the part: " + "\n".join(before) + "\n" \
+                + "Text after the part: " + "\n".join(after) + "\n" \
+                + (f"Instructions: {instructions}\n" if instructions else "") \
+                + "Answer only with the new version of the part. " \
+                + self.prompts.get("fix") + "\n" + fragment
+        })
+
+        completion = self.__complete(
+            "fix",
+            id,
+            messages=messages,
+            # Около 4 символов на токен, с запасом на переформулировку
+            max_tokens=len(fragment) // 2 + 64
         )
+        result = completion.choices[0].message.content
 
-        print(chat.messages)
+        with chat.lock:
+            # Сообщения могут быть общими с копиями чата, поэтому исправленное сообщение заменяется новым
+            for i, x in enumerate(chat.messages):
+                if (x is message and fragment in x.content):
+                    chat.messages[i] = Message(x.role, x.content.replace(fragment, result, 1))
+                    chat.version += 1
+                    break
 
-        return completion.choices[0].message.content
+        return result
+
+    def __findResponse(self, chat: Chat, fragment: str, index: int = None) -> Message:
+        context = [x for x in chat.messages if x.role != "system"]
+        if (index is not None):
+            if (index < 0 or index >= len(context) or context[index].role != "assistant"):
+                raise KeyError(f"response with index: {index} not found")
+            if (fragment not in context[index].content):
+                raise ValueError("fragment not found in response")
+            return context[index]
+
+        for x in reversed(context):
+            if (x.role == "assistant" and fragment in x.content):
+                return x
+        raise ValueError("fragment not found in responses")
+
+    def __complete(self, operation: str, id: str, **kwargs):
+        """Отправляет запрос модели, учитывая время ответа и использованные токены"""
+        if (operation != "summarize"):
+            # Сжатие чата выполняется сервисом, а не по запросу пользователя
+            self.usageService.checkQuota(id)
+
+        start = time.perf_counter()
+        with span(f"model:{operation}"):
+            completion = self.connection.client.chat.completions.create(
+                model=self.connection.model,
+                **kwargs
+            )
+        if (kwargs.get("stream")):
+            return self.__stream(operation, id, start, completion)
+
+        elapsed = time.perf_counter() - start
+        MODEL_LATENCY.labels(operation=operation).observe(elapsed)
+        recordTokens(completion.usage)
+        self.usageService.record(id, completion.usage)
+        logger.info("model completion", extra={
+            "environment": id,
+            "operation": operation,
+            "duration": round(elapsed, 3),
+            "tokens": completion.usage.total_tokens if completion.usage else None,
+        })
+        return completion
+
+    def __stream(self, operation: str, id: str, start: float, chunks: Iterator) -> Iterator:
+        first = True
+        tokens = None
+        for x in chunks:
+            if (first and len(x.choices) and x.choices[0].delta.content):
+                MODEL_TTFT.labels(operation=operation).observe(time.perf_counter() - start)
+                first = False
+            if (x.usage is not None):
+                recordTokens(x.usage)
+                self.usageService.record(id, x.usage)
+                tokens = x.usage.total_tokens
+            yield x
+        elapsed = time.perf_counter() - start
+        MODEL_LATENCY.labels(operation=operation).observe(elapsed)
+        logger.info("model completion", extra={
+            "environment": id,
+            "operation": operation,
+            "duration": round(elapsed, 3),
+            "tokens": tokens,
+        })
 
     def loadContext(self, id: str, context: List[Dict[str, str]]) -> None:
         """Загружает `context` в контекст модели"""
         chat: GPTService.Chat = self.getConversation(id)
-        chat.messages.append(context)
+        with chat.lock:
+            chat.messages.extend(Message(x["role"], x["content"]) for x in context)
+            chat.version += 1
 
     def clearContext(self, id: str) -> None:
         """Очищает контекст модели"""
@@ -214,67 +863,272 @@ class EnvironmentService(Service):
     def __init__(self):
         self.fileService = FileService()
         self.gptService = GPTService()
+        self.notificationService = NotificationService()
+        # Контекст файлов, собранный в фоне, вместе с версией файлов, по которой он собран,
+        # и количеством токенов, сэкономленных удалением повторов. Хранится не больше CONTEXT_PREBUILD_MAX окружений,
+        # первым вытесняется контекст окружения, к которому дольше всего не обращались
+        self.prebuilt: OrderedDict[str, tuple[str, List[FileBlock], int]] = OrderedDict()
+        self.prebuiltLock = threading.Lock()
+        # Директории без окружения в базе данных, найденные при предыдущей сверке
+        self.orphans: set = set()
+        if (settings.STORAGE_GC_INTERVAL > 0):
+            BackgroundWorker().every(settings.STORAGE_GC_INTERVAL, self.collectGarbage, key="storage-gc")
 
     def createEnvironment(self, id: str) -> None:
         self.fileService.createDir(id)
         self.gptService.createConversation(id)
 
+    def cloneEnvironment(self, source: str, target: str, fork: bool = False, index: int = None) -> None:
+        """
+        Создает окружение `target` с файлами окружения `source`. Если `fork`, чат копируется до сообщения
+        с индексом `index` или целиком
+        """
+        self.fileService.copyDir(source, target)
+        if (fork):
+            self.gptService.forkConversation(source, target, index)
+        else:
+            self.gptService.createConversation(target)
+            self.scheduleFilesContext(target)
+
     def removeEnvironment(self, id: str) -> None:
-        self.fileService.removeDir(id)
+        """Помечает файлы окружения для удаления и освобождает его чат. Файлы удаляются в фоне"""
+        self.fileService.discardDir(id)
+        self.releaseEnvironment(id)
+        BackgroundWorker().submit(self.fileService.collectTrash)
+
+    def releaseEnvironment(self, id: str) -> None:
+        """Освобождает память, занятую чатом и собранным контекстом окружения"""
         self.gptService.closeConversation(id)
+        self.__dropPrebuilt(id)
 
     def clearEnvironment(self, id: str) -> JsonResponse:
         """Очищает файлы окружения и контекст модели"""
         try:
-            self.fileService.clearDir(id)
+            # Старые файлы удаляются в фоне, окружение сразу получает пустую директорию
+            self.fileService.discardDir(id)
+            self.fileService.createDir(id)
             self.gptService.clearContext(id)
         except KeyError as e:
             ...
-        return JsonResponse({}, status=status.HTTP_200_OK)
+        self.__dropPrebuilt(id)
+        self.notificationService.publish(id, {"type": "clear"})
+        BackgroundWorker().submit(self.fileService.collectTrash)
+        return FastJsonResponse({}, status=status.HTTP_200_OK)
+
+    def collectGarbage(self) -> None:
+        """Сверяет директории и чаты с таблицей окружений и удаляет директории, помеченные для удаления"""
+        try:
+            discarded = self.reconcileEnvironments()
+        finally:
+            close_old_connections()
+        collected = self.fileService.collectTrash()
+        try:
+            expired = self.fileService.expireUploads(settings.UPLOAD_TTL)
+        finally:
+            close_old_connections()
+        if (discarded or collected or expired):
+            logger.info("storage collected", extra={"orphans": discarded, "directories": collected, "uploads": expired})
+
+    def reconcileEnvironments(self) -> int:
+        """
+        Помечает для удаления директории окружений, которых нет в базе данных, и освобождает их чаты.
+        Директория удаляется, только если ее не было в базе данных и при предыдущей сверке, чтобы не задеть
+        окружение, которое создается прямо сейчас. Возвращает количество помеченных директорий
+        """
+        candidates = set()
+        batch = []
+
+        def check(names: List[str]) -> None:
+            existing = set(
+                str(x) for x in Environment.objects.filter(id__in=[int(x) for x in names]).values_list("id", flat=True)
+            )
+            candidates.update(x for x in names if x not in existing)
+
+        for name in self.fileService.listDirs():
+            if (name.isdigit() == False):
+                continue
+            batch.append(name)
+            if (len(batch) >= 1000):
+                check(batch)
+                batch = []
+        if (len(batch)):
+            check(batch)
+
+        conversations = [x for x in list(self.gptService.conversations) if x.isdigit()]
+        for i in range(0, len(conversations), 1000):
+            check(conversations[i:i + 1000])
+
+        orphans = candidates & self.orphans
+        self.orphans = candidates - orphans
+        for id in orphans:
+            self.fileService.discardDir(id)
+            self.releaseEnvironment(id)
+        return len(orphans)
 
     def saveFile(self, id: str, file: Union[UploadedFile, str], filename: str = None) -> JsonResponse:
         """Загружает файл, представленный `UploadedFile` или `str`, или заменяет файл с таким же именем в хранилище."""
         self.fileService.replaceFile(id, file, filename)
+        self.notificationService.publish(id, {"type": "file", "action": "saved", "filename": filename})
+        self.scheduleFilesContext(id)
 
-        return JsonResponse({}, status=status.HTTP_201_CREATED)
+        return FastJsonResponse({}, status=status.HTTP_201_CREATED)
 
     def updateFile(self, id: str, file: Union[UploadedFile, str], filename: str = None) -> JsonResponse:
-        """Дополняет файл в хранилище файлом с тем же именем, представленным `UploadedFile` или `str`"""
-        self.fileService.saveFile(id, file, filename)
+        """Дописывает в конец файла в хранилище файл с тем же именем, представленный `UploadedFile` или `str`"""
+        meta = self.fileService.appendFile(id, file, filename)
+        self.notificationService.publish(id, {"type": "file", "action": "updated", "filename": filename})
+        self.scheduleFilesContext(id)
             
-        return JsonResponse({}, status=status.HTTP_200_OK)
+        return FastJsonResponse(meta, status=status.HTTP_200_OK)
 
     def removeFile(self, id: str, filename: str) -> JsonResponse:
         """Удаляет файл c именем `filename` из хранилища"""
         try:
             self.fileService.removeFile(id, filename)
+            self.notificationService.publish(id, {"type": "file", "action": "removed", "filename": filename})
+            self.scheduleFilesContext(id)
         except FileNotFoundError as e:
             ...
-        return JsonResponse({}, status=status.HTTP_200_OK)
+        return FastJsonResponse({}, status=status.HTTP_200_OK)
+
+    def createUpload(self, id: str, filename: str, size: int) -> JsonResponse:
+        """Начинает загрузку файла по частям"""
+        state = self.fileService.createUpload(id, filename, size)
+        return FastJsonResponse(self.__uploadState(state), status=status.HTTP_201_CREATED)
+
+    def getUpload(self, id: str, upload: str) -> JsonResponse:
+        """Возвращает количество полученных байтов загрузки, с которого ее можно продолжить"""
+        try:
+            state = self.fileService.readUpload(id, upload)
+        except FileNotFoundError:
+            return FastJsonResponse({"detail": f"upload {upload} not found"}, status=status.HTTP_404_NOT_FOUND)
+        return FastJsonResponse(self.__uploadState(state), status=status.HTTP_200_OK)
+
+    def writeUpload(self, id: str, upload: str, offset: int, data: Iterator[bytes]) -> JsonResponse:
+        """Записывает часть загрузки, начиная с `offset`"""
+        try:
+            offset = self.fileService.writeUpload(id, upload, offset, data)
+        except FileNotFoundError:
+            return FastJsonResponse({"detail": f"upload {upload} not found"}, status=status.HTTP_404_NOT_FOUND)
+        except OffsetMismatch as e:
+            return FastJsonResponse({"detail": " ".join(e.args), "offset": e.offset}, status=status.HTTP_409_CONFLICT)
+        except ValueError as e:
+            return FastJsonResponse({"detail": " ".join(e.args)}, status=status.HTTP_400_BAD_REQUEST)
+        return FastJsonResponse({"upload": upload, "offset": offset}, status=status.HTTP_200_OK)
+
+    def commitUpload(self, id: str, upload: str, checksum: str) -> JsonResponse:
+        """Завершает загрузку: проверяет контрольную сумму и заменяет файл с тем же именем"""
+        try:
+            meta = self.fileService.commitUpload(id, upload, checksum)
+        except FileNotFoundError:
+            return FastJsonResponse({"detail": f"upload {upload} not found"}, status=status.HTTP_404_NOT_FOUND)
+        except OffsetMismatch as e:
+            return FastJsonResponse({"detail": "upload is incomplete", "offset": e.offset}, status=status.HTTP_409_CONFLICT)
+        except ChecksumMismatch as e:
+            return FastJsonResponse({"detail": " ".join(e.args)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.notificationService.publish(id, {"type": "file", "action": "saved", "filename": meta["filename"]})
+        self.scheduleFilesContext(id)
+
+        return FastJsonResponse(meta, status=status.HTTP_201_CREATED)
+
+    def removeUpload(self, id: str, upload: str) -> JsonResponse:
+        """Отменяет загрузку и удаляет полученные части"""
+        try:
+            self.fileService.removeUpload(id, upload)
+        except FileNotFoundError:
+            return FastJsonResponse({"detail": f"upload {upload} not found"}, status=status.HTTP_404_NOT_FOUND)
+        return FastJsonResponse({}, status=status.HTTP_200_OK)
+
+    def __uploadState(self, state: Dict) -> Dict:
+        updatedAt = int(state.get("updatedAt", time.time()))
+        return {
+            "upload": state["upload"],
+            "filename": state["name"],
+            "size": state["size"],
+            "offset": state["offset"],
+            "updatedAt": updatedAt,
+            "expiresAt": updatedAt + settings.UPLOAD_TTL,
+        }
 
     def readFile(self, id: str, filename: str) -> JsonResponse:
         """Считывает файл c именем `filename` из хранилища"""
         file = self.fileService.readFile(id, filename)
-        return JsonResponse({
+        return FastJsonResponse({
                 "filename": filename,
                 "file": file
             }, status=status.HTTP_200_OK)
 
     def listFiles(self, id: str) -> JsonResponse:
         """Получает информацию о файлах в окружении"""
-        return JsonResponse(
+        # Версия берется до чтения директории, чтобы изменения во время чтения не остались незамеченными
+        etag = self.getFilesVersion(id)
+        response = FastJsonResponse(
             self.fileService.listFilesStat(id),
             safe=False,
             status=status.HTTP_200_OK,
         )
+        response["ETag"] = etag
+        return response
+
+    def getFilesVersion(self, id: str) -> str:
+        """Возвращает ETag списка файлов окружения, не читая директорию"""
+        return f'"{self.fileService.version(id)}"'
 
     def generate(self, id: str, prompt: str = '') -> JsonResponse:
         """Генерирует текстовый файл на основе файлов окружения"""
-        chat = self.gptService.getConversation(id)
-        
-        if (chat.commited == False):
-            # raise Exception("files not commited")
-            self.commitFiles(id)
+        return FastJsonResponse({
+                "response": self.generateResponse(id, prompt)
+            }, status=status.HTTP_200_OK)
+
+    def generateBatch(self, items: List[Dict[str, str]]) -> Iterator[Dict[str, str]]:
+        """
+        Генерирует текстовые файлы для нескольких окружений, представленных как `{"id": ..., "prompt": ...}`. 
+        Файлы окружений загружаются в контекст параллельно, запросы к модели отправляются не более чем 
+        по `BATCH_CONCURRENCY` одновременно. Результаты возвращаются по мере готовности.
+        Элементы с одним окружением выполняются последовательно в порядке запроса, так как используют один чат
+        """
+        results = queue.Queue()
+        contexts = ThreadPoolExecutor(max_workers=settings.BATCH_CONTEXT_WORKERS, thread_name_prefix="batch-context")
+        completions = ThreadPoolExecutor(max_workers=settings.BATCH_CONCURRENCY, thread_name_prefix="batch-completion")
+
+        groups: Dict[str, List[Dict[str, str]]] = {}
+        for x in items:
+            groups.setdefault(str(x["id"]), []).append(x)
+
+        def complete(group: List[Dict[str, str]]) -> None:
+            try:
+                for item in group:
+                    try:
+                        results.put({"id": item["id"], "response": self.generateResponse(item["id"], item.get("prompt", ''))})
+                    except Exception as e:
+                        results.put({"id": item["id"], "detail": " ".join(map(str, e.args))})
+            finally:
+                # Потоки пула не обрабатывают запросы, поэтому их соединения с базой данных сами не закрываются
+                connections.close_all()
+
+        def prepare(group: List[Dict[str, str]]) -> None:
+            try:
+                self.prepareFiles(group[0]["id"])
+            except Exception as e:
+                for item in group:
+                    results.put({"id": item["id"], "detail": " ".join(map(str, e.args))})
+                return
+            finally:
+                connections.close_all()
+            completions.submit(complete, group)
+
+        try:
+            for x in groups.values():
+                contexts.submit(prepare, x)
+            for _ in range(len(items)):
+                yield results.get()
+        finally:
+            contexts.shutdown(wait=False, cancel_futures=True)
+            completions.shutdown(wait=False, cancel_futures=True)
+
+    def generateResponse(self, id: str, prompt: str = '') -> str:
+        """Генерирует ответ модели на основе файлов окружения"""
+        self.prepareFiles(id)
 
         if (prompt == False and len(prompt) == 0):
             prompt = self.gptService.prompts.get("generate")
@@ -282,45 +1136,195 @@ class EnvironmentService(Service):
             prompt = self.gptService.prompts.get("generate-instructed") \
                 + prompt
 
-        return JsonResponse({
-                "response": self.gptService.sendMessage(id, prompt)
-            }, status=status.HTTP_200_OK)
+        return self.gptService.sendMessage(id, prompt)
+
+    def prepareFiles(self, id: str) -> None:
+        """Загружает файлы окружения в контекст модели, если они еще не загружены"""
+        chat = self.gptService.getConversation(id)
+        
+        if (chat.commited == False):
+            # raise Exception("files not commited")
+            self.commitFiles(id)
 
     def sendPrompt(self, id: str, prompt: str) -> JsonResponse:
         """Отправляет запрос модели"""
-        return JsonResponse({
+        return FastJsonResponse({
                 "response": self.gptService.sendMessage(id, prompt)
             }, status=status.HTTP_200_OK)
 
+    def streamPrompt(self, id: str, prompt: str) -> Iterator[str]:
+        """Отправляет запрос модели и возвращает части ответа по мере генерации"""
+        return self.gptService.streamMessage(id, prompt)
+
+    def fix(self, id: str, fragment: str, index: int = None, prompt: str = '') -> JsonResponse:
+        """Переписывает фрагмент ответа модели, не отправляя ей весь контекст"""
+        return FastJsonResponse({
+                "response": self.gptService.fixFragment(
+                    id, 
+                    fragment, 
+                    index, 
+                    prompt, 
+                    self.getFileExcerpts(id, fragment)
+                )
+            }, status=status.HTTP_200_OK)
+
     def commitFiles(self, id: str) -> JsonResponse:
-        """Загружает файлы окружения в контекст модели, перезаписывая его"""
-        self.gptService.createConversation(id, files=self.getFilesContext(id))
+        """
+        Загружает файлы окружения в контекст модели, перезаписывая его. Возвращает количество токенов,
+        сэкономленных удалением повторяющихся фрагментов файлов
+        """
+        files, saved = self.buildFilesContext(id, consume=True)
+        self.gptService.createConversation(id, files=files)
+        FILES_CONTEXT_DEDUP_SAVED.inc(saved)
+        logger.info("files committed", extra={"environment": id, "files": len(files), "tokensSaved": saved})
+        self.notificationService.publish(id, {"type": "commit", "tokensSaved": saved})
 
-        return JsonResponse({}, status=status.HTTP_200_OK)
+        return FastJsonResponse({"tokensSaved": saved}, status=status.HTTP_200_OK)
 
-    def getChatContext(self, id: str) -> JsonResponse:
-        """Получает контекст модели по идентификатору окружения"""
-        context = [x for x in self.gptService.getConversation(id).messages if x["role"] != "system"]
+    def getChatContext(self, id: str, since: int = 0) -> JsonResponse:
+        """
+        Получает контекст модели по идентификатору окружения. Если указан `since`, возвращаются только сообщения
+        с идентификатором больше `since`, то есть добавленные или исправленные после него. Сжатие истории
+        не меняет идентификаторы оставшихся сообщений. Идентификаторы выдаются процессом, поэтому `since` больше
+        последнего идентификатора чата означает, что чат создан заново (например, после перезапуска),
+        и тогда возвращается вся история
+        """
+        chat: GPTService.Chat = self.gptService.getConversation(id)
+        with chat.lock:
+            history = [x for x in chat.messages if x.role != "system"]
+            if (len(history) and since > max(x.id for x in history)):
+                since = 0
+            context = [
+                {"id": x.id, "role": x.role, "content": x.content} 
+                for x in history if x.id > since
+            ]
+            etag = chat.etag
 
-        return JsonResponse(
+        response = FastJsonResponse(
             context,
             safe=False,
             status=status.HTTP_200_OK
         )
+        response["ETag"] = etag
+        return response
+
+    def getChatVersion(self, id: str) -> str:
+        """Возвращает ETag истории сообщений, не собирая ее"""
+        return self.gptService.getConversation(id).etag
 
     def clearChatContext(self, id: str) -> JsonResponse:
         """Очищает контекст модели"""
         self.gptService.clearContext(id)
 
-        return JsonResponse({}, status=status.HTTP_200_OK)
+        return FastJsonResponse({}, status=status.HTTP_200_OK)
 
-    def getFilesContext(self, id: str) -> List[Dict[str, str]]:
+    def getFilesContext(self, id: str) -> List[FileBlock]:
         """Получаем содержание файлов"""
-        context=[]
-        for filename in self.fileService.listFiles(id):
-            context.append({
-                    "role": "system",
-                    "content": f"This is the content of file {filename}: " \
-                        + self.fileService.readFile(id, filename)
-                })
-        return context
\ No newline at end of file
+        return self.buildFilesContext(id)[0]
+
+    def buildFilesContext(self, id: str, consume: bool = False) -> tuple[List[FileBlock], int]:
+        """
+        Возвращает блоки контекста файлов и количество токенов, сэкономленных удалением повторов.
+        Если `consume`, собранный в фоне контекст удаляется из памяти: после загрузки в чат он больше не нужен
+        """
+        # Фоновая сборка уже читает файлы, повторно читать их не нужно
+        pending = BackgroundWorker().getPending(("prebuild", id))
+        if (pending is not None):
+            pending.exception()
+
+        with self.prebuiltLock:
+            prebuilt = self.prebuilt.pop(id, None) if consume else self.prebuilt.get(id, None)
+            if (prebuilt is not None and consume == False):
+                self.prebuilt.move_to_end(id)
+        if (prebuilt is not None):
+            if (prebuilt[0] == self.fileService.version(id)):
+                FILES_CONTEXT_PREBUILT.labels(result="hit").inc()
+                return list(prebuilt[1]), prebuilt[2]
+            FILES_CONTEXT_PREBUILT.labels(result="miss").inc()
+            # Устаревший контекст будет собран заново после следующего изменения файлов
+            self.__dropPrebuilt(id, prebuilt)
+
+        context, _, saved = self.readFilesContext(id)
+        return context, saved
+
+    def readFilesContext(self, id: str) -> tuple[List[FileBlock], int, int]:
+        """
+        Читает файлы окружения и возвращает блоки контекста, оценку количества токенов в них и количество токенов,
+        сэкономленных заменой повторяющихся и почти совпадающих фрагментов ссылками на первое вхождение
+        """
+        files = []
+        updated = []
+        size = 0
+        tokens = 0
+        with span("files_context"):
+            for x in self.fileService.listFilesStat(id):
+                files.append((x["filename"], self.fileService.readFile(id, x["filename"])))
+                updated.append(x["updatedAt"])
+                size += x["size"]
+                tokens += x["tokens"] or 0
+        FILES_READ_BYTES.observe(size)
+
+        saved = 0
+        if (settings.CONTEXT_DEDUP):
+            # Первое вхождение остается в последнем измененном файле, например в новой версии документа
+            order = sorted(range(len(files)), key=lambda k: -updated[k])
+            with span("files_dedup"):
+                texts, chars = deduplicate([files[k] for k in order], settings.CONTEXT_DEDUP_THRESHOLD, settings.CONTEXT_DEDUP_CHUNK)
+            for k, text in zip(order, texts):
+                files[k] = (files[k][0], text)
+            # Около 4 символов на токен, как в оценке токенов файлов
+            saved = max(chars // 4, 0)
+
+        # Файлы с одинаковым содержимым хранятся в памяти один раз для всех чатов
+        context = [FileBlock.intern(name, text) for name, text in files]
+        return context, tokens - saved, saved
+
+    def scheduleFilesContext(self, id: str) -> None:
+        """Планирует сборку контекста файлов окружения после того, как файлы перестанут меняться"""
+        if (settings.CONTEXT_PREBUILD):
+            BackgroundWorker().debounce(settings.CONTEXT_PREBUILD_DELAY, self.prebuildFilesContext, id, key=("prebuild", id))
+
+    def prebuildFilesContext(self, id: str) -> None:
+        """Собирает контекст файлов окружения заранее, чтобы `commitFiles` только подставил готовые блоки"""
+        # Версия берется до чтения, поэтому изменения во время чтения сделают результат неактуальным
+        try:
+            version = self.fileService.version(id)
+            context, tokens, saved = self.readFilesContext(id)
+        except FileNotFoundError:
+            # Окружение удалено до начала сборки
+            return
+        with self.prebuiltLock:
+            self.prebuilt[id] = (version, context, saved)
+            self.prebuilt.move_to_end(id)
+            while (len(self.prebuilt) > settings.CONTEXT_PREBUILD_MAX):
+                self.prebuilt.popitem(last=False)
+        logger.info("files context prebuilt", extra={"environment": id, "files": len(context), "tokens": tokens, "tokensSaved": saved})
+
+    def __dropPrebuilt(self, id: str, prebuilt: tuple = None) -> None:
+        """Удаляет собранный в фоне контекст окружения, если указан `prebuilt` - только если он еще не заменен"""
+        with self.prebuiltLock:
+            if (prebuilt is None or self.prebuilt.get(id, None) is prebuilt):
+                self.prebuilt.pop(id, None)
+
+    def getFileExcerpts(self, id: str, fragment: str) -> List[str]:
+        """Получаем строки файлов, в которых больше всего слов из `fragment`"""
+        chat = self.gptService.getConversation(id)
+        if (chat.commited):
+            files = [x for x in chat.messages if isinstance(x, FileBlock)]
+        else:
+            files = self.getFilesContext(id)
+
+        words = set(re.findall(r"\w{4,}", fragment.lower()))
+        if (len(words) == 0):
+            return []
+
+        lines = []
+        for x in files:
+            filename, content = x.filename, x.text
+            for number, line in enumerate(content.split("\n"), start=1):
+                score = len(words.intersection(re.findall(r"\w{4,}", line.lower())))
+                if (score):
+                    lines.append((score, f"{filename}, line {number}: {line.strip()[:300]}"))
+
+        lines.sort(key=lambda x: x[0], reverse=True)
+        return [x[1] for x in lines[:settings.FIX_EXCERPT_LINES]]
@@ -0,0 +1,24 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import tokenCacheKey
+from .models import Environment
+from .services import AccessService
+
+# Create your signal handlers here.
+
+@receiver([post_save, post_delete], sender=Environment)
+def forgetEnvironment(sender, instance: Environment, **kwargs):
+    AccessService().forgetEnvironment(str(instance.pk))
+
+@receiver([post_save, post_delete], sender=Token)
+def forgetToken(sender, instance: Token, **kwargs):
+    cache.delete(tokenCacheKey(instance.key))
+
+@receiver(post_save, sender=User)
+def forgetUserTokens(sender, instance: User, **kwargs):
+    # Пользователь мог быть деактивирован, а закэшированный токен содержит его копию
+    cache.delete_many([tokenCacheKey(x) for x in Token.objects.filter(user=instance).values_list("key", flat=True)])
@@ -1,3 +1,764 @@
-from django.test import TestCase
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .authentication import tokenCacheKey
+from .chats import Message
+from .connections import GPTConnection
+from .dedup import MIN_CHUNK, clusters
+from .managers import LocalFileManager
+from .models import Environment, StorageUsage
+from .services import AccessService, EnvironmentService, FileService, GPTService, UsageService
+from .workers import BackgroundWorker
 
 # Create your tests here.
+
+def fakeModel(test: TestCase) -> None:
+    """Подменяет клиент модели на время теста: запросы к модели обрабатывает метод `create` теста"""
+    connection = GPTConnection()
+    test.addCleanup(setattr, connection, "_client", connection._client)
+    # Использование токенов записывается в базу данных в фоне, после отката транзакции теста его некуда записать
+    test.addCleanup(UsageService().buffer.clear)
+    connection._client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=test))
+
+def completion(text: str, tokens: int):
+    """Ответ модели с текстом `text` и размером контекста `tokens`"""
+    return types.SimpleNamespace(
+        usage=types.SimpleNamespace(total_tokens=tokens, prompt_tokens=tokens, completion_tokens=0, prompt_tokens_details=None),
+        choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))]
+    )
+
+@override_settings(CONTEXT_PREBUILD=False, STORAGE_GC_INTERVAL=0)
+class StorageTestCase(TestCase):
+    """
+    Тесты с окружением пользователя, файлы которого хранятся во временной директории
+    """
+
+    def setUp(self):
+        # Владельцы окружений и токены кэшируются, а идентификаторы повторяются после отката транзакции теста
+        cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+
+        self.fileService = FileService()
+        self.addCleanup(setattr, self.fileService, "fileManager", self.fileService.fileManager)
+        self.fileService.fileManager = LocalFileManager(basePath=directory, fsync=False)
+
+        self.user = User.objects.create(username="user")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=self.user).key}")
+        response = self.client.post("/api/v1/environments/", {"name": "environment", "user": self.user.id}, format="json")
+        self.id = str(response.json()["id"])
+        self.url = f"/api/v1/environments/{self.id}"
+
+    def usage(self) -> tuple:
+        """Счетчики объема и количества файлов окружения и пользователя"""
+        environment = Environment.objects.values_list("storageBytes", "storageFiles").get(id=int(self.id))
+        user = StorageUsage.objects.filter(user=self.user).values_list("bytes", "files").first()
+        return environment, tuple(user or (0, 0))
+
+    def loadFile(self, name: str, data: bytes, action: str = "load-file"):
+        return self.client.post(f"{self.url}/{action}/", {"file": SimpleUploadedFile(name, data)})
+
+class UploadTests(StorageTestCase):
+    """Загрузка файлов по частям"""
+
+    def createUpload(self, name: str, size: int) -> str:
+        response = self.client.post(f"{self.url}/uploads/", {"filename": name, "size": size}, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()["upload"]
+
+    def writeUpload(self, upload: str, offset: int, data: bytes):
+        return self.client.generic(
+            "PUT", f"{self.url}/uploads/{upload}/?offset={offset}", data, content_type="application/octet-stream"
+        )
+
+    def finalize(self, upload: str, data: bytes):
+        checksum = hashlib.sha256(data).hexdigest()
+        return self.client.post(f"{self.url}/uploads/{upload}/finalize/", {"checksum": checksum}, format="json")
+
+    def test_upload(self):
+        upload = self.createUpload("a.txt", 10)
+        self.assertEqual(self.writeUpload(upload, 0, b"01234").json()["offset"], 5)
+        self.assertEqual(self.writeUpload(upload, 5, b"56789").json()["offset"], 10)
+
+        response = self.finalize(upload, b"0123456789")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["size"], 10)
+        self.assertEqual(self.fileService.readFile(self.id, "a.txt"), "0123456789")
+        self.assertEqual(self.usage(), ((10, 1), (10, 1)))
+
+    def test_wrong_offset(self):
+        upload = self.createUpload("a.txt", 10)
+        response = self.writeUpload(upload, 5, b"56789")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 0)
+
+        # Повторно отправленная часть не записывается дважды
+        self.writeUpload(upload, 0, b"01234")
+        response = self.writeUpload(upload, 0, b"01234")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 5)
+
+    def test_incomplete_upload(self):
+        upload = self.createUpload("a.txt", 10)
+        self.writeUpload(upload, 0, b"01234")
+        response = self.finalize(upload, b"01234")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 5)
+
+    def test_oversized_chunk(self):
+        upload = self.createUpload("a.txt", 4)
+        self.writeUpload(upload, 0, b"01")
+        response = self.writeUpload(upload, 2, b"2345")
+        self.assertEqual(response.status_code, 400)
+
+        # Часть, выходящая за объявленный размер, не записывается даже частично
+        self.assertEqual(self.client.get(f"{self.url}/uploads/{upload}/").json()["offset"], 2)
+        self.assertEqual(self.writeUpload(upload, 2, b"23").json()["offset"], 4)
+
+    def test_checksum_mismatch(self):
+        upload = self.createUpload("a.txt", 3)
+        self.writeUpload(upload, 0, b"abc")
+        response = self.finalize(upload, b"abd")
+        self.assertEqual(response.status_code, 422)
+
+        # Загрузка удаляется, а занятое ей место освобождается
+        self.assertEqual(self.client.get(f"{self.url}/uploads/{upload}/").status_code, 404)
+        self.assertFalse(self.fileService.exists(self.id, "a.txt"))
+        self.assertEqual(self.usage(), ((0, 0), (0, 0)))
+
+    def test_replace_file(self):
+        self.loadFile("a.txt", b"x" * 100)
+        upload = self.createUpload("a.txt", 3)
+        self.assertEqual(self.usage(), ((103, 2), (103, 2)))
+
+        self.writeUpload(upload, 0, b"abc")
+        self.finalize(upload, b"abc")
+        self.assertEqual(self.usage(), ((3, 1), (3, 1)))
+
+    def test_remove_upload(self):
+        upload = self.createUpload("a.txt", 10)
+        self.writeUpload(upload, 0, b"012")
+        self.assertEqual(self.client.delete(f"{self.url}/uploads/{upload}/").status_code, 200)
+        self.assertEqual(self.client.get(f"{self.url}/uploads/{upload}/").status_code, 404)
+        self.assertEqual(self.usage(), ((0, 0), (0, 0)))
+
+    def test_expire_uploads(self):
+        upload = self.createUpload("a.txt", 10)
+        self.writeUpload(upload, 0, b"012")
+        self.assertEqual(self.usage(), ((10, 1), (10, 1)))
+
+        self.assertEqual(self.fileService.expireUploads(3600), 0)
+        self.assertEqual(self.fileService.expireUploads(-1), 1)
+        self.assertEqual(self.client.get(f"{self.url}/uploads/{upload}/").status_code, 404)
+        self.assertEqual(self.usage(), ((0, 0), (0, 0)))
+
+class StorageQuotaTests(StorageTestCase):
+    """Учет объема файлов и квоты хранилища"""
+
+    def test_accounting(self):
+        self.loadFile("a.txt", b"x" * 100)
+        self.loadFile("b.txt", b"x" * 50)
+        self.assertEqual(self.usage(), ((150, 2), (150, 2)))
+
+        # Замена файла учитывает только разницу размеров, дозапись - дописанные байты
+        self.loadFile("a.txt", b"x" * 30)
+        self.assertEqual(self.usage(), ((80, 2), (80, 2)))
+        response = self.loadFile("b.txt", b"y" * 20, "update-file")
+        self.assertEqual(response.json()["size"], 70)
+        self.assertEqual(self.usage(), ((100, 2), (100, 2)))
+
+        self.client.delete(f"{self.url}/remove-file/", {"filename": "b.txt"}, format="json")
+        self.assertEqual(self.usage(), ((30, 1), (30, 1)))
+
+    @override_settings(STORAGE_QUOTA_ENVIRONMENT_BYTES=100)
+    def test_environment_quota(self):
+        self.assertEqual(self.loadFile("a.txt", b"x" * 80).status_code, 201)
+        self.assertEqual(self.loadFile("b.txt", b"x" * 50).status_code, 413)
+        self.assertEqual(self.loadFile("a.txt", b"x" * 30, "update-file").status_code, 413)
+
+        # Отклоненный файл не записывается и не учитывается
+        self.assertFalse(self.fileService.exists(self.id, "b.txt"))
+        self.assertEqual(self.usage(), ((80, 1), (80, 1)))
+
+        # Замена файла учитывает только разницу размеров
+        self.assertEqual(self.loadFile("a.txt", b"x" * 100).status_code, 201)
+        self.assertEqual(self.usage(), ((100, 1), (100, 1)))
+
+    @override_settings(STORAGE_QUOTA_USER_FILES=1)
+    def test_user_quota(self):
+        self.assertEqual(self.loadFile("a.txt", b"x").status_code, 201)
+        self.assertEqual(self.loadFile("b.txt", b"x").status_code, 413)
+        # Дозапись в существующий файл не добавляет файлов
+        self.assertEqual(self.loadFile("a.txt", b"x", "update-file").status_code, 200)
+        self.assertEqual(self.usage(), ((2, 1), (2, 1)))
+
+    @override_settings(STORAGE_QUOTA_ENVIRONMENT_BYTES=100)
+    def test_upload_reservation(self):
+        response = self.client.post(f"{self.url}/uploads/", {"filename": "a.txt", "size": 80}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.loadFile("b.txt", b"x" * 50).status_code, 413)
+
+        self.client.delete(f"{self.url}/uploads/{response.json()['upload']}/")
+        self.assertEqual(self.loadFile("b.txt", b"x" * 50).status_code, 201)
+
+    def test_rollback(self):
+        self.loadFile("a.txt", b"x" * 100)
+        with mock.patch.object(LocalFileManager, "saveFileByChunks", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.fileService.saveFile(self.id, SimpleUploadedFile("b.txt", b"x" * 50), "b.txt")
+        with mock.patch.object(LocalFileManager, "appendFileByChunks", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.fileService.appendFile(self.id, "x" * 50, "a.txt")
+        with mock.patch.object(LocalFileManager, "createUpload", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.fileService.createUpload(self.id, "c.txt", 50)
+        self.assertEqual(self.usage(), ((100, 1), (100, 1)))
+
+    def test_size_from_stat(self):
+        self.loadFile("a.txt", b"x" * 100)
+        os.remove(self.fileService.fileManager.makePath(self.id, f"{LocalFileManager.metaPrefix}a.txt"))
+
+        # Размер заменяемого или удаляемого файла берется из stat, метаданные по содержимому не вычисляются
+        with mock.patch.object(LocalFileManager, "readMeta", side_effect=AssertionError("file contents read")):
+            self.fileService.saveFile(self.id, SimpleUploadedFile("a.txt", b"x" * 30), "a.txt")
+            self.assertEqual(self.usage(), ((30, 1), (30, 1)))
+            self.fileService.removeFile(self.id, "a.txt")
+            self.assertEqual(self.usage(), ((0, 0), (0, 0)))
+
+class AccessCacheTests(StorageTestCase):
+    """Сброс кэша владельцев окружений и пользователей токенов"""
+
+    def test_owner_delete(self):
+        self.assertEqual(AccessService().ownerOf(self.id), self.user.id)
+        self.assertEqual(self.client.delete(f"{self.url}/").status_code, 204)
+        self.assertIsNone(AccessService().ownerOf(self.id))
+
+    def test_owner_transfer(self):
+        other = User.objects.create(username="other")
+        self.assertEqual(AccessService().ownerOf(self.id), self.user.id)
+        response = self.client.patch(f"{self.url}/", {"user": other.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AccessService().ownerOf(self.id), other.id)
+
+    def test_token_logout(self):
+        token = Token.objects.get(user=self.user)
+        self.assertEqual(self.client.get("/api/v1/environments/").status_code, 200)
+        self.assertIsNotNone(cache.get(tokenCacheKey(token.key)))
+
+        # Удаленный токен перестает действовать сразу, а не после истечения кэша
+        token.delete()
+        self.assertIsNone(cache.get(tokenCacheKey(token.key)))
+        self.assertEqual(self.client.get("/api/v1/environments/").status_code, 401)
+
+    def test_token_user_deactivated(self):
+        self.assertEqual(self.client.get("/api/v1/environments/").status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get("/api/v1/environments/").status_code, 401)
+
+class EnvironmentListTests(StorageTestCase):
+    """Список окружений"""
+
+    def environments(self, client: APIClient = None, **params) -> dict:
+        response = (client or self.client).get("/api/v1/environments/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_scoping(self):
+        other = User.objects.create(username="other")
+        environment = Environment.objects.create(name="other", user=other)
+        self.assertEqual([x["id"] for x in self.environments()["results"]], [int(self.id)])
+        # Обычный пользователь не может выбрать чужие окружения
+        self.assertEqual(self.environments(user=other.id)["results"], [])
+
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual({x["id"] for x in self.environments()["results"]}, {int(self.id), environment.id})
+        self.assertEqual([x["id"] for x in self.environments(user=other.id)["results"]], [environment.id])
+
+    def test_anonymous(self):
+        self.assertEqual(self.environments(APIClient())["results"], [])
+
+    def test_pagination(self):
+        for i in range(4):
+            Environment.objects.create(name=f"environment {i}", user=self.user)
+        # Окружения с одинаковым временем изменения упорядочиваются по id
+        moment = timezone.now()
+        ids = list(Environment.objects.order_by("id").values_list("id", flat=True))
+        Environment.objects.filter(id__in=ids[:3]).update(editedAt=moment)
+        Environment.objects.filter(id__in=ids[3:]).update(editedAt=moment - timedelta(minutes=1))
+
+        results = []
+        page = self.environments(limit=2)
+        while True:
+            results += [x["id"] for x in page["results"]]
+            if (page["next"] is None):
+                break
+            page = self.client.get(page["next"]).json()
+        self.assertEqual(results, ids[2::-1] + ids[:2:-1])
+
+class ReconcileTests(StorageTestCase):
+    """Сверка директорий и чатов с таблицей окружений"""
+
+    def setUp(self):
+        super().setUp()
+        self.service = EnvironmentService()
+        self.addCleanup(self.service.orphans.clear)
+        self.service.orphans.clear()
+        self.manager = self.fileService.fileManager
+
+    def trash(self) -> list:
+        path = f"{self.manager.basePath}/{self.manager.trashDir}"
+        return os.listdir(path) if os.path.isdir(path) else []
+
+    def test_orphans(self):
+        self.manager.makeDir("999")
+        GPTService().createConversation("998")
+        self.addCleanup(GPTService().closeConversation, "998")
+
+        # Директория без окружения удаляется только при второй сверке: окружение могло создаваться во время первой
+        self.service.collectGarbage()
+        self.assertTrue(self.manager.exists("999"))
+        self.assertIn("998", GPTService().conversations)
+
+        self.service.collectGarbage()
+        self.assertFalse(self.manager.exists("999"))
+        self.assertNotIn("998", GPTService().conversations)
+        self.assertEqual(self.trash(), [])
+        self.assertTrue(self.manager.exists(self.id))
+        self.assertIn(self.id, GPTService().conversations)
+
+    def test_created_between(self):
+        self.manager.makeDir("999")
+        self.service.collectGarbage()
+        Environment.objects.create(id=999, name="created", user=self.user)
+        self.service.collectGarbage()
+        self.assertTrue(self.manager.exists("999"))
+
+    def test_removed(self):
+        self.loadFile("a.txt", b"hello")
+        # Корзину очищает сверка, а не фоновая задача, запланированная запросом
+        with mock.patch.object(BackgroundWorker(), "submit"):
+            self.assertEqual(self.client.delete(f"{self.url}/").status_code, 204)
+        self.assertEqual(len(self.trash()), 1)
+        # Директория сразу переносится в корзину, а чат освобождается
+        self.assertFalse(self.manager.exists(self.id))
+        self.assertNotIn(self.id, GPTService().conversations)
+
+        self.service.collectGarbage()
+        self.assertEqual(self.trash(), [])
+
+    def test_deleted_row(self):
+        # Окружение удалено из базы данных в обход API, например другим процессом
+        self.service.prebuildFilesContext(self.id)
+        Environment.objects.filter(id=int(self.id)).delete()
+        self.service.collectGarbage()
+        self.service.collectGarbage()
+        self.assertFalse(self.manager.exists(self.id))
+        self.assertNotIn(self.id, GPTService().conversations)
+        self.assertNotIn(self.id, self.service.prebuilt)
+        self.assertEqual(self.trash(), [])
+
+class CloneTests(StorageTestCase):
+    """Копирование окружения"""
+
+    def clone(self) -> dict:
+        response = self.client.post(f"{self.url}/clone/", {"name": "clone"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_usage(self):
+        self.loadFile("a.txt", b"x" * 100)
+        clone = self.clone()
+        # Ответ содержит объем копии, учтенный при копировании файлов
+        self.assertEqual((clone["storageBytes"], clone["storageFiles"]), (100, 1))
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes, 200)
+
+    def test_append_source(self):
+        self.loadFile("a.txt", b"hello")
+        clone = str(self.clone()["id"])
+        source = os.stat(self.fileService.fileManager.makePath(self.id, "a.txt"))
+        self.assertGreater(source.st_nlink, 1)
+
+        # Файл, связанный с копией, дописывается в собственную копию файла
+        response = self.loadFile("a.txt", b" world", "update-file")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.fileService.readFile(self.id, "a.txt"), "hello world")
+        self.assertEqual(self.fileService.readFile(clone, "a.txt"), "hello")
+        self.assertEqual(os.stat(self.fileService.fileManager.makePath(clone, "a.txt")).st_nlink, 1)
+
+@override_settings(CONTEXT_PREBUILD_MAX=2)
+class PrebuildTests(StorageTestCase):
+    """Контекст файлов, собранный в фоне"""
+
+    def setUp(self):
+        super().setUp()
+        self.service = EnvironmentService()
+        self.addCleanup(self.service.prebuilt.clear)
+        self.service.prebuilt.clear()
+
+    def createEnvironment(self) -> str:
+        response = self.client.post("/api/v1/environments/", {"name": "environment", "user": self.user.id}, format="json")
+        return str(response.json()["id"])
+
+    def test_eviction(self):
+        ids = [self.id, self.createEnvironment(), self.createEnvironment()]
+        for id in ids[:2]:
+            self.service.prebuildFilesContext(id)
+        # Обращение к контексту делает окружение последним использованным
+        self.service.buildFilesContext(ids[0])
+        self.service.prebuildFilesContext(ids[2])
+        self.assertEqual(list(self.service.prebuilt), [ids[0], ids[2]])
+
+        self.service.buildFilesContext(ids[0], consume=True)
+        self.assertEqual(list(self.service.prebuilt), [ids[2]])
+
+    def test_stale(self):
+        self.loadFile("a.txt", b"first")
+        self.service.prebuildFilesContext(self.id)
+        self.assertIn(self.id, self.service.prebuilt)
+
+        self.loadFile("b.txt", b"second")
+        context, _ = self.service.buildFilesContext(self.id)
+        self.assertEqual(sorted(x.filename for x in context), ["a.txt", "b.txt"])
+        self.assertNotIn(self.id, self.service.prebuilt)
+
+class ChatContextTests(StorageTestCase):
+    """История сообщений чата"""
+
+    def setUp(self):
+        super().setUp()
+        fakeModel(self)
+
+    def create(self, model, messages, **kwargs):
+        return completion(f"answer: {messages[-1]['content']}", 10)
+
+    def context(self, **headers):
+        return self.client.get(f"{self.url}/get-context/", **headers)
+
+    def test_not_modified(self):
+        GPTService().sendMessage(self.id, "first")
+        response = self.context()
+        self.assertEqual([x["content"] for x in response.json()], ["first", "answer: first"])
+
+        etag = response["ETag"]
+        response = self.context(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        GPTService().sendMessage(self.id, "second")
+        response = self.context(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_since(self):
+        GPTService().sendMessage(self.id, "first")
+        last = self.context().json()[-1]["id"]
+        GPTService().sendMessage(self.id, "second")
+
+        response = self.client.get(f"{self.url}/get-context/", {"since": last})
+        self.assertEqual([x["content"] for x in response.json()], ["second", "answer: second"])
+        response = self.client.get(f"{self.url}/get-context/", {"since": response.json()[-1]["id"]})
+        self.assertEqual(response.json(), [])
+
+        response = self.client.get(f"{self.url}/get-context/", {"since": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_since_recreated(self):
+        # После перезапуска процесса идентификаторы сообщений начинаются заново, и полученный ранее идентификатор
+        # больше всех идентификаторов нового чата, поэтому возвращается вся история
+        GPTService().sendMessage(self.id, "first")
+        last = self.context().json()[-1]["id"]
+        with mock.patch.object(Message, "ids", itertools.count(1)):
+            GPTService().createConversation(self.id)
+            GPTService().sendMessage(self.id, "second")
+
+        response = self.client.get(f"{self.url}/get-context/", {"since": last})
+        self.assertEqual([x["content"] for x in response.json()], ["second", "answer: second"])
+
+class GenerateBatchTests(StorageTestCase):
+    """Генерация для нескольких окружений"""
+
+    def setUp(self):
+        super().setUp()
+        fakeModel(self)
+
+    def create(self, model, messages, **kwargs):
+        if (messages[-1]["content"].endswith("fail")):
+            raise Exception("model is unavailable")
+        return completion(f"answer: {messages[-1]['content'].split()[-1]}", 10)
+
+    def generate(self, items: list) -> list:
+        # Потоки генерации используют свои соединения с базой данных и не видят данные незавершенной транзакции теста,
+        # поэтому владельцы окружений заранее попадают в кэш
+        for x in items:
+            AccessService().ownerOf(str(x["id"]))
+        response = self.client.post("/api/v1/environments/generate-batch/", {"items": items}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        return [json.loads(x) for x in b"".join(response.streaming_content).splitlines()]
+
+    def test_order(self):
+        other = self.client.post("/api/v1/environments/", {"name": "other", "user": self.user.id}, format="json").json()["id"]
+        id = int(self.id)
+        results = self.generate([
+            {"id": id, "prompt": "first"},
+            {"id": other, "prompt": "other"},
+            {"id": 999, "prompt": "missing"},
+            {"id": id, "prompt": "second"},
+        ])
+
+        # Ненайденные окружения возвращаются сразу, запросы к одному окружению выполняются в порядке запроса
+        self.assertEqual(results[0], {"id": 999, "detail": "Not found."})
+        self.assertEqual(len(results), 4)
+        self.assertEqual([x["response"] for x in results if x["id"] == id], ["answer: first", "answer: second"])
+        self.assertEqual([x["response"] for x in results if x["id"] == other], ["answer: other"])
+
+    def test_errors(self):
+        id = int(self.id)
+        results = self.generate([{"id": id, "prompt": "fail"}, {"id": id, "prompt": "second"}])
+
+        # Ошибка одного запроса возвращается в его строке и не прерывает остальные
+        self.assertEqual(results, [
+            {"id": id, "detail": "model is unavailable"},
+            {"id": id, "response": "answer: second"},
+        ])
+
+class WorkerTests(SimpleTestCase):
+    """Фоновые задачи"""
+
+    def test_debounce_after_shutdown(self):
+        worker = BackgroundWorker()
+        executor = ThreadPoolExecutor(max_workers=1)
+        executor.shutdown()
+        errors = []
+        with mock.patch.object(worker, "executor", executor), mock.patch("threading.excepthook", errors.append):
+            worker.debounce(0.05, print, key="shutdown")
+            timer = worker.timers["shutdown"]
+            timer.join()
+        # Таймер, сработавший после остановки пула, не завершается ошибкой
+        self.assertEqual(errors, [])
+        self.assertIsNone(worker.getPending("shutdown"))
+
+class AppendMetaTests(SimpleTestCase):
+    """Метаданные файлов, обновляемые при дозаписи"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.manager = LocalFileManager(basePath=directory, fsync=False)
+        self.manager.makeDir("1")
+
+    def test_append(self):
+        meta = self.manager.appendFileByChunks("1", "a.txt", iter(("привет".encode(), b" world")))
+        self.assertEqual(meta["size"], len("привет world".encode()))
+        self.assertEqual(meta["chars"], len("привет world"))
+        self.assertEqual(meta["tokens"], (len("привет world") + 3) // 4)
+
+        meta = self.manager.appendFileByChunks("1", "a.txt", iter((b"!",)))
+        self.assertEqual(self.manager.readFile("1", "a.txt"), "привет world!")
+        self.assertEqual(meta["size"], len("привет world!".encode()))
+        self.assertEqual(self.manager.readMeta("1", "a.txt"), meta)
+
+    def test_split_character(self):
+        # Многобайтовый символ, разделенный между частями, считается один раз
+        data = "привет".encode()
+        meta = self.manager.appendFileByChunks("1", "a.txt", iter((data[:3], data[3:])))
+        self.assertEqual(meta["chars"], 6)
+
+    def test_matches_saved_file(self):
+        self.manager.appendFileByChunks("1", "a.txt", iter((b"hello ",)))
+        appended = self.manager.appendFileByChunks("1", "a.txt", iter((b"world",)))
+        self.manager.saveFile("1", "b.txt", "hello world")
+        saved = self.manager.readMeta("1", "b.txt")
+        for key in ("size", "chars", "tokens"):
+            self.assertEqual(appended[key], saved[key])
+
+    def test_revision_changes(self):
+        first = self.manager.appendFileByChunks("1", "a.txt", iter((b"hello",)))
+        second = self.manager.appendFileByChunks("1", "a.txt", iter((b" world",)))
+        self.assertNotEqual(first["revision"], second["revision"])
+
+    def test_previous_format(self):
+        self.manager.appendFileByChunks("1", "a.txt", iter((b"hello",)))
+        path = self.manager.makePath("1", f"{self.manager.metaPrefix}a.txt")
+        with open(path, "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        meta["hash"] = meta.pop("revision")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+
+        self.assertIn("revision", self.manager.readMeta("1", "a.txt"))
+        self.assertEqual(self.manager.appendFileByChunks("1", "a.txt", iter((b"!",)))["size"], 6)
+
+    def test_stale_meta(self):
+        self.manager.appendFileByChunks("1", "a.txt", iter((b"hello",)))
+        with open(self.manager.makePath("1", "a.txt"), "ab") as file:
+            file.write(b" world")
+
+        # Метаданные, не соответствующие файлу, вычисляются заново
+        self.assertEqual(self.manager.readMeta("1", "a.txt")["size"], 11)
+        self.assertEqual(self.manager.appendFileByChunks("1", "a.txt", iter((b"!",)))["size"], 12)
+
+    def test_list_stat(self):
+        meta = self.manager.appendFileByChunks("1", "a.txt", iter((b"hello",)))
+        with open(self.manager.makePath("1", "b.txt"), "wb") as file:
+            file.write(b"world")
+
+        # Список файлов не вычисляет метаданные: у файла без них нет оценки токенов и метки версии
+        with mock.patch.object(LocalFileManager, "_LocalFileManager__computeMeta", side_effect=AssertionError("file contents read")):
+            stats = {x["filename"]: x for x in self.manager.listFilesStat("1")}
+        self.assertEqual((stats["a.txt"]["tokens"], stats["a.txt"]["revision"]), (meta["tokens"], meta["revision"]))
+        self.assertEqual((stats["b.txt"]["size"], stats["b.txt"]["tokens"], stats["b.txt"]["revision"]), (5, None, None))
+
+        # Метаданные вычисляются при следующей записи в файл
+        self.manager.appendFileByChunks("1", "b.txt", iter((b"!",)))
+        stats = {x["filename"]: x for x in self.manager.listFilesStat("1")}
+        self.assertEqual(stats["b.txt"]["tokens"], 2)
+        self.assertIsNotNone(stats["b.txt"]["revision"])
+
+class DedupTests(SimpleTestCase):
+    """Поиск повторяющихся фрагментов файлов"""
+
+    def text(self, seed: int, count: int = 400) -> str:
+        return " ".join(f"word{seed}x{i}" for i in range(count))
+
+    def test_exact(self):
+        text = self.text(0)
+        chunks = [text, self.text(1), text, text.replace(" ", " \n", 1) + "  "]
+        self.assertEqual(clusters(chunks, 1), [0, 1, 0, 3])
+        # Пробелы в конце строк не учитываются
+        self.assertEqual(clusters([f"{text}\n", f"{text}  \n"], 1), [0, 0])
+
+    def test_indentation(self):
+        lines = [f"line {i} " + "x" * 20 for i in range(20)]
+        chunks = ["\n".join(lines), "\n".join(f"    {x}" for x in lines)]
+        self.assertGreaterEqual(len(chunks[0]), MIN_CHUNK)
+        self.assertEqual(clusters(chunks, 1), [0, 1])
+
+    def test_short(self):
+        text = "x" * (MIN_CHUNK - 1)
+        self.assertEqual(clusters([text, text], 1), [0, 1])
+
+    def test_similar(self):
+        text = self.text(0)
+        similar = text.replace("word0x200", "changed")
+        chunks = [text, self.text(1), similar]
+        self.assertEqual(clusters(chunks, 1), [0, 1, 2])
+        self.assertEqual(clusters(chunks, 0.8), [0, 1, 0])
+
+    def test_chain(self):
+        # Фрагмент сравнивается с первым фрагментом группы, поэтому цепочка правок не объединяется целиком
+        words = self.text(0).split()
+        chunks = []
+        for i in range(0, 200, 20):
+            chunks.append(" ".join(words[:i] + [f"changed{k}" for k in range(i)] + words[2 * i:]))
+        representatives = clusters(chunks, 0.9)
+        self.assertEqual(representatives[0], 0)
+        self.assertEqual(representatives[-1], len(chunks) - 1)
+
+
+@override_settings(CHAT_KEEP_MESSAGES=4)
+class CompactionTests(TestCase):
+    """
+    Тесты сжатия чата, размер которого превышает лимит токенов
+    """
+
+    id = "compaction"
+
+    def setUp(self):
+        fakeModel(self)
+
+        patcher = mock.patch.object(GPTService, "tokenLimit", 300)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.service = GPTService()
+        self.addCleanup(self.service.closeConversation, self.id)
+        self.service.createConversation(self.id)
+
+        # Ответы модели: размер контекста после ответа, текст краткого содержания и ошибка при сжатии
+        self.tokens = 100
+        self.summary = "summary"
+        self.failing = False
+        self.summaries = 0
+
+    def create(self, model, messages, **kwargs):
+        text = "y" * 100
+        if (messages[-1]["content"] == GPTService.prompts.get("summarize")):
+            self.summaries += 1
+            if (self.failing):
+                raise Exception("model is unavailable")
+            text = self.summary
+        return completion(text, self.tokens)
+
+    def send(self):
+        self.service.sendMessage(self.id, "x" * 100)
+        # Фоновое сжатие, запланированное после ответа, завершается до следующего запроса
+        pending = BackgroundWorker().getPending(("compact", self.id))
+        if (pending is not None):
+            pending.exception()
+
+    def fill(self):
+        """Заполняет чат так, что последний ответ превышает лимит токенов"""
+        self.failing = True
+        for i in range(4):
+            self.send()
+        self.tokens = 350
+        self.send()
+        self.assertGreater(self.service.getConversation(self.id).tokens, GPTService.tokenLimit)
+
+    def test_failed_summary(self):
+        self.fill()
+        chat = self.service.getConversation(self.id)
+
+        # Пока модель не может составить краткое содержание, запросы отклоняются
+        with self.assertRaisesRegex(Exception, "token limit"):
+            self.send()
+
+        self.failing = False
+        self.tokens = 200
+        self.send()
+        self.assertLessEqual(chat.tokens, GPTService.tokenLimit)
+        self.assertIn(chat.summary, chat.messages)
+        self.assertEqual(chat.messages[-1].role, "assistant")
+
+    def test_over_limit(self):
+        self.fill()
+        chat = self.service.getConversation(self.id)
+
+        # Краткое содержание вместе с последними сообщениями все еще превышает лимит
+        self.failing = False
+        self.summary = "s" * 500
+        summaries = self.summaries
+        self.send()
+        self.assertGreater(self.summaries - summaries, 1)
+        self.assertIn(chat.summary, chat.messages)
+        self.assertEqual(chat.messages[-2].content, "x" * 100)
+
+    def test_context_over_limit(self):
+        # Сообщения, которые нельзя сжать, превышают лимит
+        self.failing = False
+        self.tokens = 350
+        self.send()
+        chat = self.service.getConversation(self.id)
+        chat.messages[:] = chat.messages[:len(GPTService.default_context)]
+        with self.assertRaisesRegex(Exception, "token limit"):
+            self.send()
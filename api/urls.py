@@ -6,8 +6,10 @@ from . import views
 router = DefaultRouter()
 router.register(r'users', views.UserViewSet, basename='user')
 router.register(r'environments', views.EnvironmentViewSet, basename='environment')
+router.register(r'profiles', views.ProfileViewSet, basename='profile')
 
 urlpatterns = [
     path('auth/', views.LoginView().as_view()),
+    path('metrics', views.metrics, name='metrics'),
     path('api/v1/', include(router.urls)),
 ]
@@ -1,16 +1,24 @@
-from django.http import JsonResponse, StreamingHttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from rest_framework import status, permissions, views, viewsets, serializers
 from rest_framework.request import HttpRequest
 from rest_framework.response import Response
 from rest_framework.decorators import action, api_view
 from rest_framework.authtoken.models import Token
+from rest_framework.settings import api_settings
 
 from rest_framework.exceptions import (
     APIException, 
-    NotFound
+    AuthenticationFailed,
+    NotFound,
+    ValidationError,
 )
 
-from django.db.models import Manager
+from django.conf import settings
+from django.db.models import Manager, Sum
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_GET
 from django.contrib.auth import authenticate
 
 from drf_spectacular.utils import (
@@ -22,22 +30,38 @@ from drf_spectacular.utils import (
     OpenApiParameter,
 )
 from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.views import SCHEMA_KWARGS, SpectacularAPIView
 
 from http import HTTPMethod
-from typing import List
+from typing import Dict, List
 from functools import wraps
+import hmac
+import threading
 
-from .models import User, Environment
+from .models import User, Environment, StorageUsage, TokenUsage
 from .serializers import (
     UserSerializer, 
     LoginSerializer,
     EnvironmentSerializer, 
+    CloneSerializer,
     FileSerializer,
     FileNameSerializer,
+    UploadSerializer,
+    UploadChunkSerializer,
+    CommitUploadSerializer,
     PromptSerializer,
     GeneratePromptSerializer,
+    FixPromptSerializer,
+    GenerateBatchSerializer,
+    ProfilingSerializer,
 )
-from .services import EnvironmentService
+from .authentication import CachedTokenAuthentication
+from .base import lazy
+from .metrics import exposition
+from .pagination import EnvironmentPagination, UserPagination
+from .profiling import Profiler, span
+from .renderers import dumps
+from .services import AccessService, EnvironmentService, QuotaExceeded, StorageQuotaExceeded, UsageService
 
 # Create your views here.
 
@@ -46,24 +70,37 @@ def serialize(queryset: Manager, serializers: List[type[serializers.Serializer]]
     def decorator(func):
         @wraps(func)
         def wrapper(self: viewsets.ModelViewSet, request: HttpRequest, pk: str, **kwargs):
-            try:
-                obj = self.get_object()
-            except NotFound as e:
+            with span("get_object"):
+                # Владелец кэшируется, поэтому проверка обычно не обращается к базе данных
+                exists = AccessService().exists(pk)
+            if (exists == False):
                 return JsonResponse(
                     {"detail": "Not found."}, 
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            for x in serializers:
-                serializer = x(data=request.data)
-                if (serializer.is_valid() == False):
-                    return JsonResponse(
-                        {"detail": serializer.errors},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
+            with span("validate"):
+                for x in serializers:
+                    serializer = x(data=request.data)
+                    if (serializer.is_valid() == False):
+                        return JsonResponse(
+                            {"detail": serializer.errors},
+                            status=status.HTTP_400_BAD_REQUEST
+                        )
 
             try:
-                return func(self, request, pk, **kwargs)
+                with span(func.__name__):
+                    return func(self, request, pk, **kwargs)
+            except StorageQuotaExceeded as e:
+                return JsonResponse(
+                    {"detail": " ".join(e.args)}, 
+                    status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                )
+            except QuotaExceeded as e:
+                return JsonResponse(
+                    {"detail": " ".join(e.args)}, 
+                    status=status.HTTP_429_TOO_MANY_REQUESTS
+                )
             except Exception as e:
                 return JsonResponse(
                     {"detail": " ".join(e.args)}, 
@@ -72,6 +109,82 @@ def serialize(queryset: Manager, serializers: List[type[serializers.Serializer]]
         return wrapper
     return decorator
 
+# Состояние загрузки по частям в ответах API
+UPLOAD_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "upload": {"type": "string"},
+        "filename": {"type": "string"},
+        "size": {"type": "integer", "format": "int64"},
+        "offset": {"type": "integer", "format": "int64"},
+        "updatedAt": {"type": "integer"},
+        "expiresAt": {"type": "integer"},
+    }
+}
+
+def notModified(request: HttpRequest, etag: str) -> HttpResponse | None:
+    """Возвращает ответ 304, если `etag` совпадает с заголовком If-None-Match запроса"""
+    response = get_conditional_response(request, etag=etag)
+    if (response is not None):
+        response["ETag"] = etag
+    return response
+
+def canReadMetrics(request: HttpRequest) -> bool:
+    """Метрики доступны по заголовку `Authorization: Bearer <METRICS_TOKEN>` или администраторам"""
+    if (settings.METRICS_TOKEN and hmac.compare_digest(
+            request.headers.get("Authorization", "").encode(), f"Bearer {settings.METRICS_TOKEN}".encode())):
+        return True
+    user = getattr(request, "user", None)
+    if (user is None or user.is_authenticated == False):
+        try:
+            result = CachedTokenAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+        user = result[0] if result else None
+    return user is not None and user.is_staff
+
+@require_GET
+def metrics(request: HttpRequest) -> HttpResponse:
+    """Метрики в формате Prometheus"""
+    if (canReadMetrics(request) == False):
+        return JsonResponse({"detail": "Forbidden."}, status=status.HTTP_403_FORBIDDEN)
+    return HttpResponse(exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+class SchemaView(SpectacularAPIView):
+    """
+    Схема OpenAPI. Схема не меняется до следующего развертывания, поэтому она генерируется и сериализуется
+    один раз на процесс для каждого формата, версии и языка, а затем отдается из памяти. Схемы для языков
+    не из LANGUAGES и версий не из ALLOWED_VERSIONS не кэшируются, чтобы параметры запроса не заполняли память
+    """
+
+    schemas: Dict[tuple, HttpResponse] = {}
+    lock = threading.Lock()
+
+    @extend_schema(**SCHEMA_KWARGS)
+    def get(self, request, *args, **kwargs):
+        version = self.api_version or request.version or self._get_version_parameter(request)
+        lang = request.GET.get("lang") or None
+        if ((lang is not None and lang not in dict(settings.LANGUAGES))
+                or (version is not None and version != self.api_version and version not in (api_settings.ALLOWED_VERSIONS or ()))):
+            return super().get(request, *args, **kwargs)
+
+        key = (request.accepted_renderer.format, version, lang)
+        cached = self.schemas.get(key, None)
+        if (cached is None):
+            with self.lock:
+                cached = self.schemas.get(key, None)
+                if (cached is None):
+                    response = super().get(request, *args, **kwargs)
+                    response.accepted_renderer = request.accepted_renderer
+                    response.accepted_media_type = request.accepted_media_type
+                    response.renderer_context = self.get_renderer_context()
+                    response.render()
+                    cached = self.schemas[key] = response
+
+        result = HttpResponse(cached.content, content_type=cached["Content-Type"])
+        result["Content-Disposition"] = cached["Content-Disposition"]
+        return result
+
 @extend_schema_view(
     post=extend_schema(
         summary="Авторизация",
@@ -131,16 +244,145 @@ class LoginView(views.APIView):
         
         return Response({"detail": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
 
+@extend_schema(tags=["Profiling"])
+@extend_schema_view(
+    list=extend_schema(
+        summary="Получить список профилей медленных запросов",
+        description="Возвращает последние сохраненные профили: действие, длительность и интервалы обработки (получение окружения, чтение файлов, запрос к модели).",
+    ),
+    retrieve=extend_schema(
+        summary="Скачать профиль запроса",
+        description="Возвращает статистику cProfile в формате pstats, например для snakeviz или python -m pstats.",
+        responses={(200, "application/octet-stream"): OpenApiTypes.BINARY},
+    ),
+    configure=extend_schema(
+        summary="Изменить параметры профилирования",
+        description="Изменяет долю случайно профилируемых запросов и порог медленного запроса в текущем процессе.",
+        request=ProfilingSerializer,
+        responses={200: ProfilingSerializer},
+    ),
+)
+class ProfileViewSet(viewsets.ViewSet):
+    permission_classes = [permissions.IsAdminUser]
+
+    def list(self, request: HttpRequest) -> Response:
+        return Response([x.summary() for x in Profiler().list()])
+
+    def retrieve(self, request: HttpRequest, pk: str) -> HttpResponse:
+        profile = Profiler().get(pk)
+        if (profile is None):
+            return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        response = HttpResponse(profile.stats, content_type="application/octet-stream")
+        response["Content-Disposition"] = f'attachment; filename="{profile.id}.prof"'
+        return response
+
+    @action(url_path="configure", detail=False, methods=[HTTPMethod.POST])
+    def configure(self, request: HttpRequest) -> Response:
+        serializer = ProfilingSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        profiler = Profiler()
+        slow = serializer.validated_data.get("slowMs", None)
+        profiler.configure(
+            serializer.validated_data.get("sampleRate", None),
+            slow / 1000 if slow is not None else None
+        )
+        return Response({"sampleRate": profiler.sampleRate, "slowMs": profiler.slow * 1000})
+
 @extend_schema(tags=["Users"])
+@extend_schema_view(
+    usage=extend_schema(
+        summary="Получить использование токенов и хранилища пользователем",
+        description="Возвращает количество токенов за текущие день и месяц, квоты (0 - без ограничений), использование по окружениям за месяц, "
+                    "а также объем и количество файлов во всех окружениях пользователя с квотами хранилища.",
+        request=None,
+        responses={
+            200: OpenApiResponse(
+                response={
+                    "type": "object",
+                    "properties": {
+                        "day": {"type": "integer"},
+                        "month": {"type": "integer"},
+                        "dailyQuota": {"type": "integer"},
+                        "monthlyQuota": {"type": "integer"},
+                        "environments": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "environment": {"type": "integer", "nullable": True},
+                                    "promptTokens": {"type": "integer"},
+                                    "completionTokens": {"type": "integer"},
+                                    "cachedTokens": {"type": "integer"},
+                                    "requests": {"type": "integer"},
+                                }
+                            }
+                        },
+                        "storage": {
+                            "type": "object",
+                            "properties": {
+                                "bytes": {"type": "integer"},
+                                "files": {"type": "integer"},
+                                "quotaBytes": {"type": "integer"},
+                                "quotaFiles": {"type": "integer"},
+                            }
+                        },
+                    }
+                }
+            )
+        },
+    ),
+)
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permissions_classes = [permissions.AllowAny]
+    pagination_class = UserPagination
+
+    @action(url_path="usage", detail=True, methods=[HTTPMethod.GET])
+    def usage(self, request: HttpRequest, pk: str) -> Response:
+        """Использование токенов пользователем"""
+
+        user = self.get_object()
+        usageService = UsageService()
+        today = timezone.localdate()
+        environments = TokenUsage.objects.filter(user=user, date__gte=today.replace(day=1)) \
+            .values("environment") \
+            .annotate(
+                promptTokens=Sum("promptTokens"),
+                completionTokens=Sum("completionTokens"),
+                cachedTokens=Sum("cachedTokens"),
+                requests=Sum("requests"),
+            ) \
+            .order_by("environment")
+        storage = StorageUsage.objects.filter(user=user).values("bytes", "files").first() or {"bytes": 0, "files": 0}
+
+        return Response({
+            "day": usageService.getUsage(user.id, "day"),
+            "month": usageService.getUsage(user.id, "month"),
+            "dailyQuota": settings.TOKEN_QUOTA_DAILY,
+            "monthlyQuota": settings.TOKEN_QUOTA_MONTHLY,
+            "environments": list(environments),
+            "storage": {
+                **storage,
+                "quotaBytes": settings.STORAGE_QUOTA_USER_BYTES,
+                "quotaFiles": settings.STORAGE_QUOTA_USER_FILES,
+            },
+        }, status=status.HTTP_200_OK)
 
 @extend_schema(tags=["Environments"])
 @extend_schema_view(
     list=extend_schema(
         summary="Получить список окружений",
+        description="Возвращает окружения постранично, начиная с последних измененных. Следующая страница запрашивается по ссылке next. "
+                    "Обычный пользователь видит только свои окружения, анонимный получает пустой список.",
+        parameters=[
+            OpenApiParameter("user", OpenApiTypes.INT, description="Идентификатор владельца"),
+            OpenApiParameter("editedAfter", OpenApiTypes.DATETIME, description="Изменены не раньше указанного времени"),
+            OpenApiParameter("editedBefore", OpenApiTypes.DATETIME, description="Изменены раньше указанного времени"),
+            OpenApiParameter("limit", OpenApiTypes.INT, description="Размер страницы"),
+        ],
     ),
     create=extend_schema(
         summary="Создание окружение",
@@ -166,20 +408,166 @@ class UserViewSet(viewsets.ModelViewSet):
             200: None
         },
     ),
+    clone=extend_schema(
+        summary="Создать копию окружения",
+        description="""Создает окружение того же владельца с файлами исходного окружения. Данные файлов не копируются,
+                    пока одна из копий их не изменит, поэтому время копирования не зависит от размера файлов.
+                    Если `fork` равен true, копируется и чат: целиком или до сообщения с индексом `index`
+                    в истории get-context. Иначе чат нового окружения пуст, а файлы нужно загрузить в контекст через commit-files""",
+        request=CloneSerializer,
+        responses={
+            201: EnvironmentSerializer,
+            404: OpenApiResponse(
+                description="Окружение не найдено",
+                response={
+                    "type": "object",
+                    "properties": {
+                        "detail": {"type": "string"}
+                    }
+                }
+            ),
+            413: OpenApiResponse(
+                description="Превышена квота хранилища пользователя или окружения",
+                response={
+                    "type": "object",
+                    "properties": {
+                        "detail": {"type": "string"}
+                    }
+                }
+            ),
+        },
+    ),
     loadFile=extend_schema(
         summary="Загрузить файл в окружение",
         description="Загружает один файл в окружение. Если файл с таким именем уже существует, он будет замен полученным файлом.",
         request=FileSerializer,
         responses={
-            201: None
+            201: None,
+            413: OpenApiResponse(
+                description="Превышена квота хранилища пользователя или окружения",
+                response={
+                    "type": "object",
+                    "properties": {
+                        "detail": {"type": "string"}
+                    }
+                }
+            ),
         },
     ),
     updateFile=extend_schema(
         summary="Обновить файл в окружение",
-        description="Дополняет содержимое файла в окружении. Если файла не существует, он будет создан с полученным содержанием файла.",
+        description="""Дописывает полученное содержимое в конец файла в окружении, не перезаписывая файл целиком.
+                    Если файла не существует, он будет создан с полученным содержанием файла. Одновременные дополнения
+                    одного окружения выполняются по очереди. Ответ содержит размер, оценку количества токенов и метку версии файла""",
         request=FileSerializer,
         responses={
-            200: None
+            200: OpenApiResponse(
+                response={
+                    "type": "object",
+                    "properties": {
+                        "size": {"type": "integer", "format": "int64"},
+                        "tokens": {"type": "integer", "format": "int64"},
+                        "revision": {"type": "string", "description": "Метка версии файла, меняется при каждом изменении. Не является хешем содержимого"},
+                    }
+                }
+            ),
+            413: OpenApiResponse(
+                description="Превышена квота хранилища пользователя или окружения",
+                response={
+                    "type": "object",
+                    "properties": {
+                        "detail": {"type": "string"}
+                    }
+                }
+            ),
+        },
+    ),
+    createUpload=extend_schema(
+        summary="Начать загрузку файла по частям",
+        description="""Начинает загрузку большого файла по частям. Весь размер файла учитывается в квотах хранилища сразу.
+                    Части отправляются запросами PUT uploads/{upload}/?offset=<байт> с содержимым части в теле запроса
+                    и записываются прямо в хранилище окружения. После обрыва количество полученных байтов можно узнать
+                    запросом GET uploads/{upload}/ и продолжить с него. Загрузка завершается запросом finalize с SHA-256
+                    всего файла. Загрузки, в которые не записывали дольше UPLOAD_TTL секунд, удаляются""",
+        request=UploadSerializer,
+        responses={
+            201: OpenApiResponse(response=UPLOAD_SCHEMA),
+            413: OpenApiResponse(
+                description="Превышена квота хранилища пользователя или окружения",
+                response={
+                    "type": "object",
+                    "properties": {
+                        "detail": {"type": "string"}
+                    }
+                }
+            ),
+        },
+    ),
+    upload=[
+        extend_schema(
+            methods=["GET"],
+            summary="Получить состояние загрузки",
+            description="Возвращает количество полученных байтов `offset`, с которого нужно продолжить загрузку.",
+            request=None,
+            responses={200: OpenApiResponse(response=UPLOAD_SCHEMA)},
+        ),
+        extend_schema(
+            methods=["PUT"],
+            summary="Загрузить часть файла",
+            description="""Записывает тело запроса, начиная с байта `offset`. Часть принимается, только если `offset` равен
+                        количеству уже полученных байтов, иначе возвращается 409 с текущим `offset`. Повторная отправка
+                        уже записанной части не записывает ее дважды.""",
+            parameters=[OpenApiParameter("offset", OpenApiTypes.INT, OpenApiParameter.QUERY, required=True)],
+            request={"application/octet-stream": OpenApiTypes.BINARY},
+            responses={
+                200: OpenApiResponse(
+                    response={
+                        "type": "object",
+                        "properties": {
+                            "upload": {"type": "string"},
+                            "offset": {"type": "integer", "format": "int64"},
+                        }
+                    }
+                ),
+                409: OpenApiResponse(
+                    description="Смещение не совпадает с количеством полученных байтов",
+                    response={
+                        "type": "object",
+                        "properties": {
+                            "detail": {"type": "string"},
+                            "offset": {"type": "integer", "format": "int64"},
+                        }
+                    }
+                ),
+            },
+        ),
+        extend_schema(
+            methods=["DELETE"],
+            summary="Отменить загрузку",
+            description="Удаляет полученные части и освобождает место в квотах хранилища.",
+            request=None,
+            responses={200: None},
+        ),
+    ],
+    commitUpload=extend_schema(
+        summary="Завершить загрузку по частям",
+        description="""Проверяет, что получены все байты и их SHA-256 совпадает с `checksum`, и заменяет загруженным файлом
+                    файл с тем же именем. Если сумма не совпадает, загрузка удаляется и возвращается 422""",
+        request=CommitUploadSerializer,
+        responses={
+            201: OpenApiResponse(
+                response={
+                    "type": "object",
+                    "properties": {
+                        "filename": {"type": "string"},
+                        "size": {"type": "integer", "format": "int64"},
+                        "tokens": {"type": "integer", "format": "int64"},
+                        "revision": {"type": "string", "description": "Метка версии файла, меняется при каждом изменении. Не является хешем содержимого"},
+                    }
+                }
+            ),
+            409: OpenApiResponse(description="Получены не все байты файла"),
+            422: OpenApiResponse(description="Контрольная сумма не совпадает"),
         },
     ),
     removeFile=extend_schema(
@@ -217,8 +605,12 @@ class UserViewSet(viewsets.ModelViewSet):
     ),
     listFiles=extend_schema(
         summary="Получить список файлов из окружения",
-        description="Получает список файлов из окружения.",
+        description="Получает список файлов из окружения. Ответ содержит ETag; если список не изменился, "
+                    "запрос с заголовком If-None-Match возвращает 304 без чтения директории.",
         request=None,
+        parameters=[
+            OpenApiParameter("If-None-Match", OpenApiTypes.STR, OpenApiParameter.HEADER, description="ETag предыдущего ответа"),
+        ],
         responses={
             200: OpenApiResponse(
                 response={
@@ -229,6 +621,8 @@ class UserViewSet(viewsets.ModelViewSet):
                             "filename": {"type": "string"},
                             "size": {"type": "integer", "format": "int64"},
                             "updatedAt": {"type": "integer", "format": "int64"},
+                            "tokens": {"type": "integer", "format": "int64", "description": "Оценка количества токенов"},
+                            "revision": {"type": "string", "description": "Метка версии файла, меняется при каждом изменении. Не является хешем содержимого"},
                         }
                     }
                 }
@@ -253,6 +647,25 @@ class UserViewSet(viewsets.ModelViewSet):
             )
         },
     ),
+    generateBatch=extend_schema(
+        summary="Отправить запросы на генерацию текста для нескольких окружений",
+        description="""Выполняет generate для каждого окружения из списка. Файлы окружений загружаются в контекст параллельно, 
+                    количество одновременных запросов к модели ограничено. Результаты возвращаются в формате NDJSON по мере готовности, 
+                    по одной строке на окружение: {"id": ..., "response": ...} или {"id": ..., "detail": ...} в случае ошибки.""",
+        request=GenerateBatchSerializer,
+        responses={
+            (200, "application/x-ndjson"): OpenApiResponse(
+                response={
+                    "type": "object", 
+                    "properties": {
+                        "id": {"type": "integer"},
+                        "response": {"type": "string"},
+                        "detail": {"type": "string"},
+                    }
+                }
+            )
+        },
+    ),
     sendPrompt=extend_schema(
         summary="Отправить простой запрос на генерацию текста",
         description="Отправляет простой запрос на генерацию текста модели.",
@@ -270,18 +683,52 @@ class UserViewSet(viewsets.ModelViewSet):
             )
         },
     ),
+    fix=extend_schema(
+        summary="Переписать фрагмент ответа модели",
+        description="""Переписывает фрагмент ранее полученного ответа модели и заменяет его в истории чата. 
+                    Модели отправляются только фрагмент, соседние строки ответа и подходящие строки файлов окружения. 
+                    Если index не указан, используется последний ответ, содержащий фрагмент.""",
+        request=FixPromptSerializer,
+        responses={
+            200: OpenApiResponse(
+                response={
+                    "type": "object", 
+                    "properties": {
+                        "response": {
+                            "type": "string"
+                        }
+                    }
+                },
+            )
+        },
+    ),
     commitFiles=extend_schema(
         summary="Загрузить содержание файлов окружения в контекст",
-        description="Загружает содержание файлов окружения в контекст модели. Если файлов не сущетсвует, загружается пустой контекст.",
+        description="Загружает содержание файлов окружения в контекст модели. Если файлов не сущетсвует, загружается пустой контекст. "
+                    "Повторяющиеся фрагменты файлов отправляются модели один раз, ответ содержит оценку сэкономленных токенов.",
         request=None,
         responses={
-            200: None
+            200: OpenApiResponse(
+                response={
+                    "type": "object",
+                    "properties": {
+                        "tokensSaved": {"type": "integer"},
+                    }
+                }
+            )
         },
     ),
     getContext=extend_schema(
         summary="Получить историю чата с моделью",
-        description="Получает сообщения из контекста модели. Системные сообщения игнорируются, например, промпт по умолчанию или содержаение файлов.",
+        description="Получает сообщения из контекста модели. Системные сообщения игнорируются, например, промпт по умолчанию или содержаение файлов. "
+                    "Ответ содержит ETag; если история не изменилась, запрос с заголовком If-None-Match возвращает 304.",
         request=None,
+        parameters=[
+            OpenApiParameter("since", OpenApiTypes.INT, description="Идентификатор последнего полученного сообщения: "
+                             "возвращаются только сообщения, добавленные или измененные после него. "
+                             "Если чат создан заново и такого идентификатора в нем еще не было, возвращается вся история"),
+            OpenApiParameter("If-None-Match", OpenApiTypes.STR, OpenApiParameter.HEADER, description="ETag предыдущего ответа"),
+        ],
         responses={
             200: OpenApiResponse(
                 response={
@@ -289,6 +736,7 @@ class UserViewSet(viewsets.ModelViewSet):
                     "items": {
                         "type": "object",
                         "properties": {
+                            "id": {"type": "integer"},
                             "role": {"type": "string"},
                             "content": {"type": "string"}
                         }
@@ -298,8 +746,8 @@ class UserViewSet(viewsets.ModelViewSet):
                     OpenApiExample(
                         name="Пример ответа",
                         value=[
-                            {"role": "user", "content": "request"},
-                            {"role": "assistant", "content": "response"},
+                            {"id": 12, "role": "user", "content": "request"},
+                            {"id": 13, "role": "assistant", "content": "response"},
                         ],
                         response_only=True,
                     )
@@ -320,15 +768,50 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
     queryset = Environment.objects.all()
     serializer_class = EnvironmentSerializer
     permissions_classes = [permissions.AllowAny]
+    pagination_class = EnvironmentPagination
     
-    environmentService = EnvironmentService()
+    environmentService = lazy(EnvironmentService)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if (self.action != "list"):
+            return queryset
+
+        # Анонимный пользователь не видит окружений, обычный видит только свои, администратор может выбрать владельца
+        user = self.request.user
+        if (user.is_authenticated == False):
+            return queryset.none()
+        if (user.is_staff == False):
+            queryset = queryset.filter(user=user)
+
+        owner = self.request.query_params.get("user", None)
+        if (owner is not None):
+            if (owner.isdigit() == False):
+                raise ValidationError({"user": "Must be an integer."})
+            queryset = queryset.filter(user_id=int(owner))
+
+        for param, lookup in (("editedAfter", "editedAt__gte"), ("editedBefore", "editedAt__lt")):
+            value = self.request.query_params.get(param, None)
+            if (value is None):
+                continue
+            try:
+                moment = parse_datetime(value)
+            except ValueError:
+                moment = None
+            if (moment is None):
+                raise ValidationError({param: "Must be an ISO 8601 datetime."})
+            if (timezone.is_naive(moment)):
+                moment = timezone.make_aware(moment)
+            queryset = queryset.filter(**{lookup: moment})
+
+        return queryset
 
     """Endpoints: """
     """For Environment:"""
 
     def perform_create(self, serializer: EnvironmentSerializer):
-        self.environmentService.createEnvironment(serializer.data.get("id"))
         serializer.save()
+        self.environmentService.createEnvironment(str(serializer.instance.id))
 
     def perform_destroy(self, instance):
         self.environmentService.removeEnvironment(str(instance.id))
@@ -340,6 +823,36 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
         """Очистка окружения без его удаления"""
 
         return self.environmentService.clearEnvironment(pk)
+
+    @action(url_path="clone", detail=True, methods=[HTTPMethod.POST])
+    @serialize(queryset=queryset, serializers=[CloneSerializer])
+    def clone(self, request: HttpRequest, pk: str) -> JsonResponse:
+        """Копирование окружения с файлами и, при необходимости, чатом"""
+
+        source = Environment.objects.get(pk=pk)
+        options = CloneSerializer(data=request.data)
+        options.is_valid()
+        serializer = EnvironmentSerializer(data={
+            "name": options.validated_data.get("name") or source.name,
+            "description": options.validated_data.get("description", source.description),
+            "user": source.user_id,
+        })
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        try:
+            self.environmentService.cloneEnvironment(
+                pk,
+                str(serializer.instance.id),
+                options.validated_data["fork"],
+                options.validated_data.get("index", None)
+            )
+        except Exception:
+            serializer.instance.delete()
+            raise
+
+        # Объем и количество файлов копии учитываются при копировании файлов
+        serializer.instance.refresh_from_db()
+        return JsonResponse(EnvironmentSerializer(serializer.instance).data, status=status.HTTP_201_CREATED)
     
     """For Files:"""
 
@@ -358,6 +871,38 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
 
         file = request.FILES['file']
         return self.environmentService.updateFile(pk, file, file.name)
+
+    @action(url_path="uploads", detail=True, methods=[HTTPMethod.POST])
+    @serialize(queryset=queryset, serializers=[UploadSerializer])
+    def createUpload(self, request: HttpRequest, pk: str) -> JsonResponse:
+        """Начало загрузки файла по частям"""
+
+        return self.environmentService.createUpload(pk, request.data["filename"], int(request.data["size"]))
+
+    @action(url_path=r"uploads/(?P<upload>[0-9a-f]{32})", detail=True, methods=[HTTPMethod.GET, HTTPMethod.PUT, HTTPMethod.DELETE])
+    @serialize(queryset=queryset)
+    def upload(self, request: HttpRequest, pk: str, upload: str) -> JsonResponse:
+        """Состояние, запись части и отмена загрузки по частям"""
+
+        if (request.method == HTTPMethod.GET):
+            return self.environmentService.getUpload(pk, upload)
+        if (request.method == HTTPMethod.DELETE):
+            return self.environmentService.removeUpload(pk, upload)
+
+        serializer = UploadChunkSerializer(data=request.query_params)
+        if (serializer.is_valid() == False):
+            return JsonResponse({"detail": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+        # Тело читается потоком, не загружаясь в память и не сохраняясь во временный файл
+        stream = request.stream
+        data = iter(lambda: stream.read(65536), b"") if stream is not None else iter(())
+        return self.environmentService.writeUpload(pk, upload, serializer.validated_data["offset"], data)
+
+    @action(url_path=r"uploads/(?P<upload>[0-9a-f]{32})/finalize", detail=True, methods=[HTTPMethod.POST])
+    @serialize(queryset=queryset, serializers=[CommitUploadSerializer])
+    def commitUpload(self, request: HttpRequest, pk: str, upload: str) -> JsonResponse:
+        """Завершение загрузки по частям"""
+
+        return self.environmentService.commitUpload(pk, upload, request.data["checksum"])
     
     @action(url_path="remove-file", detail=True, methods=[HTTPMethod.DELETE])
     @serialize(queryset=queryset, serializers=[FileNameSerializer])
@@ -380,6 +925,9 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
     def listFiles(self, request: HttpRequest, pk: str) -> JsonResponse:
         """Получение списка файлов окружения и их свойств"""
 
+        response = notModified(request, self.environmentService.getFilesVersion(pk))
+        if (response is not None):
+            return response
         return self.environmentService.listFiles(pk)
     
     """For AI Model:"""
@@ -391,6 +939,34 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
         
         return self.environmentService.generate(pk, request.data.get("prompt", ''))
 
+    @action(url_path="generate-batch", detail=False, methods=[HTTPMethod.POST])
+    def generateBatch(self, request: HttpRequest) -> StreamingHttpResponse:
+        """Отправка запросов модели на генерацию текстовых файлов для нескольких окружений"""
+
+        serializer = GenerateBatchSerializer(data=request.data)
+        if (serializer.is_valid() == False):
+            return JsonResponse(
+                {"detail": serializer.errors},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        items = [
+            {"id": str(x["id"]), "prompt": x.get("prompt") or ''} 
+            for x in serializer.validated_data["items"]
+        ]
+        existing = set(
+            str(x) for x in self.get_queryset().filter(id__in=[x["id"] for x in items]).values_list("id", flat=True)
+        )
+
+        def stream():
+            for x in items:
+                if (x["id"] not in existing):
+                    yield dumps({"id": int(x["id"]), "detail": "Not found."}) + b"\n"
+            for x in self.environmentService.generateBatch([x for x in items if x["id"] in existing]):
+                yield dumps({**x, "id": int(x["id"])}) + b"\n"
+
+        return StreamingHttpResponse(stream(), content_type="application/x-ndjson")
+
     @action(url_path="send-prompt", detail=True, methods=[HTTPMethod.POST])
     @serialize(queryset=queryset, serializers=[PromptSerializer])
     def sendPrompt(self, request: HttpRequest, pk: str) -> JsonResponse:
@@ -398,6 +974,18 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
 
         return self.environmentService.sendPrompt(pk, request.data.get("prompt", ''))
     
+    @action(url_path="fix", detail=True, methods=[HTTPMethod.POST])
+    @serialize(queryset=queryset, serializers=[FixPromptSerializer])
+    def fix(self, request: HttpRequest, pk: str) -> JsonResponse:
+        """Отправка запроса модели на исправление фрагмента ответа"""
+
+        return self.environmentService.fix(
+            pk, 
+            request.data.get("fragment"), 
+            request.data.get("index", None), 
+            request.data.get("prompt", '')
+        )
+    
     @action(url_path="commit-files", detail=True, methods=[HTTPMethod.POST])
     @serialize(queryset=queryset)
     def commitFiles(self, request: HttpRequest, pk: str) -> JsonResponse:
@@ -410,7 +998,17 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
     def getContext(self, request: HttpRequest, pk: str) -> JsonResponse:
         """Получение истории сообщений переписки с моделью"""
 
-        return self.environmentService.getChatContext(pk)
+        since = request.query_params.get("since", "0")
+        if (since.isdigit() == False):
+            return JsonResponse(
+                {"detail": {"since": ["Must be a non-negative integer."]}},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        response = notModified(request, self.environmentService.getChatVersion(pk))
+        if (response is not None):
+            return response
+        return self.environmentService.getChatContext(pk, int(since))
 
     @action(url_path="clear-context", detail=True, methods=[HTTPMethod.DELETE])
     @serialize(queryset=queryset)
@@ -0,0 +1,52 @@
+import logging
+import time
+from typing import Callable, Dict, List
+
+from django.test import RequestFactory
+
+from .connections import GPTConnection
+from .services import AccessService, EnvironmentService, NotificationService, UsageService
+
+logger = logging.getLogger(__name__)
+
+# Create your warm-up steps here.
+
+def services() -> None:
+    """Создает сервисы и хранилище окружений"""
+    EnvironmentService()
+    AccessService()
+    NotificationService()
+    UsageService()
+
+def client() -> None:
+    """Создает клиент OpenAI"""
+    GPTConnection().client
+
+def schema() -> None:
+    """Генерирует схему OpenAPI в форматах YAML и JSON"""
+    from .views import SchemaView
+
+    view = SchemaView.as_view()
+    factory = RequestFactory()
+    for query in ({}, {"format": "json"}):
+        view(factory.get("/api/schema/", query))
+
+steps: List[tuple[str, Callable]] = [
+    ("services", services),
+    ("client", client),
+    ("schema", schema),
+]
+
+def warmUp() -> Dict[str, float]:
+    """
+    Выполняет заранее работу, которую иначе сделал бы первый запрос: создает сервисы, клиент модели
+    и схему OpenAPI. Возвращает время каждого шага в миллисекундах
+    """
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        timings[name] = round((time.perf_counter() - start) * 1000, 3)
+
+    logger.info("warm-up finished", extra={"timings": timings})
+    return timings
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import re
+import uuid
+from typing import Dict
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+from rest_framework.exceptions import AuthenticationFailed
+
+from .authentication import CachedTokenAuthentication
+from .logs import requestId
+from .renderers import dumps
+from .services import AccessService, EnvironmentService, NotificationService, QuotaExceeded
+
+logger = logging.getLogger(__name__)
+
+# Create your websockets here.
+
+class WebSocketRouter:
+    """
+    Передает WebSocket-соединения с путем /ws/v1/environments/<id>/chat/ в EnvironmentSocket,
+    а остальные запросы - приложению Django
+    """
+
+    pattern = re.compile(r"^/ws/v1/environments/(?P<pk>\d+)/chat/?$")
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope: Dict, receive, send) -> None:
+        if (scope["type"] != "websocket"):
+            return await self.application(scope, receive, send)
+
+        match = self.pattern.match(scope["path"])
+        if (match is None):
+            # Закрытие до принятия соединения отклоняет рукопожатие
+            await receive()
+            await send({"type": "websocket.close", "code": 4404})
+            return
+
+        await EnvironmentSocket(match["pk"], scope, receive, send).run()
+
+class EnvironmentSocket:
+    """
+    Чат с моделью в одном окружении через WebSocket. Пользователь аутентифицируется один раз при подключении
+    токеном из заголовка Authorization или параметра token. Сообщения передаются в формате JSON:
+
+    - клиент: `{"type": "prompt", "prompt": "..."}`, `{"type": "ping"}`
+    - сервер: `{"type": "start"}`, `{"type": "token", "content": "..."}`, `{"type": "done", "response": "..."}`,
+      `{"type": "error", "status": 429, "detail": "..."}`, `{"type": "pong"}`
+    - события окружения: `{"type": "file", "action": "saved" | "updated" | "removed", "filename": "..."}`,
+      `{"type": "commit", "tokensSaved": ...}`, `{"type": "clear"}`. Приходят только события, опубликованные в этом процессе
+
+    Одновременно обрабатывается один запрос к модели. Соединение закрывается с кодом 4401, если токен
+    неверен, 4403, если окружение принадлежит другому пользователю, и 4404, если окружения не существует
+    """
+
+    promptLength = 512
+
+    def __init__(self, id: str, scope: Dict, receive, send):
+        self.id = id
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.requestId = uuid.uuid4().hex
+        self.loop = asyncio.get_running_loop()
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+        self.busy = False
+        self.environmentService = EnvironmentService()
+        self.notificationService = NotificationService()
+
+    async def run(self) -> None:
+        message = await self.receive()
+        if (message["type"] != "websocket.connect"):
+            return
+
+        token = requestId.set(self.requestId)
+        try:
+            code = await sync_to_async(self.authorize)()
+            await self.send({"type": "websocket.accept"})
+            if (code is not None):
+                await self.send({"type": "websocket.close", "code": code})
+                return
+
+            logger.info("websocket connected", extra={"environment": self.id})
+            self.notificationService.subscribe(self.id, self.push)
+            sender = asyncio.create_task(self.sender())
+            try:
+                await self.receiver()
+            finally:
+                self.notificationService.unsubscribe(self.id, self.push)
+                sender.cancel()
+                logger.info("websocket disconnected", extra={"environment": self.id})
+        finally:
+            requestId.reset(token)
+
+    def authorize(self) -> int | None:
+        """Проверяет токен и владельца окружения. Возвращает код закрытия соединения или None"""
+        try:
+            user = self.authenticate()
+            if (user is None):
+                return 4401
+            owner = AccessService().ownerOf(self.id)
+            if (owner is None):
+                return 4404
+            if (owner != user.id and user.is_staff == False):
+                return 4403
+            return None
+        finally:
+            close_old_connections()
+
+    def authenticate(self) -> User | None:
+        headers = dict(self.scope.get("headers", []))
+        key = parse_qs(self.scope.get("query_string", b"").decode()).get("token", [""])[0]
+        authorization = headers.get(b"authorization", b"").decode().split()
+        if (len(authorization) == 2 and authorization[0] == "Token"):
+            key = authorization[1]
+        if (key == ""):
+            return None
+
+        try:
+            user, _ = CachedTokenAuthentication().authenticate_credentials(key)
+        except AuthenticationFailed:
+            return None
+        return user
+
+    async def receiver(self) -> None:
+        while True:
+            message = await self.receive()
+            if (message["type"] == "websocket.disconnect"):
+                return
+            if (message["type"] != "websocket.receive"):
+                continue
+
+            try:
+                data = json.loads(message.get("text") or message.get("bytes") or b"")
+            except ValueError:
+                data = None
+            if (isinstance(data, dict) == False):
+                self.push({"type": "error", "status": 400, "detail": "message must be a JSON object"})
+                continue
+
+            if (data.get("type") == "ping"):
+                self.push({"type": "pong"})
+            elif (data.get("type") == "prompt"):
+                self.prompt(data.get("prompt", None))
+            else:
+                self.push({"type": "error", "status": 400, "detail": f"unknown message type: {data.get('type')}"})
+
+    def prompt(self, prompt) -> None:
+        if (isinstance(prompt, str) == False or len(prompt) < 1 or len(prompt) > self.promptLength):
+            self.push({"type": "error", "status": 400, "detail": f"prompt must be a string of 1 to {self.promptLength} characters"})
+            return
+        if (self.busy):
+            self.push({"type": "error", "status": 409, "detail": "previous prompt is still being answered"})
+            return
+
+        self.busy = True
+        self.loop.run_in_executor(None, self.answer, prompt)
+
+    def answer(self, prompt: str) -> None:
+        """Получает ответ модели по частям. Выполняется в отдельном потоке"""
+        token = requestId.set(self.requestId)
+        try:
+            self.push({"type": "start"})
+            parts = []
+            for x in self.environmentService.streamPrompt(self.id, prompt):
+                parts.append(x)
+                self.push({"type": "token", "content": x})
+            self.push({"type": "done", "response": "".join(parts)})
+        except QuotaExceeded as e:
+            self.push({"type": "error", "status": 429, "detail": " ".join(e.args)})
+        except Exception as e:
+            logger.exception("websocket prompt failed", extra={"environment": self.id})
+            self.push({"type": "error", "status": 500, "detail": " ".join(str(x) for x in e.args)})
+        finally:
+            close_old_connections()
+            requestId.reset(token)
+            self.loop.call_soon_threadsafe(self.release)
+
+    def release(self) -> None:
+        self.busy = False
+
+    def push(self, event: Dict) -> None:
+        """Ставит событие в очередь отправки. Может вызываться из любого потока"""
+        try:
+            self.loop.call_soon_threadsafe(self.outgoing.put_nowait, event)
+        except RuntimeError:
+            # Цикл событий уже остановлен
+            pass
+
+    async def sender(self) -> None:
+        while True:
+            event = await self.outgoing.get()
+            # Части ответа, накопившиеся за время отправки, объединяются в одно сообщение
+            while (event["type"] == "token" and self.outgoing.empty() == False):
+                following = self.outgoing.get_nowait()
+                if (following["type"] != "token"):
+                    await self.send({"type": "websocket.send", "text": dumps(event).decode()})
+                    event = following
+                    break
+                event = {"type": "token", "content": event["content"] + following["content"]}
+            await self.send({"type": "websocket.send", "text": dumps(event).decode()})
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable
+
+from django.conf import settings
+
+from .base import once, Singleton
+from .logs import requestId
+
+logger = logging.getLogger(__name__)
+
+# Create your workers here.
+
+class Worker(Singleton):
+    """
+    Базовый класс фоновых обработчиков
+    """
+    pass
+
+class BackgroundWorker(Worker):
+    """
+    Выполняет задачи вне потока обработки запроса
+    """
+
+    @once
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.BACKGROUND_WORKERS,
+            thread_name_prefix="background"
+        )
+        self.lock = threading.Lock()
+        self.pending: Dict[Hashable, Future] = {}
+        self.periodic: set = set()
+        self.timers: Dict[Hashable, threading.Timer] = {}
+
+    def submit(self, func: Callable, *args, key: Hashable = None, **kwargs) -> Future:
+        """
+        Ставит `func` в очередь на выполнение. Если задача с таким же `key` еще не завершена,
+        новая задача не создается и возвращается уже запланированная
+        """
+        if (key is None):
+            return self.executor.submit(self.__run, requestId.get(), func, *args, **kwargs)
+
+        with self.lock:
+            future = self.pending.get(key, None)
+            if (future is not None):
+                return future
+
+            future = self.pending[key] = self.executor.submit(self.__run, requestId.get(), func, *args, **kwargs)
+
+        future.add_done_callback(lambda x: self.__release(key, x))
+        return future
+
+    def every(self, interval: float, func: Callable, key: Hashable) -> None:
+        """Выполняет `func` каждые `interval` секунд. Повторный вызов с тем же `key` ничего не делает"""
+        with self.lock:
+            if (key in self.periodic):
+                return
+            self.periodic.add(key)
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.submit(func, key=key)
+                except RuntimeError:
+                    # Пул потоков остановлен при завершении процесса
+                    return
+
+        threading.Thread(target=loop, name=f"every-{key}", daemon=True).start()
+
+    def debounce(self, delay: float, func: Callable, *args, key: Hashable, **kwargs) -> None:
+        """
+        Ставит `func` в очередь через `delay` секунд после последнего вызова с тем же `key`.
+        Если задача с этим `key` еще выполняется, запуск снова откладывается, чтобы она увидела все изменения
+        """
+        with self.lock:
+            timer = self.timers.pop(key, None)
+            if (timer is not None):
+                timer.cancel()
+            timer = self.timers[key] = threading.Timer(delay, self.__fire, (delay, key, requestId.get(), func, args, kwargs))
+            timer.daemon = True
+            timer.start()
+
+    def getPending(self, key: Hashable) -> Future | None:
+        """Возвращает незавершенную задачу с ключом `key`"""
+        with self.lock:
+            return self.pending.get(key, None)
+
+    def __run(self, id: str, func: Callable, *args, **kwargs):
+        # Записи журнала фоновой задачи связываются с запросом, который ее запланировал
+        token = requestId.set(id)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            logger.exception("background task failed", extra={"task": getattr(func, "__name__", repr(func))})
+            raise
+        finally:
+            requestId.reset(token)
+
+    def __fire(self, delay: float, key: Hashable, id: str, func: Callable, args: tuple, kwargs: Dict) -> None:
+        with self.lock:
+            if (self.timers.get(key, None) is not threading.current_thread()):
+                return
+            self.timers.pop(key)
+            running = key in self.pending
+
+        token = requestId.set(id)
+        try:
+            if (running):
+                self.debounce(delay, func, *args, key=key, **kwargs)
+            else:
+                self.submit(func, *args, key=key, **kwargs)
+        except RuntimeError:
+            # Таймер сработал после остановки пула потоков при завершении процесса, задача уже не нужна
+            logger.debug("background task dropped after shutdown", extra={"task": getattr(func, "__name__", repr(func))})
+        finally:
+            requestId.reset(token)
+
+    def __release(self, key: Hashable, future: Future) -> None:
+        with self.lock:
+            if (self.pending.get(key, None) is future):
+                self.pending.pop(key)
@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'base.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Импортируется после настройки Django
+from django.conf import settings
+from api.websockets import WebSocketRouter
+
+application = WebSocketRouter(django_application)
+
+if (settings.WARMUP):
+    from api.warmup import warmUp
+    warmUp()
@@ -58,6 +58,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestIdMiddleware',
+    'api.middleware.MetricsMiddleware',
+    'api.middleware.ProfilingMiddleware',
+    'api.middleware.CompressionMiddleware',
+
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,9 +78,13 @@ ROOT_URLCONF = 'base.urls'
 
 REST_FRAMEWORK = {       
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema', 
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.OrjsonRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 SPECTACULAR_SETTINGS = {
@@ -115,9 +124,44 @@ DATABASES = {
        'PASSWORD': os.getenv('DB_PASSWORD'),
        'HOST': os.getenv('DB_HOST'),
        'PORT': os.getenv('DB_PORT'),
+       # Постоянные соединения: время жизни в секундах (0 - закрывать после каждого запроса, None - без ограничения).
+       # По умолчанию выключены: при ASGI запросы выполняются в разных потоках, и у каждого потока остается свое соединение
+       'CONN_MAX_AGE': None if os.getenv('DB_CONN_MAX_AGE') == 'None' else int(os.getenv('DB_CONN_MAX_AGE', 0)),
+       'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS') != 'False',
+       'OPTIONS': {},
    }
 }
 
+# Пул соединений psycopg 3. Несовместим с постоянными соединениями, поэтому отключает CONN_MAX_AGE
+if (os.getenv('DB_POOL') == 'True'):
+    from psycopg_pool import ConnectionPool
+
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        # Проверка соединения перед выдачей из пула
+        'check': ConnectionPool.check_connection,
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# Кэш токенов, владельцев окружений и сумм использования. Кэш в памяти процесса сбрасывается только в процессе,
+# где изменились данные, поэтому при нескольких процессах нужен общий кэш Redis
+CACHE_URL = os.getenv('CACHE_URL', '')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_URL,
+    } if CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -159,3 +203,154 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Logging
+
+# Максимальная длина строк и списков в подробных записях журнала
+LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', 256))
+# Доля подробных (DEBUG) событий, например содержимого чатов, которые записываются в журнал
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {
+            '()': 'api.logs.RequestIdFilter',
+        },
+    },
+    'formatters': {
+        'json': {
+            '()': 'api.logs.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'filters': ['request_id'],
+            'formatter': 'json',
+        },
+    },
+    'loggers': {
+        'api': {
+            'handlers': ['console'],
+            'level': os.getenv('LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+
+# Metrics
+
+# Секрет для заголовка Authorization: Bearer <токен>, с которым /metrics доступен сборщику метрик. Без него - только администраторам
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+
+# Profiling
+
+# Включает профилирование запросов. Если выключено, профилирование не добавляет накладных расходов
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED') == 'True'
+# Доля случайно профилируемых запросов, может быть изменена администратором во время работы
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0))
+# Порог в миллисекундах, начиная с которого профиль запроса сохраняется
+PROFILING_SLOW_MS = float(os.getenv('PROFILING_SLOW_MS', 500))
+# Количество сохраняемых профилей
+PROFILING_KEEP = int(os.getenv('PROFILING_KEEP', 20))
+# Секрет для заголовка X-Profile, принудительно профилирующего запрос
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+
+
+# Background workers
+
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', 2))
+
+# Создавать сервисы, клиент модели и схему OpenAPI при запуске WSGI/ASGI-приложения, а не при первом запросе
+WARMUP = os.getenv('WARMUP') == 'True'
+
+
+# Token usage
+
+# Квоты токенов на пользователя, 0 - без ограничений
+TOKEN_QUOTA_DAILY = int(os.getenv('TOKEN_QUOTA_DAILY', 0))
+TOKEN_QUOTA_MONTHLY = int(os.getenv('TOKEN_QUOTA_MONTHLY', 0))
+# Интервал в секундах и размер буфера, при которых использование записывается в базу данных
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', 10))
+USAGE_FLUSH_SIZE = int(os.getenv('USAGE_FLUSH_SIZE', 500))
+# Время жизни в секундах закэшированных сумм использования и владельцев окружений
+USAGE_CACHE_TTL = int(os.getenv('USAGE_CACHE_TTL', 300))
+
+
+# Access caching
+
+# Время жизни в секундах закэшированных владельцев окружений и токенов авторизации
+OWNER_CACHE_TTL = int(os.getenv('OWNER_CACHE_TTL', 300))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 60))
+
+
+# File storage
+
+# Окружения распределяются по сегментам shards/<хеш>/. После изменения выполните python manage.py migratestorage
+FILES_SHARDED = os.getenv('FILES_SHARDED') == 'True'
+# Синхронизация записанных файлов с диском перед переименованием
+FILES_FSYNC = os.getenv('FILES_FSYNC') != 'False'
+# Интервал в секундах, с которым директории удаленных окружений удаляются с диска, 0 - без фоновой сверки
+STORAGE_GC_INTERVAL = float(os.getenv('STORAGE_GC_INTERVAL', 600))
+# Квоты хранилища, 0 - без ограничений. Счетчики пересчитываются с диска командой python manage.py recountstorage
+STORAGE_QUOTA_USER_BYTES = int(os.getenv('STORAGE_QUOTA_USER_BYTES', 0))
+STORAGE_QUOTA_USER_FILES = int(os.getenv('STORAGE_QUOTA_USER_FILES', 0))
+STORAGE_QUOTA_ENVIRONMENT_BYTES = int(os.getenv('STORAGE_QUOTA_ENVIRONMENT_BYTES', 0))
+# Время в секундах с последней записи, после которого незавершенная загрузка по частям удаляется при сверке хранилища
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', 86400))
+
+
+# Response compression
+
+# Минимальный размер ответа в байтах, начиная с которого ответ сжимается
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+# Уровень сжатия gzip (1-9) и качество сжатия brotli (0-11)
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', 4))
+
+
+# Listings
+
+# Размер страницы списков окружений и пользователей и максимальное значение параметра limit
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 200))
+
+
+# Model conversations
+
+# Доля GPTService.tokenLimit, после которой старые сообщения чата сжимаются в краткое содержание
+CHAT_COMPACTION_THRESHOLD = float(os.getenv('CHAT_COMPACTION_THRESHOLD', 0.75))
+# Количество последних сообщений, которые сохраняются без сжатия
+CHAT_KEEP_MESSAGES = int(os.getenv('CHAT_KEEP_MESSAGES', 4))
+
+# Собирать контекст файлов окружения в фоне после загрузки, дополнения или удаления файла
+CONTEXT_PREBUILD = os.getenv('CONTEXT_PREBUILD') != 'False'
+# Время в секундах без изменений файлов окружения, после которого собирается контекст
+CONTEXT_PREBUILD_DELAY = float(os.getenv('CONTEXT_PREBUILD_DELAY', 1))
+# Количество окружений, собранный контекст которых хранится в памяти
+CONTEXT_PREBUILD_MAX = int(os.getenv('CONTEXT_PREBUILD_MAX', 100))
+# Заменять повторяющиеся фрагменты файлов ссылкой на первое вхождение при загрузке файлов в контекст модели
+CONTEXT_DEDUP = os.getenv('CONTEXT_DEDUP') != 'False'
+# Оценка сходства Жаккара, начиная с которой фрагменты считаются почти совпадающими, 1 - только точные повторы.
+# Отличающийся текст почти совпадающих фрагментов не отправляется модели, поэтому по умолчанию только точные повторы
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv('CONTEXT_DEDUP_THRESHOLD', 1))
+# Размер фрагмента в символах: абзацы объединяются, пока фрагмент не достигнет этого размера
+CONTEXT_DEDUP_CHUNK = int(os.getenv('CONTEXT_DEDUP_CHUNK', 1024))
+
+# Количество строк ответа до и после фрагмента, отправляемых модели при его исправлении
+FIX_CONTEXT_LINES = int(os.getenv('FIX_CONTEXT_LINES', 3))
+# Максимальное количество строк файлов, отправляемых модели при исправлении фрагмента
+FIX_EXCERPT_LINES = int(os.getenv('FIX_EXCERPT_LINES', 8))
+
+
+# Batch generation
+
+# Количество потоков, загружающих файлы окружений в контекст модели
+BATCH_CONTEXT_WORKERS = int(os.getenv('BATCH_CONTEXT_WORKERS', 8))
+# Максимальное количество одновременных запросов к модели
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
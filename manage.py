@@ -25,12 +25,11 @@ if __name__ == '__main__':
     if os.path.exists(dotenv_path):
         load_dotenv()
 
-    print("Creating connection to OpenAI API")
+    # Клиент OpenAI создается при первом запросе к модели
     GPTConnection(
         api_key=os.getenv("OPENAI_API_KEY"),
         url=os.getenv("OPENAI_API_URL"),
         model=os.getenv("MODEL_NAME")
     )
-    print("Connection created")
     
     main()